@@ -0,0 +1,11 @@
+""" asyncio names that differ between the ROV's Python 3.4 and current Pythons,
+so the ROV code also runs on a development machine (see loopback_bench.py).
+"""
+import asyncio
+import types
+
+# Decorator for generator based coroutines. asyncio.coroutine was removed in Python 3.11.
+coroutine = getattr(asyncio, "coroutine", types.coroutine)
+
+# asyncio.async was renamed ensure_future in 3.4.4, and is a syntax error from 3.7 on.
+ensure_future = getattr(asyncio, "ensure_future", None) or getattr(asyncio, "async")
@@ -0,0 +1,27 @@
+""" Control path shared by rov.py and the replay harness.
+Nothing here touches hardware, so it can run off the ROV.
+"""
+
+def apply_deadzone(info, deadzone):
+    """ Zeroes stick axes that are within deadzone. """
+    if abs(info["lx"]) < deadzone:
+        info["lx"] = 0
+    if abs(info["ly"]) < deadzone:
+        info["ly"] = 0
+    if abs(info["rx"]) < deadzone:
+        info["rx"] = 0
+    if abs(info["ry"]) < deadzone:
+        info["ry"] = 0
+
+def manual_command(thrusters, info, timed_out=False):
+    """ Maps controller axes onto the thrusters' movement command.
+        All movement is cleared once packets have timed out.
+    """
+    thrusters.move_horizontal(info["lx"])
+    thrusters.move_forward(info["ly"])
+    thrusters.move_vertical(info["lt"] - info["rt"])
+    thrusters.move_yaw(-info["rx"]) # Flipped to map xbox state to ROV coordinate
+    thrusters.move_pitch(info["ry"])
+
+    if timed_out:
+        thrusters.clear_weights()
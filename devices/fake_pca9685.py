@@ -0,0 +1,68 @@
+""" In-memory stand-in for Adafruit_PCA9685.PCA9685.
+Used to run the thruster code without the PiHat, e.g. by replay.py and loopback_bench.py.
+"""
+import numpy as np
+
+NUM_CHANNELS = 16
+LED0_ON_L = 0x06
+REGS_PER_CHANNEL = 4
+
+class FakeI2CDevice:
+    """ Register file behind the methods of Adafruit_GPIO.I2C.Device that BatchedPWM uses. """
+    def __init__(self, chip):
+        self.chip = chip
+        self.registers = bytearray(256)
+
+    def readU8(self, register):
+        return self.registers[register]
+
+    def write8(self, register, value):
+        self.registers[register] = value
+        self.chip.registers_written(register, 1)
+
+    def writeList(self, register, data):
+        self.registers[register:register + len(data)] = bytes(data)
+        self.chip.registers_written(register, len(data))
+
+class FakePCA9685:
+    """ Keeps the on/off tick of every channel instead of writing them over I2C.
+        With i2c set, it also emulates the register interface, so BatchedPWM's
+        block writes are exercised. on_write(chip) is called after every write.
+    """
+    def __init__(self, i2c=False):
+        self.freq = None
+        self.on = np.zeros(NUM_CHANNELS, int)
+        self.off = np.zeros(NUM_CHANNELS, int)
+        self.writes = 0
+        self.on_write = None
+        if i2c:
+            self._device = FakeI2CDevice(self)
+
+    def set_pwm_freq(self, freq_hz):
+        self.freq = freq_hz
+
+    def set_pwm(self, channel, on, off):
+        self.on[channel] = on
+        self.off[channel] = off
+        self.written()
+
+    def set_all_pwm(self, on, off):
+        self.on.fill(on)
+        self.off.fill(off)
+        self.written()
+
+    def registers_written(self, register, count):
+        """ Updates the channels covered by a register write. """
+        regs = self._device.registers
+        first = max(0, (register - LED0_ON_L) // REGS_PER_CHANNEL)
+        last = min(NUM_CHANNELS - 1, (register + count - 1 - LED0_ON_L) // REGS_PER_CHANNEL)
+        for channel in range(first, last + 1):
+            base = LED0_ON_L + REGS_PER_CHANNEL * channel
+            self.on[channel] = regs[base] | (regs[base + 1] << 8)
+            self.off[channel] = regs[base + 2] | (regs[base + 3] << 8)
+        self.written()
+
+    def written(self):
+        self.writes += 1
+        if self.on_write is not None:
+            self.on_write(self)
@@ -4,58 +4,249 @@
 
   See razor.ino for documentation.
   Binary output is little-endian.
+
+  IMU polls the firmware one sample at a time and blocks while waiting.
+  IMUStream switches the firmware to its continuous stream ("#c")
+  and parses frames as they arrive on the asyncio event loop.
+  Given an imu_calibration.Calibration, it asks for raw readings ("#r")
+  and calibrates each batch of frames here instead of in the firmware.
 """
-import serial
+import asyncio
+import collections
+import os
 import struct
 import time
 
+from asyncio_compat import coroutine
+
 SERIAL_DEV = '/dev/ttyUSB0'
 SERIAL_BAUD = 57600
 
-class IMU(serial.Serial):
+# Stream frame layout, see razor.ino
+STREAM_SYNC = b'\xa5\x5a'
+STREAM_HEADER = struct.Struct('<2sBBH') # sync, length, flags, counter
+STREAM_SAMPLE = struct.Struct('<ffffff') # acc, gyro
+STREAM_TEMPERATURE = struct.Struct('<f') # gyro temperature (C), after the sample in newer firmware
+FLAG_RAW = 0x01 # acc and gyro are raw readings
+STREAM_INTERVAL = 0.02 # secs between samples at the firmware's 50Hz
+COUNTER_MOD = 1 << 16
+HISTORY_LEN = 250 # samples kept by IMUStream, 5 seconds at 50Hz
+READ_SIZE = 4096
+WAKE_INTERVAL = 0.25 # secs between stream commands while the board boots
+
+Sample = collections.namedtuple('Sample', ['time', 'counter', 'accel', 'gyro', 'temperature'])
+Sample.__new__.__defaults__ = (float('nan'),)
+
+class IMU:
     def __init__(self, dev, rate):
-        serial.Serial.__init__(self, dev, rate)
+        import serial # Only where there is a port; the parsers work without pyserial
+        self.port = serial.Serial(dev, rate)
         time.sleep(2) # This should be more than 1 second.
 
         self.mode_bin()
-        self.flushInput() # Deprecated 
-        #self.reset_input_buffers() New version
+        self.port.flushInput() # Deprecated 
+        #self.port.reset_input_buffers() New version
+
+    def close(self):
+        self.port.close()
 
     def mode_bin(self):
         self.bin = True
 
-        self.write(b'#b')
-        self.flush()
+        self.port.write(b'#b')
+        self.port.flush()
 
     def mode_text(self):
         self.bin = False
 
-        self.write(b'#t')
-        self.flush()
+        self.port.write(b'#t')
+        self.port.flush()
 
     def get_sensors(self):
-        self.write(b'#s')
-        self.flush()
+        self.port.write(b'#s')
+        self.port.flush()
 
         if self.bin:
-            line = self.read(24)
+            line = self.port.read(24)
             unpacked = struct.unpack('<ffffff', line)
 
             return unpacked[0:3], unpacked[3:6]
         else:
-            return self.readline()
+            return self.port.readline()
 
     def get_angle(self):
-        self.write(b'#a')
-        self.flush()
+        self.port.write(b'#a')
+        self.port.flush()
 
         if self.bin:
-            line = self.read(12)
+            line = self.port.read(12)
             unpacked = struct.unpack('<fff', line)
 
             return unpacked
         else:
-            return self.readline()
+            return self.port.readline()
+
+class FrameParser:
+    """ Splits the continuous stream into frames.
+        Bad frames are skipped one byte at a time until the next sync header,
+        so the parser recovers from dropped or corrupted bytes.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0
+        self.errors = 0
+
+    def feed(self, data):
+        """ Adds received bytes. Returns a list of (flags, counter, values) for complete frames,
+            values being acc, gyro and temperature, which is nan from firmware that does not send it.
+        """
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+
+        while True:
+            start = buf.find(STREAM_SYNC)
+            if start < 0:
+                # Keep a last byte that could be the start of a split sync header
+                del buf[:max(0, len(buf) - 1)]
+                break
+            if start:
+                del buf[:start]
+
+            if len(buf) < STREAM_HEADER.size:
+                break
+            _, length, flags, counter = STREAM_HEADER.unpack_from(buf)
+            if length < STREAM_SAMPLE.size:
+                self.errors += 1
+                del buf[:1]
+                continue
+
+            end = STREAM_HEADER.size + length
+            if len(buf) < end + 1:
+                break
+            if sum(buf[2:end]) & 0xFF != buf[end]:
+                self.errors += 1
+                del buf[:1]
+                continue
+
+            values = STREAM_SAMPLE.unpack_from(buf, STREAM_HEADER.size)
+            if length >= STREAM_SAMPLE.size + STREAM_TEMPERATURE.size:
+                values += STREAM_TEMPERATURE.unpack_from(buf, STREAM_HEADER.size + STREAM_SAMPLE.size)
+            else:
+                values += (float('nan'),)
+            frames.append((flags, counter, values))
+            self.frames += 1
+            del buf[:end + 1]
+
+        return frames
+
+def stream_command(calibration=None):
+    """ Starts the binary stream, of raw readings when they are calibrated here. """
+    return b'#b#r#c' if calibration is not None else b'#b#f#c'
+
+class IMUStream:
+    """ Publishes the firmware's continuous stream on the asyncio event loop.
+        latest holds the newest Sample and history the last few, newest on the right.
+        Sample times are time.monotonic() values, backdated by the firmware interval
+        when several frames arrive in one read.
+        closed completes when the stream stops: with None after close(), or with the OSError
+        (EOFError on end of file) that stopped it, i.e. when the USB adapter was unplugged.
+        The port is closed by then; open a new stream to carry on.
+    """
+    def __init__(self, port, loop, history=HISTORY_LEN, calibration=None):
+        self.port = port
+        self.loop = loop
+        self.calibration = calibration
+        self.parser = FrameParser()
+        self.latest = None
+        self.history = collections.deque(maxlen=history)
+        self.dropped = 0
+        self.callbacks = []
+        self.closed = asyncio.Future(loop=loop)
+
+    @classmethod
+    @coroutine
+    def open(cls, dev, rate, loop=None, history=HISTORY_LEN, calibration=None):
+        """ Opens the port and returns once the first frame arrives.
+            The board resets when the port opens and ignores commands while it boots,
+            so the stream command is repeated every WAKE_INTERVAL instead of waiting out a fixed delay.
+        """
+        import serial
+        loop = loop or asyncio.get_event_loop()
+        port = serial.Serial(dev, rate, timeout=0)
+        self = cls(port, loop, history, calibration)
+        command = stream_command(calibration)
+        first = asyncio.Future(loop=loop)
+        started = lambda sample: first.done() or first.set_result(sample)
+        self.on_sample(started)
+        loop.add_reader(port.fileno(), self._read_ready)
+
+        try:
+            while not first.done():
+                port.write(command)
+                port.flush()
+                yield from asyncio.wait([first, self.closed], timeout=WAKE_INTERVAL,
+                                        return_when=asyncio.FIRST_COMPLETED)
+                if self.closed.done():
+                    raise self.closed.exception()
+        except BaseException:
+            if not self.closed.done():
+                loop.remove_reader(port.fileno())
+                port.close()
+            raise
+        self.callbacks.remove(started)
+        return self
+
+    def on_sample(self, callback):
+        """ Calls callback(sample) for every new sample. """
+        self.callbacks.append(callback)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self.port.fileno(), READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._lost(e)
+            return
+        if not data:
+            self._lost(EOFError("IMU port closed"))
+            return
+        self.data_received(data, time.monotonic())
+
+    def _lost(self, exc):
+        """ Stops reading a port that failed and reports why through closed. """
+        self.loop.remove_reader(self.port.fileno())
+        try:
+            self.port.close()
+        except OSError:
+            pass
+        self.closed.set_exception(exc)
+
+    def data_received(self, data, now):
+        frames = self.parser.feed(data)
+        if self.calibration is not None and frames:
+            frames = self.calibration.apply_frames(frames)
+        for i, (flags, counter, values) in enumerate(frames):
+            if self.latest is not None:
+                gap = (counter - self.latest.counter) % COUNTER_MOD
+                if gap > 1:
+                    self.dropped += gap - 1
+
+            stamp = now - (len(frames) - 1 - i) * STREAM_INTERVAL
+            sample = Sample(stamp, counter, values[0:3], values[3:6], values[6])
+            self.latest = sample
+            self.history.append(sample)
+            for cb in self.callbacks:
+                cb(sample)
+
+    def close(self):
+        if self.closed.done():
+            return
+        self.loop.remove_reader(self.port.fileno())
+        self.port.write(b'#p')
+        self.port.close()
+        self.closed.set_result(None)
 
 if __name__ == '__main__':
     """ Poll the imu at random intervals and output the values.
@@ -0,0 +1,149 @@
+""" IMU calibration: an affine transform from raw readings to calibrated ones.
+
+The firmware calibrates with per-axis offsets and scales hard-coded in razor.ino.
+With "#r" it streams raw ADXL345 and ITG-3200 counts and the gyro temperature instead,
+and a Calibration fitted by test_tools/calibrate_imu.py corrects them on this side:
+
+    accel = accel_matrix (raw accel - accel_bias)
+    gyro  = gyro_matrix (raw gyro - gyro_bias - gyro_drift (temperature - reference_temperature))
+
+Both are linear in (raw accel, raw gyro, temperature), so they fold into one 6x7
+matrix and an offset, applied to a whole batch of samples with one matrix product.
+The outputs are in the firmware's units: accel reads +GRAVITY on z when level and gyro is deg/s.
+
+The accelerometer fit is an ellipsoid through readings taken still in many orientations,
+which also corrects cross-axis scale. The gyro bias is a line in the temperature.
+"""
+import json
+import numpy as np
+
+from devices.imu import FLAG_RAW
+
+# Firmware conventions the calibrated output keeps, see sensors_fix in razor.ino
+GRAVITY = 256.0                         # accel reading of 1g
+ACCEL_AXES = np.diag([1.0, 1.0, -1.0])  # z is flipped
+GYRO_SCALE = -14.375                    # ITG-3200 counts per deg/s, sign included
+
+MIN_TEMPERATURE_SPAN = 2.0  # C, narrower than this and the gyro drift is left at zero
+STILL_RATE = 3.0            # deg/s, accel readings are used while the gyro turns slower than this
+
+class Calibration:
+    def __init__(self, accel_bias, accel_matrix, gyro_bias, gyro_drift=(0.0, 0.0, 0.0),
+                 reference_temperature=25.0, gyro_matrix=None, info=None):
+        self.accel_bias = np.array(accel_bias, float)
+        self.accel_matrix = np.array(accel_matrix, float)
+        self.gyro_bias = np.array(gyro_bias, float)
+        self.gyro_drift = np.array(gyro_drift, float)
+        self.reference_temperature = float(reference_temperature)
+        self.gyro_matrix = np.eye(3) / GYRO_SCALE if gyro_matrix is None else np.array(gyro_matrix, float)
+        self.info = info or {}  # Fit statistics, kept in the file
+        self.warned = False
+
+        # out = weights . (accel, gyro, temperature) + offset
+        self.weights = np.zeros((6, 7))
+        self.weights[0:3, 0:3] = self.accel_matrix
+        self.weights[3:6, 3:6] = self.gyro_matrix
+        self.weights[3:6, 6] = -self.gyro_matrix.dot(self.gyro_drift)
+        self.offset = np.concatenate((
+            -self.accel_matrix.dot(self.accel_bias),
+            -self.gyro_matrix.dot(self.gyro_bias - self.gyro_drift * self.reference_temperature)))
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({
+                "accel_bias": self.accel_bias.tolist(),
+                "accel_matrix": self.accel_matrix.tolist(),
+                "gyro_bias": self.gyro_bias.tolist(),
+                "gyro_drift": self.gyro_drift.tolist(),
+                "reference_temperature": self.reference_temperature,
+                "gyro_matrix": self.gyro_matrix.tolist(),
+                "info": self.info,
+            }, f, indent=2)
+
+    def apply(self, raw, out=None):
+        """ Calibrates raw (..., 7): accel, gyro, temperature. Returns (..., 6): accel, gyro. """
+        raw = np.asarray(raw, float)
+        if out is None:
+            out = np.empty(raw.shape[:-1] + (6,))
+        np.dot(raw, self.weights.T, out=out)
+        out += self.offset
+        return out
+
+    def apply_frames(self, frames):
+        """ Calibrates the raw frames of a FrameParser.feed batch in one transform.
+            Their values become arrays of accel, gyro, temperature; other frames pass through.
+        """
+        raw = [i for i, (flags, _, _) in enumerate(frames) if flags & FLAG_RAW]
+        if len(raw) < len(frames) and not self.warned:
+            self.warned = True
+            print("IMU sends calibrated frames; its firmware may not know \"#r\". Using them as they are")
+        if not raw:
+            return frames
+
+        values = np.array([frames[i][2] for i in raw])
+        calibrated = np.empty(values.shape)
+        calibrated[:, 0:6] = self.apply(values)
+        calibrated[:, 6] = values[:, 6]
+        frames = list(frames)
+        for i, row in zip(raw, calibrated):
+            flags, counter, _ = frames[i]
+            frames[i] = (flags & ~FLAG_RAW, counter, row)
+        return frames
+
+def fit_ellipsoid(points):
+    """ Least squares ellipsoid through points (n, 3).
+        Returns (center, matrix) so that |matrix (point - center)| is 1 on it.
+    """
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    design = np.column_stack((x * x, y * y, z * z, 2 * y * z, 2 * x * z, 2 * x * y, 2 * x, 2 * y, 2 * z))
+    a, b, c, f, g, h, p, q, r = np.linalg.lstsq(design, np.ones(len(points)), rcond=-1)[0]
+
+    # x'Qx + 2u'x = 1  is  (x - center)'Q(x - center) = 1 + center'Q center
+    quadric = np.array([[a, h, g], [h, b, f], [g, f, c]])
+    center = -np.linalg.solve(quadric, [p, q, r])
+    quadric /= 1.0 + center.dot(quadric).dot(center)
+
+    values, vectors = np.linalg.eigh(quadric)
+    if values.min() <= 0:
+        raise ValueError("Readings do not outline an ellipsoid; turn the IMU through more orientations")
+    return center, (vectors * np.sqrt(values)).dot(vectors.T)
+
+def fit_gyro(gyro, temperature):
+    """ Gyro bias (raw counts) as a line in the temperature, from readings (n, 3) taken still.
+        Returns (bias at the reference, drift per C, reference temperature).
+    """
+    reference = float(np.mean(temperature))
+    if np.ptp(temperature) < MIN_TEMPERATURE_SPAN:
+        return gyro.mean(axis=0), np.zeros(3), reference
+    design = np.column_stack((np.ones(len(gyro)), temperature - reference))
+    (bias, drift) = np.linalg.lstsq(design, gyro, rcond=-1)[0]
+    return bias, drift, reference
+
+def fit(still, tumble):
+    """ Calibration from raw readings (n, 7) of two recordings: one held still, for the gyro,
+        and one turned slowly through many orientations, for the accelerometer.
+    """
+    gyro_bias, gyro_drift, reference = fit_gyro(still[:, 3:6], still[:, 6])
+    calibration = Calibration(np.zeros(3), np.eye(3), gyro_bias, gyro_drift, reference)
+
+    # Accel readings only count while the IMU is nearly still, so they measure gravity alone
+    rates = calibration.apply(tumble)[:, 3:6]
+    points = tumble[np.sqrt((rates ** 2).sum(axis=1)) < STILL_RATE, 0:3]
+    center, matrix = fit_ellipsoid(points)
+
+    calibration = Calibration(center, GRAVITY * ACCEL_AXES.dot(matrix), gyro_bias, gyro_drift, reference)
+    still_out = calibration.apply(still)
+    norms = np.sqrt((((points - center).dot(matrix.T)) ** 2).sum(axis=1))
+    calibration.info = {
+        "still_samples": len(still),
+        "accel_points": len(points),
+        "temperature_range": [float(still[:, 6].min()), float(still[:, 6].max())],
+        "gravity_error": float(np.std(norms - 1.0)),  # fraction of 1g
+        "gyro_noise": np.std(still_out[:, 3:6], axis=0).tolist(),  # deg/s
+    }
+    return calibration
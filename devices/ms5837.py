@@ -1,11 +1,20 @@
-""" Code from https://github.com/bluerobotics/ms5837-python """
+""" Code from https://github.com/bluerobotics/ms5837-python
+
+read() sleeps through both ADC conversions. read_async() and Sampler
+wait on the asyncio event loop instead, so other tasks keep running.
+"""
 try:
     import smbus
 except:
     print('Try sudo apt-get install python-smbus')
 
+import asyncio
+import collections
+import time
 from time import sleep
 
+from asyncio_compat import coroutine, ensure_future
+
 # Models
 MODEL_02BA = 0
 MODEL_30BA = 1
@@ -37,6 +46,14 @@ UNITS_Centigrade = 1
 UNITS_Farenheit  = 2
 UNITS_Kelvin     = 3
 
+# Sampler defaults
+SAMPLE_RATE = 5 # Hz
+INIT_RETRY_DELAY = 0.5 # secs before retrying a failed init, doubled after every failure in a row
+INIT_RETRY_MAX = 30.0  # secs, cap on the retry delay
+
+# time is time.monotonic() when the reading completed
+Reading = collections.namedtuple('Reading', ['time', 'pressure', 'temperature', 'depth'])
+
 
 class MS5837(object):
 
@@ -50,13 +67,8 @@ class MS5837(object):
 
     def __init__(self, model=MODEL_30BA, bus=1):
         self._model = model
-
-        try:
-            self._bus = smbus.SMBus(bus)
-        except:
-            print("Bus %d is not available.") % bus
-            print("Available busses are listed as /dev/i2c*")
-            self._bus = None
+        self._bus_id = bus
+        self._bus = self._open_bus()
 
         self._fluidDensity = DENSITY_FRESHWATER
         self._pressure = 0
@@ -64,9 +76,20 @@ class MS5837(object):
         self._D1 = 0
         self._D2 = 0
 
+    def _open_bus(self):
+        try:
+            # A bus number, or an object with the SMBus methods (e.g. a stand-in for testing)
+            return smbus.SMBus(self._bus_id) if isinstance(self._bus_id, int) else self._bus_id
+        except:
+            print("Bus {} is not available.".format(self._bus_id))
+            print("Available busses are listed as /dev/i2c*")
+            return None
+
     def init(self):
         if self._bus is None:
-            "No bus!"
+            self._bus = self._open_bus() # It may not have been up yet
+        if self._bus is None:
+            print("No bus!")
             return False
 
         self._bus.write_byte(self._MS5837_ADDR, self._MS5837_RESET)
@@ -74,6 +97,23 @@ class MS5837(object):
         # Wait for reset to complete
         sleep(0.01)
 
+        return self._read_prom()
+
+    @coroutine
+    def init_async(self):
+        """ Same as init() but waits for the reset without blocking. """
+        if self._bus is None:
+            self._bus = self._open_bus()
+        if self._bus is None:
+            print("No bus!")
+            return False
+
+        self._bus.write_byte(self._MS5837_ADDR, self._MS5837_RESET)
+        yield from asyncio.sleep(0.01)
+
+        return self._read_prom()
+
+    def _read_prom(self):
         self._C = []
 
         # Read calibration values and CRC
@@ -90,12 +130,7 @@ class MS5837(object):
         return True
 
     def read(self, oversampling=OSR_8192):
-        if self._bus is None:
-            print("No bus!")
-            return False
-
-        if oversampling < OSR_256 or oversampling > OSR_8192:
-            print("Invalid oversampling option!")
+        if not self._check_read(oversampling):
             return False
 
         # Request D1 conversion (temperature)
@@ -104,19 +139,17 @@ class MS5837(object):
         # Maximum conversion time increases linearly with oversampling
         # max time (seconds) ~= 2.2e-6(x) where x = OSR = (2^8, 2^9, ..., 2^13)
         # We use 2.5e-6 for some overhead
-        sleep(2.5e-6 * 2**(8+oversampling))
+        sleep(self._conversion_time(oversampling))
 
-        d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
-        self._D1 = d[0] << 16 | d[1] << 8 | d[2]
+        self._D1 = self._read_adc()
 
         # Request D2 conversion (pressure)
         self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D2_256 + 2*oversampling)
 
         # As above
-        sleep(2.5e-6 * 2**(8+oversampling))
+        sleep(self._conversion_time(oversampling))
 
-        d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
-        self._D2 = d[0] << 16 | d[1] << 8 | d[2]
+        self._D2 = self._read_adc()
 
         # Calculate compensated pressure and temperature
         # using raw ADC values and internal calibration
@@ -124,6 +157,42 @@ class MS5837(object):
 
         return True
 
+    @coroutine
+    def read_async(self, oversampling=OSR_8192):
+        """ Same as read() but waits for the conversions without blocking. """
+        if not self._check_read(oversampling):
+            return False
+
+        self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D1_256 + 2*oversampling)
+        yield from asyncio.sleep(self._conversion_time(oversampling))
+        self._D1 = self._read_adc()
+
+        self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D2_256 + 2*oversampling)
+        yield from asyncio.sleep(self._conversion_time(oversampling))
+        self._D2 = self._read_adc()
+
+        self._calculate()
+
+        return True
+
+    def _check_read(self, oversampling):
+        if self._bus is None:
+            print("No bus!")
+            return False
+
+        if oversampling < OSR_256 or oversampling > OSR_8192:
+            print("Invalid oversampling option!")
+            return False
+
+        return True
+
+    def _conversion_time(self, oversampling):
+        return 2.5e-6 * 2**(8+oversampling)
+
+    def _read_adc(self):
+        d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
+        return d[0] << 16 | d[1] << 8 | d[2]
+
     def setFluidDensity(self, density):
         self._fluidDensity = density
 
@@ -232,3 +301,81 @@ class MS5837_02BA(MS5837):
     def __init__(self, bus=1):
         MS5837.__init__(self, MODEL_02BA, bus)
 
+class Sampler:
+    """ Reads the sensor in the background at a fixed rate.
+        Consumers use latest, a Reading with pressure in mbar,
+        temperature in degrees C and depth in m, instead of touching the bus.
+    """
+    def __init__(self, sensor, rate=SAMPLE_RATE, oversampling=OSR_8192):
+        self.sensor = sensor
+        self.rate = rate
+        self.oversampling = oversampling
+        self.latest = None
+        self.errors = 0
+        self.init_failures = 0
+        self.callback_errors = 0
+        self.task = None
+        self.callbacks = []
+        self.ticker = None  # A scheduler.Ticker paces the readings instead of rate, when set
+
+    def on_reading(self, callback):
+        """ Calls callback(reading) for every new reading. """
+        self.callbacks.append(callback)
+
+    def start(self, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        self.task = ensure_future(self.run(), loop=loop)
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    @coroutine
+    def init(self):
+        """ Initializes the sensor, retrying with a growing delay until it answers. """
+        delay = INIT_RETRY_DELAY
+        while True:
+            try:
+                if (yield from self.sensor.init_async()):
+                    return
+                error = "no answer"
+            except OSError as e:
+                error = e
+            self.init_failures += 1
+            print("Sensor failed to initialize ({}), retrying in {}s".format(error, delay))
+            yield from asyncio.sleep(delay)
+            delay = min(INIT_RETRY_MAX, delay * 2)
+
+    @coroutine
+    def run(self):
+        yield from self.init()
+
+        while True:
+            if self.ticker is not None:
+                yield from self.ticker.wait()
+            start = time.monotonic()
+            try:
+                ok = yield from self.sensor.read_async(self.oversampling)
+            except OSError:
+                ok = False
+
+            if ok:
+                self.latest = Reading(time.monotonic(),
+                                      self.sensor.pressure(UNITS_mbar),
+                                      self.sensor.temperature(UNITS_Centigrade),
+                                      self.sensor.depth())
+                for cb in self.callbacks:
+                    try:
+                        cb(self.latest)
+                    except Exception as e:
+                        # One failing consumer must not stop the readings for the rest
+                        self.callback_errors += 1
+                        print("Pressure reading callback failed: {!r}".format(e))
+            else:
+                self.errors += 1
+
+            if self.ticker is None:
+                elapsed = time.monotonic() - start
+                yield from asyncio.sleep(max(0.0, 1.0 / self.rate - elapsed))
@@ -0,0 +1,129 @@
+""" Batched register writes for the PCA9685 on the PiHat.
+
+Adafruit_PCA9685.set_pwm writes the four LEDn registers of a channel one I2C
+transaction at a time. With the MODE1 auto-increment bit set, the chip accepts
+consecutive registers in one block transfer, so a run of neighbouring channels
+can be updated at once. Channels whose value has not changed are skipped.
+
+I2C byte counts include the address and register bytes of each transaction.
+"""
+import time
+
+MODE1 = 0x00
+AUTO_INCREMENT = 0x20
+LED0_ON_L = 0x06
+REGS_PER_CHANNEL = 4
+BLOCK_MAX = 32  # SMBus limit on bytes per block transfer
+CHANNELS_PER_BLOCK = BLOCK_MAX // REGS_PER_CHANNEL
+
+class BatchedPWM:
+    """ Wraps an Adafruit_PCA9685.PCA9685 and remembers the last value written to each channel.
+        Objects without the underlying I2C device (i.e. stand-ins for testing)
+        fall back to one set_pwm call per changed channel.
+    """
+    def __init__(self, pwm):
+        self.pwm = pwm
+        self.device = getattr(pwm, '_device', None)
+        if self.device is not None:
+            mode1 = self.device.readU8(MODE1)
+            self.device.write8(MODE1, mode1 | AUTO_INCREMENT)
+
+        self.cache = {}
+        self.pending = []
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.ticks = 0
+        self.bytes_written = 0
+        self.transactions = 0
+        self.skipped = 0
+        self.errors = 0
+        self.write_time = 0.0
+        self.tick_bytes = 0
+        self.tick_transactions = 0
+        self.tick_time = 0.0
+
+    def set_pwm(self, channel, on, off):
+        """ Unbatched write that keeps the cache coherent. """
+        self.pwm.set_pwm(channel, on, off)
+        self.cache[channel] = off if on == 0 else None
+        self.bytes_written += 3 * REGS_PER_CHANNEL
+        self.transactions += REGS_PER_CHANNEL
+
+    def write(self, channels, values, force=False):
+        """ Sets each channel to turn on at 0 and off at its value.
+            Only channels that changed since the last write are sent, unless force is set.
+            If the transfer fails (OSError 121 is routine on a shared bus) the channels
+            are forgotten, so the next write sends them again, and the error is raised.
+        """
+        start = time.perf_counter()
+        pending = self.pending
+        del pending[:]
+
+        for channel, value in zip(channels, values):
+            value = int(value)
+            if not force and self.cache.get(channel) == value:
+                self.skipped += 1
+                continue
+            pending.append((channel, value))
+            self.cache[channel] = value
+
+        try:
+            count, size = self.send(pending)
+        except Exception:
+            for channel, _ in pending:
+                self.cache.pop(channel, None)
+            self.errors += 1
+            raise
+
+        elapsed = time.perf_counter() - start
+        self.ticks += 1
+        self.tick_bytes = size
+        self.tick_transactions = count
+        self.tick_time = elapsed
+        self.bytes_written += size
+        self.transactions += count
+        self.write_time += elapsed
+
+    def send(self, pending):
+        """ Writes (channel, value) pairs. Returns (transactions, bytes). """
+        count = 0
+        if self.device is None:
+            for channel, value in pending:
+                self.pwm.set_pwm(channel, 0, value)
+            count = len(pending) * REGS_PER_CHANNEL
+            size = 3 * count
+        else:
+            pending.sort()
+            size = 0
+            i = 0
+            while i < len(pending):
+                # Collect a run of consecutive channels that fits in one block
+                first = pending[i][0]
+                block = []
+                n = 0
+                while (i + n < len(pending) and n < CHANNELS_PER_BLOCK
+                       and pending[i + n][0] == first + n):
+                    value = pending[i + n][1]
+                    block.extend((0, 0, value & 0xFF, value >> 8))
+                    n += 1
+
+                # writeList hands the block to smbus, which wants a list of ints
+                self.device.writeList(LED0_ON_L + REGS_PER_CHANNEL * first, block)
+                count += 1
+                size += 2 + len(block)
+                i += n
+        return count, size
+
+    def summary(self):
+        return {
+            "ticks": self.ticks,
+            "bytes": self.bytes_written,
+            "transactions": self.transactions,
+            "skipped_channels": self.skipped,
+            "errors": self.errors,
+            "write_time": self.write_time,
+            "tick_bytes": self.tick_bytes,
+            "tick_transactions": self.tick_transactions,
+            "tick_time": self.tick_time,
+        }
@@ -13,12 +13,16 @@ Once this is done, the drive() function will send signals to the thrusters.
 
 """
 
+import json
 import time
 import numpy as np
 
+from devices.pca9685 import BatchedPWM
+from devices.t100_curve import ThrustTable
+
 THRUSTER_PINS = [2, 3, 4, 5, 8, 9, 10, 13]
 NUM_THRUSTERS = len(THRUSTER_PINS)
-MAX_POWER = 40
+MAX_POWER = 40 # ticks from SERVO_CENTER; full output is the thrust the weakest thruster makes here
 PWM_FREQ = 48
 
 # Pulse length of PWM. Add and subtract to this for speeds.
@@ -38,99 +42,145 @@ WEIGHTS_ROLL       = np.array([0.0, 0.0, 1.0, -1.0, 0.0, 0.0, -1.0, 1.0], float)
 
 #WEIGHT_MIN = 0.05
 
+# Order of the degrees of freedom in a command vector and in the rows of the allocation matrix
+DOF = ("forward", "horizontal", "vertical", "pitch", "yaw", "roll")
+FORWARD, HORIZONTAL, VERTICAL, PITCH, YAW, ROLL = range(len(DOF))
+
+DEFAULT_LAYOUT = {
+    "pins": THRUSTER_PINS,
+    "bias": WEIGHTS_BIAS,
+    "forward": WEIGHTS_FORWARD,
+    "horizontal": WEIGHTS_HORIZONTAL,
+    "vertical": WEIGHTS_VERTICAL,
+    "pitch": WEIGHTS_PITCH,
+    "yaw": WEIGHTS_YAW,
+    "roll": WEIGHTS_ROLL,
+}
+
+def load_layout(path):
+    """ Reads a thruster layout from a JSON file.
+        The file holds any of the keys of DEFAULT_LAYOUT, e.g.
+        {"pins": [...], "bias": [...], "forward": [...], ...}
+        Missing keys keep their default.
+    """
+    with open(path) as f:
+        return json.load(f)
+
+def allocation_matrix(layout):
+    """ Builds the DOF x thruster allocation matrix with the bias folded in. """
+    weights = np.array([layout[dof] for dof in DOF], float)
+    return weights * np.array(layout["bias"], float)
+
 
 class Thrusters:
-    def __init__(self, pwm):
+    def __init__(self, pwm, layout=None, calibration=None, freq=PWM_FREQ):
+        """ calibration is per-unit thrust data, see t100_curve.load_calibration,
+            and freq the PWM frequency asked of the PCA9685.
+        """
         self.pwm = pwm
+        self.writer = BatchedPWM(pwm)
+
+        layout = dict(DEFAULT_LAYOUT, **(layout or {}))
+        self.pins = list(layout["pins"])
+        self.matrix = allocation_matrix(layout)
+        if self.matrix.shape != (len(DOF), len(self.pins)):
+            raise ValueError("Thruster layout needs {} weights per direction".format(len(self.pins)))
+
+        # Thrust to PWM, built once for the pins and frequency in use
+        self.curve = ThrustTable(self.pins, freq, SERVO_CENTER, MAX_POWER, calibration)
 
         # Initialize thrusters. Unsure if this is necessary
-        for i in range(0, NUM_THRUSTERS):
-            self.pwm.set_pwm(THRUSTER_PINS[i], 0, SERVO_CENTER)
+        self.writer.write(self.pins, [SERVO_CENTER] * len(self.pins), force=True)
 
-        # This is the resulting weight from all vectors
-        self.weights_forward    = np.zeros(NUM_THRUSTERS)
-        self.weights_horizontal = np.zeros(NUM_THRUSTERS)
-        self.weights_vertical   = np.zeros(NUM_THRUSTERS)
-        self.weights_pitch      = np.zeros(NUM_THRUSTERS)
-        self.weights_yaw        = np.zeros(NUM_THRUSTERS)
-        self.weights_roll       = np.zeros(NUM_THRUSTERS)
+        # Requested movement along each DOF, and buffers reused by every drive()
+        self.command = np.zeros(len(DOF))
+        self.outputs = np.zeros(len(self.pins))
+        self.scaled = np.zeros(len(self.pins))
+        self.signals = np.zeros(len(self.pins), int)
 
     def move_forward(self, scalar):
         """ Scale weights to move forward. percent should range from -1 to 1"""
-        self.weights_forward = scalar * WEIGHTS_FORWARD
+        self.command[FORWARD] = scalar
 
     def move_horizontal(self, scalar):
         """ Scale weights to move horizontally. Scalar should range from -1 to 1."""
-        self.weights_horizontal = scalar * WEIGHTS_HORIZONTAL
+        self.command[HORIZONTAL] = scalar
 
     # Positive is up.
     def move_vertical(self, scalar):
         """ Scale weights to move vertical. Scalar should range from -1 to 1."""
-        self.weights_vertical = scalar * WEIGHTS_VERTICAL
+        self.command[VERTICAL] = scalar
 
     def move_pitch(self, scalar):
         """ Scale weights to move pitch. Scalar should range from -1 to 1."""
-        self.weights_pitch = scalar * WEIGHTS_PITCH
+        self.command[PITCH] = scalar
 
     def move_yaw(self, scalar):
         """ Scale weights to move yaw. Scalar should range from -1 to 1."""
-        self.weights_yaw = scalar * WEIGHTS_YAW
+        self.command[YAW] = scalar
 
     def move_roll(self, scalar):
         """ Scale weights to move roll. Scalar should range from -1 to 1."""
-        self.weights_roll = scalar * WEIGHTS_ROLL
+        self.command[ROLL] = scalar
 
     def clear_weights(self):
-        self.weights_forward    = np.zeros(NUM_THRUSTERS)
-        self.weights_horizontal = np.zeros(NUM_THRUSTERS)
-        self.weights_vertical   = np.zeros(NUM_THRUSTERS)
-        self.weights_pitch      = np.zeros(NUM_THRUSTERS)
-        self.weights_yaw        = np.zeros(NUM_THRUSTERS)
-        self.weights_roll       = np.zeros(NUM_THRUSTERS)
+        self.command.fill(0.0)
 
     def stop(self):
-        for i in range(0, NUM_THRUSTERS):
-            self.pwm.set_pwm(THRUSTER_PINS[i], 0, SERVO_CENTER)
-
-    def drive(self):
-        """ Send PWM signal to thrusters.
-            Sum the weight vectors of each direction of interest to get weights for the resulting vector.
-            Returns the weight to each thrusters
+        self.writer.write(self.pins, [SERVO_CENTER] * len(self.pins), force=True)
 
+    def allocate(self, command):
+        """ Maps a 6-DOF command vector to thruster outputs in the range -1 to 1.
+            If any thruster saturates, all outputs are scaled down together
+            so the resulting vector keeps its direction.
+            Returns self.outputs, which is overwritten by the next call.
         """
-        weights_sum = self.weights_forward + self.weights_horizontal + self.weights_vertical + self.weights_pitch + self.weights_yaw + self.weights_roll
-        #for i in range(0, NUM_THRUSTERS):
-            #if weights_sum[i] < WEIGHT_MIN:
-                #weights_sum[i] = 0
+        np.dot(command, self.matrix, out=self.outputs)
+
+        peak = max(self.outputs.max(), -self.outputs.min())
+        if peak > 1.0:
+            self.outputs /= peak
 
-        #print("Thruster weights: {}".format(weights_sum))
+        return self.outputs
 
-        # Sign mod
-        weights_sum *= WEIGHTS_BIAS
+    def drive_command(self, command):
+        """ Sets all six DOF at once (see DOF for the order) and drives. """
+        self.command[:] = command
+        return self.drive()
 
-        # Normalize the sum so the next step doesn't generate PWM signals beyond our desired range.
-        max_weight = weights_sum.max()
-        if max_weight > 1.0:
-            weights_sum /= max_weight
+    def drive(self):
+        """ Send PWM signal to thrusters.
+            Maps the current command through the allocation matrix.
+            Returns the weight to each thrusters in PWM ticks from SERVO_CENTER.
+        """
+        self.mix()
+        self.write()
+        return self.scaled
 
-        weights_sum *= MAX_POWER
+    def mix(self):
+        """ First half of drive(): computes the signals without sending them. """
+        self.allocate(self.command)
 
-        for i in range(0, NUM_THRUSTERS):
-            signal = int(SERVO_CENTER + weights_sum[i])
+        #print("Thruster weights: {}".format(self.outputs))
 
-            #print("Thruster %d gets %d" % (i, signal))
-            self.pwm.set_pwm(THRUSTER_PINS[i], 0, signal)
+        # Outputs are thrusts; the T100's curve turns them into pulse widths
+        self.curve.lookup(self.outputs, self.signals)
+        np.subtract(self.signals, SERVO_CENTER, out=self.scaled)
+        return self.signals
 
-        return weights_sum
+    def write(self):
+        """ Second half of drive(): sends the signals from the last mix(). """
+        # Only thrusters whose signal changed are sent, in as few I2C transfers as possible
+        self.writer.write(self.pins, self.signals)
 
     def set_pwm(self, pin, channel, value):
         """ Send PWM signal directly to thrusters. Used for debugging. """
-        self.pwm.set_pwm(pin, channel, value)
+        self.writer.set_pwm(pin, channel, value)
 
-import signal
-import sys
-import Adafruit_PCA9685
 if __name__ == '__main__':
+    # Only needed on the Pi, so the rest of the module also works offline (see replay.py)
+    import Adafruit_PCA9685
+
     pwm = Adafruit_PCA9685.PCA9685()
     pwm.set_pwm_freq(PWM_FREQ) # 50 Hz is good for servo
     thrust = Thrusters(pwm)
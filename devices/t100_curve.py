@@ -0,0 +1,135 @@
+""" Thrust curve of the Blue Robotics T100 and lookup tables from thrust to PCA9685 ticks.
+
+The T100 is not linear in its pulse width: it has a deadband of about +-25us around 1500us,
+pushes about a quarter harder forward than in reverse, and its thrust grows faster
+than the pulse width. A ThrustTable inverts the curve of each thruster once, on a
+grid of normalized thrusts, so mapping the outputs of all thrusters to register
+values is one vectorized interpolation.
+
+Normalized thrust 1.0 is max_thrust kgf, the same for every thruster so the
+allocation matrix stays balanced. By default it is what the weakest thruster makes
+at MAX_POWER ticks from the center, i.e. the limit the linear mapping used to have.
+
+Per-unit calibration is a JSON file keyed by pin, each entry either a measured curve
+or a scale on the published one:
+    {"2": {"pwm_us": [1100, ..., 1900], "thrust": [-1.8, ..., 2.3]},
+     "9": {"scale": 0.9}}
+"""
+import json
+import math
+import numpy as np
+
+# Published 12V curve, pulse width (us) against thrust (kgf), read off Blue Robotics' T100 chart
+CURVE_US = np.array([1100, 1150, 1200, 1250, 1300, 1350, 1400, 1450, 1475,
+                     1525, 1550, 1600, 1650, 1700, 1750, 1800, 1850, 1900], float)
+CURVE_THRUST = np.array([-1.85, -1.63, -1.36, -1.09, -0.83, -0.56, -0.32, -0.12, 0.0,
+                         0.0, 0.15, 0.43, 0.76, 1.11, 1.47, 1.82, 2.12, 2.36])
+NEUTRAL_US = 1500.0
+
+# The PCA9685 divides its oscillator down to the requested frequency. Adafruit_PCA9685 picks the
+# divider assuming the nominal 25MHz, but these chips run near 26MHz, so asking for 48Hz gives ~50Hz.
+# That is why SERVO_CENTER 307 is 1500us.
+NOMINAL_OSCILLATOR = 25e6
+OSCILLATOR_HZ = 26e6
+TICKS = 4096
+TABLE_SIZE = 257 # Grid points from -1 to 1
+
+def update_rate(freq):
+    """ Real PWM frequency (Hz) when freq is requested from Adafruit_PCA9685. """
+    prescale = math.floor(NOMINAL_OSCILLATOR / TICKS / freq - 1 + 0.5)
+    return OSCILLATOR_HZ / (TICKS * (prescale + 1))
+
+def us_to_ticks(us, freq):
+    return np.asarray(us, float) * 1e-6 * update_rate(freq) * TICKS
+
+def ticks_to_us(ticks, freq):
+    return np.asarray(ticks, float) / (update_rate(freq) * TICKS) * 1e6
+
+def load_calibration(path):
+    """ Reads per-unit calibration, see the module docstring. Returns {pin: entry}. """
+    with open(path) as f:
+        return dict((int(pin), entry) for pin, entry in json.load(f).items())
+
+def thruster_curve(entry=None):
+    """ (pulse widths, thrusts) of one thruster, from its calibration entry or the published curve. """
+    if entry and "pwm_us" in entry:
+        us, thrust = np.array(entry["pwm_us"], float), np.array(entry["thrust"], float)
+        order = np.argsort(us)
+        return us[order], thrust[order]
+    return CURVE_US, CURVE_THRUST * (entry or {}).get("scale", 1.0)
+
+def inverse_curve(us, thrust, targets):
+    """ Pulse widths that make each target thrust, for a curve rising with the pulse width.
+        Zero thrust is NEUTRAL_US; any other thrust skips the deadband
+        and lands on the side of the curve that makes it.
+    """
+    targets = np.asarray(targets, float)
+    result = np.full(targets.shape, NEUTRAL_US)
+    forward, reverse = thrust > 0, thrust < 0
+
+    # Edges of the deadband: the pulse widths nearest neutral that still make no thrust
+    idle_fwd, idle_rev = us[thrust <= 0], us[thrust >= 0]
+    edge_fwd = idle_fwd.max() if len(idle_fwd) else us[forward].min()
+    edge_rev = idle_rev.min() if len(idle_rev) else us[reverse].max()
+
+    up = targets > 0
+    result[up] = np.interp(targets[up], np.concatenate(([0.0], thrust[forward])),
+                           np.concatenate(([edge_fwd], us[forward])))
+    down = targets < 0
+    result[down] = np.interp(targets[down], np.concatenate((thrust[reverse], [0.0])),
+                             np.concatenate((us[reverse], [edge_rev])))
+    return result
+
+class ThrustTable:
+    """ Per-thruster tables from normalized thrust (-1 to 1) to PWM ticks.
+        calibration is {pin: entry} for the units that have one.
+    """
+    def __init__(self, pins, freq, center, max_power, calibration=None, max_thrust=None, size=TABLE_SIZE):
+        calibration = calibration or {}
+        curves = [thruster_curve(calibration.get(pin)) for pin in pins]
+
+        if max_thrust is None:
+            # The linear mapping's limit: center +- max_power ticks
+            low, high = ticks_to_us([center - max_power, center + max_power], freq)
+            max_thrust = min(min(-np.interp(low, us, thrust), np.interp(high, us, thrust))
+                             for us, thrust in curves)
+        self.max_thrust = max_thrust
+        self.freq = freq
+
+        self.grid = np.linspace(-1.0, 1.0, size)
+        self.table = np.empty((len(pins), size))
+        for row, (us, thrust) in zip(self.table, curves):
+            row[:] = us_to_ticks(inverse_curve(us, thrust, self.grid * max_thrust), freq)
+        # Flattened start and slope of every grid interval, so a lookup is two np.take calls
+        steps = size - 1
+        self.base = self.table[:, :-1].ravel()
+        self.slope = np.diff(self.table, axis=1).ravel()
+        self.scale = steps / 2.0
+        self.last = steps - 1
+
+        # Buffers reused by every lookup
+        self.offsets = np.arange(len(pins)) * steps
+        self.position = np.empty(len(pins))
+        self.floor = np.empty(len(pins))
+        self.index = np.empty(len(pins), int)
+        self.ticks = np.empty(len(pins))
+        self.step = np.empty(len(pins))
+
+    def lookup(self, outputs, out):
+        """ Writes the rounded PWM ticks for normalized thrusts outputs into out. """
+        position = self.position
+        np.clip(outputs, -1.0, 1.0, out=position)
+        position += 1.0
+        position *= self.scale
+        np.floor(position, out=self.floor)
+        np.minimum(self.floor, self.last, out=self.floor)
+        position -= self.floor          # Now the fraction into the interval
+        np.add(self.offsets, self.floor, out=self.index, casting='unsafe')
+
+        np.take(self.slope, self.index, out=self.step)
+        np.take(self.base, self.index, out=self.ticks)
+        self.step *= position
+        self.ticks += self.step
+        np.rint(self.ticks, out=self.ticks)
+        out[:] = self.ticks
+        return out
@@ -1,8 +1,17 @@
 """ Controller support using asyncio.
-Handlers for digital buttons occur twice per button press.
-Analog signals are called whenever events occur.
+Two backends produce the same ControllerState records:
+    xboxdrv: spawns xboxdrv and decodes each output line in one pass.
+    evdev: reads binary input_event structs from /dev/input/event* directly.
+Reads drain everything buffered and only the newest state is dispatched:
+    Digital button handlers are called once per press.
+    Analog handlers are called whenever their value changes.
 """
 import asyncio
+import collections
+import fcntl
+import glob
+import re
+import struct
 from enum import Enum
 
 class Button(Enum):
@@ -15,27 +24,99 @@ class Button(Enum):
     Start = 17
     Guide = 18   # This is the Xbox button on the Xbox controller
 
+# Raw axis values and a bitfield of pressed buttons, bit n is Button(n)
+ControllerState = collections.namedtuple('ControllerState', ['lx', 'ly', 'rx', 'ry', 'lt', 'rt', 'buttons'])
+NEUTRAL = ControllerState(0, 0, 0, 0, 0, 0, 0)
+
+# xboxdrv prints "X1: -123 Y1: 456 ... du:0 dd:0 ... LT: 0 RT: 0". Every field is "name:value".
+FIELD = re.compile(rb':\s*(-?\d+)')
+NUM_FIELDS = 21
+# Digital fields in the order xboxdrv prints them, between the sticks and the triggers
+DIGITAL_BUTTONS = (Button.DpadU, Button.DpadD, Button.DpadL, Button.DpadR,
+                   Button.Back, Button.Guide, Button.Start,
+                   Button.L3, Button.R3,
+                   Button.A, Button.B, Button.X, Button.Y,
+                   Button.LB, Button.RB)
+STICK_MAX = 32768.0
+TRIGGER_MAX = 255.0
+READ_SIZE = 65536
+
+# linux/input.h. input_event starts with a struct timeval, so its size depends on the platform.
+INPUT_EVENT = struct.Struct('llHHi')
+ABSINFO = struct.Struct('6i') # value, minimum, maximum, fuzz, flat, resolution
+EV_SYN, EV_KEY, EV_ABS = 0x00, 0x01, 0x03
+SYN_REPORT = 0
+ABS_X, ABS_Y, ABS_Z, ABS_RX, ABS_RY, ABS_RZ = 0x00, 0x01, 0x02, 0x03, 0x04, 0x05
+ABS_HAT0X, ABS_HAT0Y = 0x10, 0x11
+EVDEV_BUTTONS = {
+    0x130: Button.A, 0x131: Button.B, 0x133: Button.X, 0x134: Button.Y,
+    0x136: Button.LB, 0x137: Button.RB,
+    0x13a: Button.Back, 0x13b: Button.Start, 0x13c: Button.Guide,
+    0x13d: Button.L3, 0x13e: Button.R3,
+}
+# The kernel reports stick Y as positive down; xboxdrv, and so the rest of this module, as positive up
+EVDEV_STICKS = {ABS_X: (0, 1), ABS_Y: (1, -1), ABS_RX: (2, 1), ABS_RY: (3, -1)}
+EVDEV_TRIGGERS = {ABS_Z: 4, ABS_RZ: 5}
+EVDEV_PATTERN = '/dev/input/by-id/*event-joystick'
+
+def EVIOCGABS(axis):
+    """ ioctl request reading the input_absinfo of an axis. """
+    return (2 << 30) | (ABSINFO.size << 16) | (ord('E') << 8) | (0x40 + axis)
+
+def parse_line(line):
+    """ Decodes one xboxdrv output line. Returns a ControllerState, or None for other lines. """
+    values = FIELD.findall(line)
+    if len(values) != NUM_FIELDS:
+        return None
+
+    buttons = 0
+    for button, value in zip(DIGITAL_BUTTONS, values[4:19]):
+        if value != b'0':
+            buttons |= 1 << button.value
+
+    return ControllerState(int(values[0]), int(values[1]), int(values[2]), int(values[3]),
+                           int(values[19]), int(values[20]), buttons)
+
 class Joystick:
     @classmethod
     async def create(cls,
                      args=["--no-uinput", "--detach-kernel-driver"],
                      deadzone=4000,
-                     normalize=False):
+                     normalize=False,
+                     backend="xboxdrv",
+                     device=None):
         """ Spawns xboxdrv using the given arguments. This is useful for telling xboxdrv to work with
         a second controller, or a specific device.
+        With backend="evdev", reads the event device at device instead (args is ignored).
+        device may also be a FIFO of recorded events. By default the first joystick in /dev/input/by-id is used.
         """
         self = Joystick()
         self.deadzone = deadzone
         self.normalize = normalize
-        self.proc = await asyncio.create_subprocess_exec("xboxdrv",
-                                                         *args,
-                                                         stdout=asyncio.subprocess.PIPE)
+        self.backend = backend
 
         # Init callback dict
         self.handlers = {}
         for b in Button:
             self.handlers[b] = []
 
+        # Last state dispatched to handlers, and any partial input left from the last read
+        self.state = NEUTRAL
+        self.partial = b''
+
+        if backend == "evdev":
+            await self.open_evdev(device)
+        else:
+            await self.open_xboxdrv(args)
+
+        return self
+
+    async def open_xboxdrv(self, args):
+        self.proc = await asyncio.create_subprocess_exec("xboxdrv",
+                                                         *args,
+                                                         stdout=asyncio.subprocess.PIPE)
+        self.stream = self.proc.stdout
+
         # Evaluate xboxdrv preample.
         # This could likely use some improvement
         while True:
@@ -49,144 +130,169 @@ class Joystick:
             else:
                 raise RuntimeError('Failed to read xboxdrv')
 
-        return self
-
+    async def open_evdev(self, device):
+        if device is None:
+            devices = sorted(glob.glob(EVDEV_PATTERN))
+            if not devices:
+                raise OSError('No joystick found in /dev/input/by-id')
+            device = devices[0]
+
+        f = open(device, 'rb', buffering=0)
+        self.read_ranges(f)
+
+        loop = asyncio.get_event_loop()
+        self.stream = asyncio.StreamReader()
+        self.transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.stream), f)
+
+        # Axis values and buttons as events come in, latched on each SYN_REPORT
+        self.raw = list(NEUTRAL)
+
+    def read_ranges(self, f):
+        """ Reads the range of each axis from device f, to rescale them to xboxdrv's. """
+        self.trigger_max = [self.axis_range(f, ABS_Z, (0, TRIGGER_MAX))[1],
+                            self.axis_range(f, ABS_RZ, (0, TRIGGER_MAX))[1]]
+        # Center and half range of each stick, which is rescaled to +-32767
+        self.stick_scale = {}
+        for code in EVDEV_STICKS:
+            minimum, maximum = self.axis_range(f, code, (-32768, 32767))
+            self.stick_scale[code] = ((minimum + maximum) / 2.0, (maximum - minimum) / 2.0)
+
+    def axis_range(self, f, axis, default):
+        """ (minimum, maximum) of an axis, or default if the device can't tell (i.e. a FIFO). """
+        try:
+            info = fcntl.ioctl(f, EVIOCGABS(axis), bytes(ABSINFO.size))
+        except OSError:
+            return default
+        _, minimum, maximum = ABSINFO.unpack(info)[0:3]
+        return (minimum, maximum) if maximum > minimum else default
 
     async def read(self):
-        line = await self.proc.stdout.readline()
-        if line:
-            self.call_handlers(line)
+        """ Waits for input, then consumes everything buffered.
+            Presses seen anywhere in the input are reported; axes are reported from the newest state only.
+        """
+        data = await self.stream.read(READ_SIZE)
+        if not data:
+            return self
+
+        if self.backend == "evdev":
+            newest, pressed = self.decode_events(data)
+        else:
+            newest, pressed = self.decode_lines(data)
+
+        if newest is not None:
+            self.dispatch(newest, pressed)
 
         return self
 
+    def decode_lines(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+
+        newest = None
+        pressed = 0
+        prev_buttons = self.state.buttons
+        for line in lines:
+            state = parse_line(line)
+            if state is None:
+                continue
+            pressed |= state.buttons & ~prev_buttons
+            prev_buttons = state.buttons
+            newest = state
+
+        return newest, pressed
+
+    def decode_events(self, data):
+        data = self.partial + data
+        usable = len(data) - len(data) % INPUT_EVENT.size
+        self.partial = data[usable:]
+
+        raw = self.raw
+        newest = None
+        pressed = 0
+        prev_buttons = self.state.buttons
+        for _, _, ev_type, code, value in INPUT_EVENT.iter_unpack(data[:usable]):
+            if ev_type == EV_ABS:
+                if code in EVDEV_STICKS:
+                    index, sign = EVDEV_STICKS[code]
+                    center, half = self.stick_scale[code]
+                    raw[index] = max(-32768, min(32767, int(sign * (value - center) * 32767 / half)))
+                elif code in EVDEV_TRIGGERS:
+                    index = EVDEV_TRIGGERS[code]
+                    raw[index] = int(value * TRIGGER_MAX / self.trigger_max[index - 4])
+                elif code == ABS_HAT0X or code == ABS_HAT0Y:
+                    raw[6] = self.hat_buttons(raw[6], code, value)
+            elif ev_type == EV_KEY and code in EVDEV_BUTTONS:
+                bit = 1 << EVDEV_BUTTONS[code].value
+                raw[6] = raw[6] | bit if value else raw[6] & ~bit
+            elif ev_type == EV_SYN and code == SYN_REPORT:
+                pressed |= raw[6] & ~prev_buttons
+                prev_buttons = raw[6]
+                newest = ControllerState(*raw)
+
+        return newest, pressed
+
+    def hat_buttons(self, buttons, code, value):
+        """ The dpad is reported as two axes from -1 to 1. """
+        if code == ABS_HAT0X:
+            low, high = Button.DpadL, Button.DpadR
+        else:
+            low, high = Button.DpadU, Button.DpadD
+
+        buttons &= ~(1 << low.value | 1 << high.value)
+        if value < 0:
+            buttons |= 1 << low.value
+        elif value > 0:
+            buttons |= 1 << high.value
+        return buttons
+
     def on_button(self, button, callback):
         self.handlers[button].append(callback)
 
-    def call_handlers(self, line):
-        """ Each handler will parse its portion of the input line """
-        self.handle_stick_l(line)
-        self.handle_stick_r(line)
-        self.handle_dpad(line)
-        self.handle_special(line)
-        self.handle_action_buttons(line)
-        self.handle_bumpers(line)
-        self.handle_triggers(line)
-
-    def handle_stick_l(self, line):
-        """ Returns a value from (-32768 to +32767) or (-1 to 1) if normalize=True
-        Stick handlers are called for every input of the controller unless the stick is in the deadzone.
-        If the LStick is outside the deadzone and A is pressed, LStick handlers will be called.
+    def dispatch(self, state, pressed):
+        """ Calls the handlers for what changed since the last dispatched state.
+            pressed is a bitfield of buttons that went down since then.
         """
-        if self.handlers[Button.LStick]:
-            leftX = int(line[3:9])
-            leftY = int(line[13:19])
-
-            # if value is beyond deadzone, do stuff
-            if not(abs(leftX) < self.deadzone and abs(leftY) < self.deadzone):
-                if self.normalize:
-                    leftX /= 32768.0
-                    leftY /= 32768.0
-
-                for cb in self.handlers[Button.LStick]:
-                    cb(leftX, leftY)
-
-        # "Clicking" the left analog stick
-        if self.handlers[Button.L3] and int(line[90:91]):
-            for cb in self.handlers[Button.L3]:
-                cb()
-
-    def handle_stick_r(self, line):
-        """ Returns a value from (-32768 to +32767) or (-1 to 1) if normalize=True
-        Stick handlers are called for every input of the controller unless the stick is in the deadzone.
-        If the LStick is outside the deadzone and A is pressed, LStick handlers will be called.
-        """
-        if self.handlers[Button.RStick]:
-            rightX = int(line[24:30])
-            rightY = int(line[34:40])
-
-            # if value is beyond deadzone, do stuff
-            if not(abs(rightX) < self.deadzone and abs(rightY) < self.deadzone):
-                if self.normalize:
-                    rightX /= 32768.0
-                    rightY /= 32768.0
-
-                for cb in self.handlers[Button.RStick]:
-                    cb(rightX, rightY)
-
-        # "Clicking" the left analog stick
-        if self.handlers[Button.R3] and int(line[95:96]):
-            for cb in self.handlers[Button.R3]:
-                cb()
-
-    def handle_dpad(self, line):
-        if self.handlers[Button.DpadU] and int(line[45:46]):
-            for cb in self.handlers[Button.DpadU]:
-                cb()
-
-        if self.handlers[Button.DpadD] and int(line[50:51]):
-            for cb in self.handlers[Button.DpadD]:
-                cb()
-
-        if self.handlers[Button.DpadL] and int(line[55:56]):
-            for cb in self.handlers[Button.DpadL]:
-                cb()
-
-        if self.handlers[Button.DpadR] and int(line[60:61]):
-            for cb in self.handlers[Button.DpadR]:
-                cb()
-
-    def handle_special(self, line):
-        if self.handlers[Button.Back] and int(line[68:69]):
-            for cb in self.handlers[Button.Back]:
-                cb()
-
-        if self.handlers[Button.Guide] and int(line[76:77]):
-            for cb in self.handlers[Button.Guide]:
-                cb()
-
-        if self.handlers[Button.Start] and int(line[84:85]):
-            for cb in self.handlers[Button.Start]:
-                cb()
-
-    def handle_action_buttons(self, line):
-        if self.handlers[Button.A] and int(line[100:101]):
-            for cb in self.handlers[Button.A]:
-                cb()
-
-        if self.handlers[Button.B] and int(line[104:105]):
-            for cb in self.handlers[Button.B]:
-                cb()
-        if self.handlers[Button.X] and int(line[108:109]):
-            for cb in self.handlers[Button.X]:
-                cb()
-        if self.handlers[Button.Y] and int(line[112:113]):
-            for cb in self.handlers[Button.Y]:
-                cb()
-
-    def handle_bumpers(self, line):
-        if self.handlers[Button.LB] and int(line[118:119]):
-            for cb in self.handlers[Button.LB]:
-                cb()
-
-        if self.handlers[Button.RB] and int(line[123:124]):
-            for cb in self.handlers[Button.RB]:
-                cb()
-
-    def handle_triggers(self, line):
+        prev = self.state
+        state = self.apply_deadzone(state)
+        self.state = state
+
+        if (state.lx, state.ly) != (prev.lx, prev.ly):
+            self.call(Button.LStick, self.scale_stick(state.lx), self.scale_stick(state.ly))
+        if (state.rx, state.ry) != (prev.rx, prev.ry):
+            self.call(Button.RStick, self.scale_stick(state.rx), self.scale_stick(state.ry))
+        if state.lt != prev.lt:
+            self.call(Button.LTrigger, self.scale_trigger(state.lt))
+        if state.rt != prev.rt:
+            self.call(Button.RTrigger, self.scale_trigger(state.rt))
+
+        if pressed:
+            for button in DIGITAL_BUTTONS:
+                if pressed & (1 << button.value):
+                    self.call(button)
+
+    def apply_deadzone(self, state):
+        """ A stick inside the deadzone on both axes reads as centered. """
+        if abs(state.lx) < self.deadzone and abs(state.ly) < self.deadzone:
+            state = state._replace(lx=0, ly=0)
+        if abs(state.rx) < self.deadzone and abs(state.ry) < self.deadzone:
+            state = state._replace(rx=0, ry=0)
+        return state
+
+    def scale_stick(self, value):
+        """ Returns a value from (-32768 to +32767) or (-1 to 1) if normalize=True """
+        return value / STICK_MAX if self.normalize else value
+
+    def scale_trigger(self, value):
         """ Returns a value from 0 - 255 or 0 - 1 if normalize=True"""
-        if self.handlers[Button.LTrigger]:
-            for cb in self.handlers[Button.LTrigger]:
-                val = int(line[129:132])
-                if self.normalize:
-                    val /= 255.0
-                cb(val)
-
-        if self.handlers[Button.RTrigger]:
-            for cb in self.handlers[Button.RTrigger]:
-                val = int(line[136:139])
-                if self.normalize:
-                    val /= 255.0
-                cb(val)
+        return value / TRIGGER_MAX if self.normalize else value
+
+    def call(self, button, *args):
+        for cb in self.handlers[button]:
+            cb(*args)
 
     def close(self):
-        self.proc.kill()
+        if self.backend == "evdev":
+            self.transport.close()
+        else:
+            self.proc.kill()
@@ -0,0 +1,293 @@
+""" State estimation from the IMU and the pressure sensor.
+
+Orientation (roll, pitch, yaw in rad) comes from a complementary filter:
+gyro rates are integrated and pulled towards the tilt measured by the
+accelerometer, which only constrains roll and pitch. Yaw is gyro only and drifts.
+Body rates are used as Euler angle rates, which holds while the ROV stays near level.
+
+Position and velocity (m, m/s) come from a Kalman filter per world axis
+driven by the accelerometer with gravity removed. Depth from the pressure sensor
+corrects z; x and y are dead reckoning, slowed by water drag.
+
+World frame: z up, x and y follow the IMU's axes at zero yaw.
+The IMU reads +GRAVITY_UNITS on z when level and at rest, gyro rates are deg/s (see razor.ino).
+Timestamps are whatever clock the samples carry, as long as IMU and depth share it.
+
+Estimator.update_imu/update_depth run one sample at a time.
+Estimator.run_batch runs over whole arrays of samples and gives the same result.
+"""
+import numpy
+
+GRAVITY = 9.80665
+GRAVITY_UNITS = 256.0   # IMU reading of 1g
+
+TILT_TIME_CONSTANT = 1.0    # secs for the accelerometer tilt to win over the gyro
+TILT_GATE = 0.15            # ignore the tilt while |accel| is further than this from 1g (fraction)
+DRAG_TIME_CONSTANT = 2.0    # secs for velocity to decay without acceleration
+ACCEL_NOISE = 0.5           # m/s^2 standard deviation, process noise
+DEPTH_NOISE = 0.02          # m standard deviation of a depth reading
+INITIAL_VARIANCE = ((0.0, 0.01), (0.0, 0.01), (100.0, 0.01)) # (position, velocity) per axis
+
+MAX_DECAY = 300.0   # keeps exp() in linear_recurrence well within float range
+
+def tilt(accel):
+    """ Roll and pitch (rad) of the gravity vector in accel (..., 3),
+        and whether accel is close enough to 1g to trust it.
+    """
+    ax, ay, az = accel[..., 0], accel[..., 1], accel[..., 2]
+    roll = numpy.arctan2(ay, az)
+    pitch = numpy.arctan2(-ax, numpy.hypot(ay, az))
+    norm = numpy.sqrt(ax * ax + ay * ay + az * az)
+    return roll, pitch, numpy.abs(norm - GRAVITY) < TILT_GATE * GRAVITY
+
+def world_acceleration(orientation, accel, out=None):
+    """ Rotates body frame accel (..., 3) to the world frame and removes gravity.
+        orientation is (..., 3) roll, pitch, yaw.
+    """
+    roll, pitch, yaw = orientation[..., 0], orientation[..., 1], orientation[..., 2]
+    cr, sr = numpy.cos(roll), numpy.sin(roll)
+    cp, sp = numpy.cos(pitch), numpy.sin(pitch)
+    cy, sy = numpy.cos(yaw), numpy.sin(yaw)
+    ax, ay, az = accel[..., 0], accel[..., 1], accel[..., 2]
+
+    if out is None:
+        out = numpy.empty(numpy.shape(accel))
+    out[..., 0] = cy * cp * ax + (cy * sp * sr - sy * cr) * ay + (cy * sp * cr + sy * sr) * az
+    out[..., 1] = sy * cp * ax + (sy * sp * sr + cy * cr) * ay + (sy * sp * cr - cy * sr) * az
+    out[..., 2] = -sp * ax + cp * sr * ay + cp * cr * az - GRAVITY
+    return out
+
+def linear_recurrence(a, c, y0):
+    """ Vectorized y[k] = a[k] * y[k-1] + c[k] with y[-1] = y0, for 0 < a <= 1.
+        Solved as y[k] = A[k] * (y0 + sum(c[j] / A[j])) with A the running product of a,
+        in blocks short enough that 1 / A does not overflow.
+    """
+    y = numpy.empty(len(c))
+    decay = numpy.cumsum(-numpy.log(a))
+    start, base, prev = 0, 0.0, y0
+    while start < len(c):
+        end = max(int(numpy.searchsorted(decay, base + MAX_DECAY, side='right')), start + 1)
+        scale = numpy.exp(decay[start:end] - base)
+        y[start:end] = (prev + numpy.cumsum(c[start:end] * scale)) / scale
+        start, base, prev = end, decay[end - 1], y[end - 1]
+    return y
+
+class Estimator:
+    """ Fuses IMU and depth samples. State arrays are updated in place, so they can be held on to. """
+    def __init__(self):
+        self.orientation = numpy.zeros(3)
+        self.position = numpy.zeros(3)
+        self.velocity = numpy.zeros(3)
+        self.acceleration = numpy.zeros(3)      # world frame, gravity removed
+        self.covariance = numpy.zeros((3, 2, 2)) # per axis, over (position, velocity)
+        self.accel = numpy.zeros(3)
+        self.reset()
+
+    def reset(self):
+        self.time = None
+        self.orientation.fill(0.0)
+        self.position.fill(0.0)
+        self.velocity.fill(0.0)
+        self.acceleration.fill(0.0)
+        self.covariance.fill(0.0)
+        for axis, (position, velocity) in enumerate(INITIAL_VARIANCE):
+            self.covariance[axis, 0, 0] = position
+            self.covariance[axis, 1, 1] = velocity
+
+    def update_imu(self, t, accel, gyro):
+        """ Adds an IMU sample in the firmware's units. Samples not newer than the last one are ignored. """
+        f = self.accel
+        f[:] = accel
+        f *= GRAVITY / GRAVITY_UNITS
+        roll, pitch, trusted = tilt(f)
+
+        if self.time is None:
+            self.orientation[:] = (roll, pitch, 0.0)
+            self.time = t
+            world_acceleration(self.orientation, f, self.acceleration)
+            return
+        dt = t - self.time
+        if dt <= 0:
+            return
+        self.time = t
+
+        # Complementary filter
+        rates = numpy.radians(gyro)
+        a = TILT_TIME_CONSTANT / (TILT_TIME_CONSTANT + dt) if trusted else 1.0
+        o = self.orientation
+        o[0] = a * (o[0] + rates[0] * dt) + (1 - a) * roll
+        o[1] = a * (o[1] + rates[1] * dt) + (1 - a) * pitch
+        o[2] += rates[2] * dt
+
+        acc = world_acceleration(o, f, self.acceleration)
+
+        # Kalman predict, F = [[1, dt], [0, drag]]
+        dt2 = dt * dt
+        drag = numpy.exp(-dt / DRAG_TIME_CONSTANT)
+        q = ACCEL_NOISE * ACCEL_NOISE
+        c = self.covariance
+        c[:, 0, 0] += 2 * dt * c[:, 0, 1] + dt2 * c[:, 1, 1] + q * dt2 * dt2 / 4
+        c[:, 0, 1] = drag * (c[:, 0, 1] + dt * c[:, 1, 1]) + q * dt2 * dt / 2
+        c[:, 1, 1] = drag * drag * c[:, 1, 1] + q * dt2
+        c[:, 1, 0] = c[:, 0, 1]
+
+        self.position += self.velocity * dt + 0.5 * dt2 * acc
+        self.velocity *= drag
+        self.velocity += acc * dt
+
+    def update_depth(self, t, depth):
+        """ Corrects z with a depth reading in m, positive down. """
+        c = self.covariance[2]
+        s = c[0, 0] + DEPTH_NOISE * DEPTH_NOISE
+        k0, k1 = c[0, 0] / s, c[0, 1] / s
+        innovation = -depth - self.position[2]
+        self.position[2] += k0 * innovation
+        self.velocity[2] += k1 * innovation
+
+        c[1, 1] -= k1 * c[0, 1]
+        c[0, 1] *= 1 - k0
+        c[0, 0] *= 1 - k0
+        c[1, 0] = c[0, 1]
+
+    def run_batch(self, times, accel, gyro, depth_times=(), depth=()):
+        """ Runs update_imu over times (N,), accel (N, 3), gyro (N, 3)
+            and update_depth over depth_times (M,), depth (M,), interleaved by time.
+            Everything but the depth corrections runs as whole-array operations.
+            Leaves the estimator at the final state and returns a dict of
+            time, orientation, position, velocity, acceleration (N, 3 each) and
+            variance (N, 3) of the position, for the samples that were used.
+            Each row is the state after an IMU sample and the depth readings up to the next one.
+        """
+        times = numpy.asarray(times, float)
+        f = numpy.asarray(accel, float) * (GRAVITY / GRAVITY_UNITS)
+        rates = numpy.radians(numpy.asarray(gyro, float))
+        depth_times = numpy.asarray(depth_times, float)
+        depth = numpy.asarray(depth, float)
+
+        # Drop samples that are not newer than the ones before them, like update_imu
+        latest = numpy.maximum.accumulate(times)
+        keep = numpy.ones(len(times), bool)
+        keep[1:] = times[1:] > latest[:-1]
+        if self.time is not None:
+            keep &= times > self.time
+        times, f, rates = times[keep], f[keep], rates[keep]
+        n = len(times)
+
+        result = {"time": times}
+        if not n:
+            for name in ("orientation", "position", "velocity", "acceleration", "variance"):
+                result[name] = numpy.empty((0, 3))
+            for t, d in zip(depth_times, depth):
+                self.update_depth(t, d)
+            return result
+
+        roll, pitch, trusted = tilt(f)
+        dt = numpy.diff(numpy.concatenate(([times[0] if self.time is None else self.time], times)))
+        if self.time is None:
+            self.orientation[:] = (roll[0], pitch[0], 0.0)
+
+        # Complementary filter. dt is 0 for a first sample, which leaves y0 as is.
+        a = numpy.where(trusted, TILT_TIME_CONSTANT / (TILT_TIME_CONSTANT + dt), 1.0)
+        orientation = numpy.empty((n, 3))
+        orientation[:, 0] = linear_recurrence(a, a * rates[:, 0] * dt + (1 - a) * roll, self.orientation[0])
+        orientation[:, 1] = linear_recurrence(a, a * rates[:, 1] * dt + (1 - a) * pitch, self.orientation[1])
+        orientation[:, 2] = self.orientation[2] + numpy.cumsum(rates[:, 2] * dt)
+        acc = world_acceleration(orientation, f)
+
+        drag = numpy.exp(-dt / DRAG_TIME_CONSTANT)
+        q = ACCEL_NOISE * ACCEL_NOISE
+        position = numpy.empty((n, 3))
+        velocity = numpy.empty((n, 3))
+        variance = numpy.empty((n, 3))
+        final = numpy.empty((3, 2, 2))
+
+        # Applied after the last IMU sample at or before them, as they would arrive live
+        after = numpy.searchsorted(times, depth_times, side='right')
+        for axis in range(3):
+            p0, v0 = self.position[axis], self.velocity[axis]
+            c = self.covariance[axis]
+            if axis == 2 and len(depth):
+                self.predict_corrected(dt, drag, acc[:, 2], depth, after,
+                                       position[:, 2], velocity[:, 2], variance[:, 2], final[2])
+                continue
+
+            # Without corrections the filter is a set of linear recurrences
+            v = linear_recurrence(drag, acc[:, axis] * dt, v0)
+            v_prev = numpy.concatenate(([v0], v[:-1]))
+            position[:, axis] = p0 + numpy.cumsum(v_prev * dt + 0.5 * acc[:, axis] * dt * dt)
+            velocity[:, axis] = v
+
+            p11 = linear_recurrence(drag * drag, q * dt * dt, c[1, 1])
+            p11_prev = numpy.concatenate(([c[1, 1]], p11[:-1]))
+            p01 = linear_recurrence(drag, drag * dt * p11_prev + q * dt ** 3 / 2, c[0, 1])
+            p01_prev = numpy.concatenate(([c[0, 1]], p01[:-1]))
+            variance[:, axis] = c[0, 0] + numpy.cumsum(2 * dt * p01_prev + dt * dt * p11_prev + q * dt ** 4 / 4)
+            final[axis] = ((variance[-1, axis], p01[-1]), (p01[-1], p11[-1]))
+
+        self.time = times[-1]
+        self.orientation[:] = orientation[-1]
+        self.position[:] = position[-1]
+        self.velocity[:] = velocity[-1]
+        self.acceleration[:] = acc[-1]
+        self.covariance[:] = final
+
+        result.update(orientation=orientation, position=position, velocity=velocity,
+                      acceleration=acc, variance=variance)
+        return result
+
+    def predict_corrected(self, dt, drag, acc, depth, after, position, velocity, variance, final):
+        """ The z axis of run_batch, stepped sample by sample around the depth corrections. """
+        p, v = self.position[2], self.velocity[2]
+        c = self.covariance[2]
+        p00, p01, p11 = c[0, 0], c[0, 1], c[1, 1]
+        q = ACCEL_NOISE * ACCEL_NOISE
+        r = DEPTH_NOISE * DEPTH_NOISE
+        dt, drag, acc = dt.tolist(), drag.tolist(), acc.tolist()
+        depth, after = depth.tolist(), after.tolist()
+        j = 0
+
+        for i in range(-1, len(dt)):
+            if i >= 0:
+                h, d, a = dt[i], drag[i], acc[i]
+                h2 = h * h
+                p += v * h + 0.5 * a * h2
+                v = d * v + a * h
+                p00 += 2 * h * p01 + h2 * p11 + q * h2 * h2 / 4
+                p01 = d * (p01 + h * p11) + q * h2 * h / 2
+                p11 = d * d * p11 + q * h2
+
+            while j < len(depth) and after[j] == i + 1:
+                s = p00 + r
+                k0, k1 = p00 / s, p01 / s
+                innovation = -depth[j] - p
+                p += k0 * innovation
+                v += k1 * innovation
+                p11 -= k1 * p01
+                p01 *= 1 - k0
+                p00 *= 1 - k0
+                j += 1
+
+            if i >= 0:
+                position[i], velocity[i], variance[i] = p, v, p00
+
+        final[:] = ((p00, p01), (p01, p11))
+
+if __name__ == "__main__":
+    """ Run the estimator over a flight recording.
+        Usage: estimator.py FILE OUT.npz
+    """
+    import sys
+    import time
+    import recorder
+
+    log = recorder.FlightLog(sys.argv[1]).export()
+    imu, pressure = log["imu"], log["pressure"]
+    depth = pressure["values"][:, 2] if len(pressure["time"]) else ()
+
+    start = time.perf_counter()
+    result = Estimator().run_batch(imu["time"], imu["values"][:, :3], imu["values"][:, 3:6],
+                                   pressure["time"], depth)
+    elapsed = time.perf_counter() - start
+
+    numpy.savez(sys.argv[2], **result)
+    print("{} IMU samples, {} depth readings in {:.3f}s".format(len(result["time"]), len(depth), elapsed))
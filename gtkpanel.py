@@ -19,10 +19,11 @@ def boxed_entry(label, value):
 class ROVPanel(Gtk.Window):
     """ Gtk window for setting parameters in the ROV's high level controls.
     """
-    def __init__(self, socket):
+    def __init__(self, send_command):
+        """ send_command(name, **args) sends a command to the ROV and returns a future or None. """
         Gtk.Window.__init__(self, title="ROV station")
         self.set_border_width(10)
-        self.socket = socket
+        self.send_command = send_command
 
         self.controls_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
 
@@ -67,19 +68,46 @@ class ROVPanel(Gtk.Window):
 
         self.controls_box.pack_start(button_box, True, True, 3)
 
+        # Create telemetry display, one line per group
+        telemetry_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        self.controls_box.pack_start(telemetry_box, True, True, 0)
+        telemetry_box.pack_start(Gtk.Label("Telemetry"), True, True, 5)
+
+        self.telemetry = {}
+        for group in ("pressure", "imu", "thrusters", "status"):
+            label = Gtk.Label("{}: -".format(group))
+            label.set_xalign(0.0)
+            telemetry_box.pack_start(label, True, True, 1)
+            self.telemetry[group] = label
+
         self.add(self.controls_box)
         self.connect("delete-event", Gtk.main_quit)
         self.show_all()
 
+    def show_telemetry(self, group, values):
+        """ Update the label of a telemetry group with its latest values. """
+        label = self.telemetry.get(group)
+        if label is None:
+            return
+
+        if group == "pressure":
+            text = "Depth: {depth:.2f} m, T: {temperature:.1f}°C, P: {pressure:.0f} mbar".format(**values)
+        elif group == "imu":
+            text = "A: {ax:.0f}, {ay:.0f}, {az:.0f}  G: {gx:.1f}, {gy:.1f}, {gz:.1f}".format(**values)
+        elif group == "thrusters":
+            text = "Thrusters: " + " ".join("{:+.2f}".format(v) for v in values["outputs"])
+        else:
+            text = "{}, lost {lost}, late {late}, jitter {jitter_ms:.1f} ms, delay {delay_ms:.1f} ms".format(
+                "Auto" if values["autonomy"] else "Manual", **values)
+        label.set_text(text)
+
     def on_pid_clicked(self, button):
         data = {
             'p': self.pid['p'].get_value(),
             'i': self.pid['i'].get_value(),
             'd': self.pid['d'].get_value()
         }
-        output = "pid" + json.dumps(data)
-
-        self.socket.write(output.encode())
+        self.send_command("pid", **data)
         print("P: {}, I: {}, D: {}".format(self.pid['p'].get_value(), self.pid[
             'i'].get_value(), self.pid['d'].get_value()))
 
@@ -88,9 +116,7 @@ class ROVPanel(Gtk.Window):
             'q': self.lqr['q'].get_value(),
             'r': self.lqr['r'].get_value(),
         }
-        output = "lqr" + json.dumps(data)
-
-        self.socket.write(output.encode())
+        self.send_command("lqr", **data)
         print("Q: {}, R: {}".format(self.lqr['q'].get_value(), self.lqr['r'].get_value()))
 
 if __name__ == "__main__":
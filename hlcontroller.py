@@ -1,123 +1,292 @@
+import collections
 import time
 import numpy
 
+from estimator import Estimator
+
+# scipy.linalg once loaded, False without scipy. Imported on first use, as it takes seconds to load on the Pi.
+scipy_linalg = None
+
+PLANT_GAIN = 1.0        # m/s (or rad/s) of state change per unit of command, see plant_model
+GAIN_CACHE_SIZE = 32    # solved LQR gains kept by solve_gain
+DARE_ITERATIONS = 10000
+DARE_TOLERANCE = 1e-10
+PID_INTEGRAL_LIMIT = 1.0    # largest output from the integral term, per axis
+PID_DERIVATIVE_FILTER = 0.05 # secs, time constant of the derivative's low-pass filter
+
 class HLController:
     """ High Level Controller.
         Wrapper over all types of controllers (PID, LQR, etc)
-        Stores state information and asks the underlying controller for updates.
+        Feeds sensor samples to the state estimator and asks the underlying controller for updates.
     """
-    def __init__(self, controller):
-        self.goalPos = numpy.zeros(3)
-        self.position = numpy.zeros(3)
-        self.velocity = numpy.zeros(3)
-        self.rotation = numpy.zeros(3)
+    def __init__(self, controller, estimator=None):
+        self.goalPos = numpy.zeros(6) # Goal state, position then rotation
+        self.estimator = estimator or Estimator()
 
-        self.time = time.time()
+        # Views of the estimator's state, updated in place
+        self.position = self.estimator.position
+        self.velocity = self.estimator.velocity
+        self.rotation = self.estimator.orientation
+
+        self.state = numpy.zeros(6)
+        self.time = None
 
         self.controller = controller
-        self.output = numpy.zeros(3)
+        self.output = numpy.zeros(6)
+
+    def observe_imu(self, t, accel, gyro):
+        """ Adds an IMU sample taken at t, see Estimator.update_imu. """
+        self.estimator.update_imu(t, accel, gyro)
+
+    def observe_depth(self, t, depth):
+        """ Adds a depth reading (m) taken at t. """
+        self.estimator.update_depth(t, depth)
 
-    def update(self, accel, gyro):
+    def update(self, now=None):
         """
-        Given accelerometer and gyro data, update internal state
-        Delta_time is based on last time this functio nwas called
+        Asks the controller how to reach goal from the current estimate.
+        Delta_time is based on last time this function was called.
+        now defaults to time.monotonic(); pass sample times when replaying a log.
         Returns controller output.
         """
-        accelx, accely, accelz = accel
-        rotx, roty, rotz = gyro
-
-        curr_time = time.time()
+        curr_time = time.monotonic() if now is None else now
+        if self.time is None or curr_time <= self.time:
+            self.time = curr_time
+            return self.output
         delta_time = curr_time - self.time
 
-        # update internal state
-        self.position += self.velocity * delta_time
-        self.velocity[0] += accelx * delta_time
-        self.velocity[1] += accely * delta_time
-        self.velocity[2] += accelz * delta_time
-        self.rotation = [rotx, roty, rotz]
-
-        # Ask the controller how to reach goal
-        state = numpy.concatenate((self.position, self.rotation))
-        output = self.controller.update(state, delta_time)
+        state = self.state
+        state[:3] = self.position
+        state[3:] = self.rotation
+        if isinstance(self.controller, LQR) and self.controller.schedule is not None:
+            speed = numpy.sqrt(numpy.dot(self.velocity, self.velocity))
+            self.controller.schedule_gain(-self.position[2], speed)
+        self.output = self.controller.update(state, delta_time)
 
         self.time = curr_time
-        return output
+        return self.output
 
-    def update_controller(controller):
+    def update_controller(self, controller):
         if controller.__class__ == self.controller.__class__:
             if isinstance(controller, PID):
-                self.controller.kP = controller.kP
-                self.controller.kI = controller.kI
-                self.controller.kD = controller.kD
+                # Keeps the integral and derivative state, so the output doesn't jump
+                self.controller.set_gains(controller.kP, controller.kI, controller.kD)
             if isinstance(controller, LQR):
                 self.controller.Q = controller.Q
                 self.controller.R = controller.R
+                self.controller.K = controller.K
+                self.controller.schedule = controller.schedule
         else:
             self.controller = controller
-            if isinstance(controller, PID):
-                self.controller.goal = self.goalPos
+            self.controller.goal = self.goalPos
 
-class LQR:
-    def __init__(self, q=numpy.identity(6), r=numpy.identity(6)):
-        self.K = 3
-        self.Q = q
-        self.R = r
+def plant_model(dt, gain=PLANT_GAIN):
+    """ Simplest model of the ROV: every DOF of the state moves at gain * command.
+        x[k+1] = A x[k] + B u[k] with a controller period of dt secs.
+    """
+    return numpy.identity(6), dt * gain * numpy.identity(6)
 
-    def solve(A, B):
-        """
+def load_scipy():
+    global scipy_linalg
+    if scipy_linalg is None:
+        try:
+            import scipy.linalg as scipy_linalg
+        except ImportError:
+            scipy_linalg = False # Gains are solved by iteration instead
+    return scipy_linalg
+
+def solve_dare(A, B, Q, R):
+    """ Solves the discrete algebraic Riccati equation for X.
+        Uses scipy when it is installed, otherwise iterates the Riccati recursion.
+    """
+    if load_scipy():
+        return scipy_linalg.solve_discrete_are(A, B, Q, R)
+
+    X = Q
+    for _ in range(DARE_ITERATIONS):
+        BX = B.T.dot(X)
+        X_next = Q + A.T.dot(X).dot(A) - A.T.dot(X).dot(B).dot(numpy.linalg.solve(R + BX.dot(B), BX.dot(A)))
+        if numpy.allclose(X_next, X, rtol=DARE_TOLERANCE, atol=DARE_TOLERANCE):
+            return X_next
+        X = X_next
+    raise ValueError("Riccati iteration did not converge")
+
+_gains = collections.OrderedDict()
+
+def gain_key(A, B, Q, R):
+    return tuple((m.shape, m.tobytes()) for m in map(numpy.ascontiguousarray, (A, B, Q, R)))
+
+def cached_gain(A, B, Q, R):
+    """ The gain solve_gain found for these matrices before, or None. """
+    return _gains.get(gain_key(A, B, Q, R))
+
+def solve_gain(A, B, Q, R):
+    """ LQR gain K for u = -K x
         x[k+1] = A x[k] + B u[k]
 
         cost = sum x[k].T*Q*x[k] + u[k].T*R*u[k]
-        """
-        #ref Bertsekas, p.151
 
-        #first, try to solve the ricatti equation
-        X = np.matrix(scipy.linalg.solve_discrete_are(A, B, self.Q, self.R))
+        Gains are memoized by (A, B, Q, R). Safe to run in an executor.
+    """
+    #ref Bertsekas, p.151
+    key = gain_key(A, B, Q, R)
+    K = _gains.get(key)
+    if K is not None:
+        return K
+
+    X = solve_dare(A, B, Q, R)
+    K = numpy.linalg.solve(B.T.dot(X).dot(B) + R, B.T.dot(X).dot(A))
+
+    _gains[key] = K
+    while len(_gains) > GAIN_CACHE_SIZE:
+        _gains.popitem(last=False)
+    return K
+
+class GainSchedule:
+    """ Table of LQR gains over operating points (depth in m, speed in m/s).
+        Gains between entries are interpolated bilinearly, and clamped to the table's edges.
+    """
+    def __init__(self, depths, speeds, gains):
+        self.depths = numpy.asarray(depths, float)
+        self.speeds = numpy.asarray(speeds, float)
+        self.gains = numpy.asarray(gains, float)
+        if self.gains.shape[:2] != (len(self.depths), len(self.speeds)):
+            raise ValueError("Gain table needs one gain per depth and speed")
+        self.K = numpy.empty(self.gains.shape[2:])
+
+    @classmethod
+    def load(cls, path):
+        """ Reads a table written by save. """
+        data = numpy.load(path)
+        return cls(data["depths"], data["speeds"], data["gains"])
 
-        #compute the LQR gain
-        K = np.matrix(scipy.linalg.inv(B.T*X*B+R)*(B.T * X * A))
+    def save(self, path):
+        numpy.savez(path, depths=self.depths, speeds=self.speeds, gains=self.gains)
 
-        #eigVals, eigVecs = scipy.linalg.eig(A-B*K)
+    @classmethod
+    def build(cls, depths, speeds, model):
+        """ Solves a gain for every operating point. model(depth, speed) returns (A, B, Q, R). """
+        gains = [[solve_gain(*model(depth, speed)) for speed in speeds] for depth in depths]
+        return cls(depths, speeds, gains)
 
+    def lookup(self, depth, speed):
+        """ Returns the interpolated gain in self.K, which is overwritten by the next lookup. """
+        i, u = self.locate(self.depths, depth)
+        j, v = self.locate(self.speeds, speed)
+        g = self.gains
+        K = self.K
+        numpy.multiply(g[i, j], (1 - u) * (1 - v), out=K)
+        K += g[i + 1, j] * (u * (1 - v))
+        K += g[i, j + 1] * ((1 - u) * v)
+        K += g[i + 1, j + 1] * (u * v)
         return K
 
-class PID:
-    """ PID controller over 6 values
+    @staticmethod
+    def locate(edges, value):
+        """ Index of the cell holding value and the fraction of the way across it.
+            A table with a single entry along an axis is treated as a cell of zero width.
+        """
+        if len(edges) == 1:
+            return -1, 1.0 # g[-1 + 1] is g[0], with full weight
+        i = min(max(int(numpy.searchsorted(edges, value)) - 1, 0), len(edges) - 2)
+        u = (value - edges[i]) / (edges[i + 1] - edges[i])
+        return i, min(max(u, 0.0), 1.0)
+
+class LQR:
+    """ Linear quadratic regulator over 6 values, u = K (goal - x).
+        K is either solved for (Q, R) with solve_gain, or looked up in a GainSchedule.
     """
-    def __init__(self, goal=numpy.zeros(6), p=2.0, i=0.0, d=0.0):
-        self.kP = p
-        self.kI = i
-        self.kD = d
-        self.integral = 0.0
+    def __init__(self, q=numpy.identity(6), r=numpy.identity(6), K=None, schedule=None, goal=numpy.zeros(6)):
+        self.K = K
+        self.Q = q
+        self.R = r
+        self.schedule = schedule
+        self.goal = goal
+        self.error = numpy.zeros(6)
+        self.output = numpy.zeros(6)
+
+    def solve(self, A, B):
+        """ Solves and keeps the gain for the plant x[k+1] = A x[k] + B u[k]. """
+        self.K = solve_gain(A, B, self.Q, self.R)
+        return self.K
+
+    def schedule_gain(self, depth, speed):
+        self.K = self.schedule.lookup(depth, speed)
 
-        self.prev_error = numpy.zeros(6)
+    def update(self, current_value, delta_time):
+        """ Controller output for the current state. Zero until a gain is set. """
+        if self.K is None:
+            return self.output
+        numpy.subtract(self.goal, current_value, out=self.error)
+        return numpy.dot(self.K, self.error, out=self.output)
+
+class PID:
+    """ PID controller over 6 values, with gains per axis.
+        The integral is kept as its contribution to the output, clamped to integral_limit,
+        so changing kI does not bump the output and the integral cannot wind up.
+        The derivative acts on the measurement rather than the error, so goal changes
+        do not kick, and is low-pass filtered with time constant derivative_filter secs.
+        All work happens in preallocated buffers.
+    """
+    def __init__(self, goal=numpy.zeros(6), p=2.0, i=0.0, d=0.0,
+                 integral_limit=PID_INTEGRAL_LIMIT, derivative_filter=PID_DERIVATIVE_FILTER):
+        self.kP = numpy.zeros(6)
+        self.kI = numpy.zeros(6)
+        self.kD = numpy.zeros(6)
+        self.set_gains(p, i, d)
+        self.integral_limit = numpy.zeros(6)
+        self.integral_limit[:] = integral_limit
+        self.derivative_filter = derivative_filter
         self.goal = goal
 
+        self.integral = numpy.zeros(6)
+        self.derivative = numpy.zeros(6)   # filtered rate of change of the measurement
+        self.prev_value = numpy.zeros(6)
+        self.error = numpy.zeros(6)
+        self.term = numpy.zeros(6)
+        self.output = numpy.zeros(6)
+        self.primed = False
+
+    def set_gains(self, p, i, d):
+        """ Each gain is a number or one value per axis. """
+        self.kP[:] = p
+        self.kI[:] = i
+        self.kD[:] = d
+
     def update(self, current_value, delta_time):
         """ Calculate PID output value for given reference input and feedback
-            Delta_time is expected as msec (but obviously kD can be modified to compensate)
+            delta_time is in secs. Returns self.output, which is overwritten by the next call.
         """
-        error = self.goal - current_value
-
-        p = self.kP * error
-
-        self.integral += self.integral + error
-        i = self.kI * self.integral
+        if delta_time <= 0:
+            return self.output
+        error, term, out = self.error, self.term, self.output
 
-        # Help
-        #d = self.kD * (error - self.prev_error)
-        d = self.kD * (error - self.prev_error) / delta_time
+        numpy.subtract(self.goal, current_value, out=error)
+        numpy.multiply(self.kP, error, out=out)
 
-        self.prev_error = error
+        numpy.multiply(self.kI, error, out=term)
+        term *= delta_time
+        self.integral += term
+        numpy.clip(self.integral, -self.integral_limit, self.integral_limit, out=self.integral)
+        out += self.integral
 
-        #print(error)
-        #print("{} {} {}".format(p, i, d))
+        if self.primed:
+            numpy.subtract(current_value, self.prev_value, out=term)
+            term /= delta_time
+            term -= self.derivative
+            term *= delta_time / (self.derivative_filter + delta_time)
+            self.derivative += term
+            numpy.multiply(self.kD, self.derivative, out=term)
+            out -= term
+        self.prev_value[:] = current_value
+        self.primed = True
 
-        return p + i + d
+        return out
 
     def reset(self):
-        self.integral = 0.0
-        self.prev_error = numpy.zeros(6)
+        self.integral.fill(0.0)
+        self.derivative.fill(0.0)
+        self.primed = False
 
 if __name__ == "__main__":
     controller = PID()
@@ -130,7 +299,7 @@ if __name__ == "__main__":
         delta_time = curr_time - prev_time
         error = numpy.random.rand(6) * 0.05
 
-        output = controller.update(state, delta_time * 1000)
+        output = controller.update(state, delta_time)
         #print("State: {}".format(state))
         #print("Output: {}".format(output))
         state += output + error
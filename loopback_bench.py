@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+""" End-to-end benchmark of station.py and rov.py on one Linux machine over loopback.
+
+The ROV runs in this process on fakes: a FakePCA9685 for the PiHat, a FakeSMBus
+pressure sensor and a pty fed with IMU frames by a helper process. The station runs
+in its own process with the evdev joystick backend reading a FIFO, which another
+process writes scripted stick moves into instead of xboxdrv.
+
+Phases:
+    idle      the ROV with only its sensors running, for the CPU and stall baseline
+    latency   stick steps through the station to the ROV. A step's latency is from the
+              event written to the FIFO to the first PWM write that changes a channel.
+              Both processes read the same CLOCK_MONOTONIC.
+    flood     control packets sent straight to the ROV at increasing rates, until more
+              than LOSS_LIMIT of them are lost. The highest rate that held is the
+              maximum sustainable packet rate.
+
+Event loop stalls are measured throughout by a task that sleeps STALL_PROBE and
+notes how late it wakes up. Results are JSON, tagged with the git commit,
+so runs on different commits can be diffed before deploying to the Pi.
+
+Usage: loopback_bench.py [--steps N] [--rates R,R,...] [--sensor-processes] [-o OUT.json]
+Needs Python 3.5+ and pyserial.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+
+import packets
+import rov
+from devices.fake_pca9685 import FakePCA9685
+from devices.fake_smbus import FakeSMBus
+
+LOCAL_ADDR = "127.0.0.1"
+STARTUP = 3.0           # secs for the ROV's sensors to come up and settle
+IDLE_TIME = 3.0         # secs of the idle phase
+STICK_STEPS = 200       # stick moves in the latency phase
+STICK_INTERVAL = 0.05   # mean secs between stick moves, randomized so they don't lock to the ROV's timers
+STICK_START = 1.0       # secs after the station opens the joystick before the first move
+FLOOD_RATES = [250, 500, 1000, 2000, 4000, 8000, 16000, 32000] # packets/s
+FLOOD_TIME = 2.0        # secs at each rate
+DRAIN_TIME = 0.2        # secs for the ROV to catch up after each rate
+LOSS_LIMIT = 0.01       # fraction of packets that may be lost at a sustainable rate
+STALL_PROBE = 0.001     # secs between stall probe wakeups
+STALL_THRESHOLD = 5.0   # ms late before a wakeup counts as a stall
+PERCENTILES = (50, 90, 99, 99.9)
+
+def percentiles(values):
+    """ Summary of a list of ms values. """
+    if not len(values):
+        return {"count": 0}
+    values = numpy.asarray(values, float)
+    summary = {"count": len(values), "mean": values.mean(), "max": values.max()}
+    for p, value in zip(PERCENTILES, numpy.percentile(values, PERCENTILES)):
+        summary["p{:g}".format(p)] = value
+    summary = dict((key, float(value)) for key, value in summary.items())
+    summary["count"] = len(values)
+    return summary
+
+def free_port():
+    """ A port that is free for both TCP and UDP on loopback, as rov.py uses the same number for both. """
+    while True:
+        with socket.socket() as tcp:
+            tcp.bind((LOCAL_ADDR, 0))
+            port = tcp.getsockname()[1]
+        with socket.socket(type=socket.SOCK_DGRAM) as udp:
+            try:
+                udp.bind((LOCAL_ADDR, port))
+            except OSError:
+                continue
+        return port
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty.strip() else "")
+
+# Helper processes. They are spawned, so they only get their arguments.
+
+def imu_process(conn):
+    """ Plays the IMU firmware's binary stream into a pty. Sends the pty's name, then runs until killed. """
+    from devices.imu import STREAM_SYNC, STREAM_HEADER, STREAM_SAMPLE, STREAM_INTERVAL
+
+    master, slave = os.openpty()
+    os.set_blocking(master, False)
+    conn.send(os.ttyname(slave))
+    counter = 0
+    next_frame = time.monotonic()
+    while True:
+        # Level and still, with a little noise
+        values = [random.gauss(0, 0.01), random.gauss(0, 0.01), random.gauss(1, 0.01),
+                  random.gauss(0, 0.1), random.gauss(0, 0.1), random.gauss(0, 0.1)]
+        frame = bytearray(STREAM_HEADER.pack(STREAM_SYNC, STREAM_SAMPLE.size, 0, counter))
+        frame.extend(STREAM_SAMPLE.pack(*values))
+        frame.append(sum(frame[2:]) & 0xFF)
+        os.write(master, frame)
+        counter = (counter + 1) & 0xFFFF
+
+        next_frame += STREAM_INTERVAL
+        time.sleep(max(0.0, next_frame - time.monotonic()))
+        try:
+            os.read(master, 1024) # Commands sent to the firmware
+        except BlockingIOError:
+            pass
+
+def joystick_process(fifo, steps, interval, conn):
+    """ Moves the left stick back and forth steps times through the FIFO.
+        Sends back the monotonic time each move was written.
+    """
+    from devices.xbox_async import INPUT_EVENT, EV_SYN, EV_ABS, ABS_Y, SYN_REPORT
+
+    fd = os.open(fifo, os.O_WRONLY) # Waits for the station to open the joystick
+    time.sleep(STICK_START)
+    times = []
+    for step in range(steps):
+        # Full stick forward and back at varying depth, so every move changes the thrusters
+        value = (16000 + (step % 8) * 2000) * (-1 if step % 2 else 1)
+        now = time.time()
+        sec, usec = int(now), int(now % 1 * 1e6)
+        data = INPUT_EVENT.pack(sec, usec, EV_ABS, ABS_Y, value) + INPUT_EVENT.pack(sec, usec, EV_SYN, SYN_REPORT, 0)
+        times.append(time.monotonic())
+        os.write(fd, data)
+        time.sleep(interval * (0.5 + random.random()))
+    conn.send(times)
+    os.close(fd)
+
+def station_process(port, fifo):
+    """ Runs station.py against the ROV on port, reading the joystick from fifo, until killed. """
+    sys.stdout = open(os.devnull, "w")
+    import station
+    station.TARGET_ADDR = LOCAL_ADDR
+    station.PORT = port
+    station.JOYSTICK_BACKEND = "evdev"
+    station.JOYSTICK_DEVICE = fifo
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport, tasks = station.start(loop)
+    loop.run_until_complete(asyncio.gather(*tasks))
+
+def flood_process(port, rate, duration, conn):
+    """ Sends control packets to the ROV at rate per second for duration secs. Sends back how many went out. """
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.connect((LOCAL_ADDR, port))
+    encoder = packets.ControlEncoder()
+    info = dict.fromkeys(packets.AXES, 0.0)
+    sent = 0
+    start = time.monotonic()
+    while True:
+        elapsed = time.monotonic() - start
+        if elapsed >= duration:
+            break
+        due = int(rate * elapsed)
+        if sent >= due:
+            time.sleep(min(0.001, (sent + 1) / rate - elapsed))
+            continue
+        while sent < due:
+            info["ly"] = 0.5 if sent % 2 else -0.5
+            try:
+                sock.send(encoder.encode(info))
+            except OSError:
+                pass # ENOBUFS: the packet is lost like on a busy link
+            sent += 1
+    conn.send(sent)
+
+# Measurements in the ROV process
+
+class StallMonitor:
+    """ Wakes up every STALL_PROBE secs and records how late it was, in ms. """
+    def __init__(self, loop):
+        self.loop = loop
+        self.lateness = []
+
+    async def run(self):
+        while True:
+            expected = self.loop.time() + STALL_PROBE
+            await asyncio.sleep(STALL_PROBE)
+            self.lateness.append((self.loop.time() - expected) * 1000.0)
+
+    def reset(self):
+        self.lateness = []
+
+    def summary(self):
+        lateness = numpy.asarray(self.lateness, float)
+        stalls = lateness[lateness > STALL_THRESHOLD]
+        summary = percentiles(lateness)
+        summary["stalls"] = len(stalls)
+        summary["stalled_ms"] = float(stalls.sum())
+        return summary
+
+class PWMWrites:
+    """ on_write hook for FakePCA9685 that notes the time of every write that changes a channel. """
+    def __init__(self, chip):
+        self.off = chip.off.copy()
+        self.changes = []
+
+    def __call__(self, chip):
+        if not numpy.array_equal(chip.off, self.off):
+            self.changes.append(time.monotonic())
+            self.off[:] = chip.off
+
+def stick_latencies(moves, changes):
+    """ ms from each stick move to the first PWM change before the next move, and the number of moves with none. """
+    latencies = []
+    missed = 0
+    changes = numpy.asarray(changes)
+    ends = list(moves[1:]) + [float("inf")]
+    for move, end in zip(moves, ends):
+        i = numpy.searchsorted(changes, move)
+        if i < len(changes) and changes[i] < end:
+            latencies.append((changes[i] - move) * 1000.0)
+        else:
+            missed += 1
+    return latencies, missed
+
+async def rov_command(port, name, **args):
+    """ Sends one command over the ROV's TCP command channel and returns the result. """
+    reader, writer = await asyncio.open_connection(LOCAL_ADDR, port)
+    try:
+        writer.write(packets.encode_command(1, {"cmd": name, "args": args}))
+        commands = packets.CommandReader()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("ROV closed the command connection")
+            for request_id, body in commands.feed(data):
+                if not body.get("ok"):
+                    raise packets.CommandError(body.get("error"))
+                return body.get("result")
+    finally:
+        writer.close()
+
+async def wait_for(loop, conn):
+    """ Receives from a helper process without blocking the event loop. """
+    return await loop.run_in_executor(None, conn.recv)
+
+async def bench(loop, ctx, port, args):
+    monitor = StallMonitor(loop)
+    monitor_task = loop.create_task(monitor.run())
+    result = {}
+
+    await asyncio.sleep(STARTUP)
+
+    # Idle baseline
+    monitor.reset()
+    cpu = time.process_time()
+    await asyncio.sleep(IDLE_TIME)
+    idle_cpu = (time.process_time() - cpu) / IDLE_TIME
+    result["idle"] = {"cpu_percent": idle_cpu * 100.0, "stalls": monitor.summary()}
+
+    # Stick to PWM latency through the station
+    await rov_command(port, "stats", reset=True, enable=True)
+    fifo = os.path.join(args.tmp, "joystick")
+    os.mkfifo(fifo)
+    station = ctx.Process(target=station_process, args=(port, fifo), daemon=True)
+    station.start()
+    receiver, sender = ctx.Pipe(False)
+    stick = ctx.Process(target=joystick_process, args=(fifo, args.steps, STICK_INTERVAL, sender), daemon=True)
+    stick.start()
+
+    writes = PWMWrites(args.pwm)
+    args.pwm.on_write = writes
+    monitor.reset()
+    cpu, start = time.process_time(), time.monotonic()
+    moves = await wait_for(loop, receiver)
+    await asyncio.sleep(STICK_INTERVAL * 2) # The last move's packet
+    elapsed = time.monotonic() - start
+    args.pwm.on_write = None
+
+    latencies, missed = stick_latencies(moves, writes.changes)
+    result["latency"] = {
+        "stick_to_pwm_ms": percentiles(latencies),
+        "missed": missed,
+        "cpu_percent": (time.process_time() - cpu) / elapsed * 100.0,
+        "stalls": monitor.summary(),
+    }
+    result["rov"] = await rov_command(port, "stats", enable=False)
+    station.terminate()
+    stick.join()
+    station.join()
+
+    # Packet rate the ROV keeps up with
+    steps = []
+    sustained = None
+    for rate in args.rates:
+        rov.link_stats.reset()
+        monitor.reset()
+        receiver, sender = ctx.Pipe(False)
+        flood = ctx.Process(target=flood_process, args=(port, rate, FLOOD_TIME, sender), daemon=True)
+        cpu, start = time.process_time(), time.monotonic()
+        flood.start()
+        sent = await wait_for(loop, receiver)
+        await asyncio.sleep(DRAIN_TIME)
+        cpu = time.process_time() - cpu - idle_cpu * (time.monotonic() - start)
+        flood.join()
+
+        accepted = rov.link_stats.accepted
+        loss = 1.0 - accepted / sent if sent else 1.0
+        steps.append({
+            "offered": rate,
+            "sent": sent,
+            "accepted": accepted,
+            "lost": rov.link_stats.lost,
+            "loss": loss,
+            "cpu_us_per_packet": cpu / accepted * 1e6 if accepted else None,
+            "stalls": monitor.summary(),
+        })
+        print("{} packets/s: {:.1%} lost".format(rate, loss), file=sys.stderr)
+        if loss > LOSS_LIMIT:
+            break
+        sustained = rate
+    result["flood"] = {"max_sustained_rate": sustained, "loss_limit": LOSS_LIMIT, "steps": steps}
+
+    monitor_task.cancel()
+    return result
+
+def main(args):
+    ctx = multiprocessing.get_context("spawn")
+    port = free_port()
+
+    receiver, sender = ctx.Pipe(False)
+    imu = ctx.Process(target=imu_process, args=(sender,), daemon=True)
+    imu.start()
+
+    rov.LOCAL_ADDR = LOCAL_ADDR
+    rov.PORT = port
+    rov.SERIAL_DEV = receiver.recv()
+    rov.RECORDER_PATH = None
+    rov.SENSOR_PROCESSES = args.sensor_processes
+    args.pwm = FakePCA9685(i2c=True)
+    args.pwm.set_pwm_freq(rov.PWM_FREQ)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    with tempfile.TemporaryDirectory() as args.tmp:
+        transport, server, tasks = rov.start(loop, args.pwm, FakeSMBus())
+        try:
+            result = loop.run_until_complete(bench(loop, ctx, port, args))
+        finally:
+            for task in tasks:
+                task.cancel()
+            if rov.sensors:
+                rov.sensors.stop()
+            else:
+                rov.pressure_sampler.stop()
+            transport.close()
+            server.close()
+            imu.terminate()
+
+    result.update({
+        "commit": git_commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "steps": args.steps,
+            "thruster_mode": rov.THRUSTER_MODE,
+            "thruster_max_rate": rov.THRUSTER_MAX_RATE,
+            "control_rate": rov.CONTROL_RATE,
+            "sensor_processes": rov.SENSOR_PROCESSES,
+            "telemetry_rates": rov.TELEMETRY_RATES,
+        },
+    })
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark station.py and rov.py over loopback.")
+    parser.add_argument("--steps", type=int, default=STICK_STEPS, help="stick moves in the latency phase")
+    parser.add_argument("--rates", default=",".join(str(rate) for rate in FLOOD_RATES),
+                        help="comma separated packet rates of the flood phase")
+    parser.add_argument("--sensor-processes", action="store_true", help="run the sensors in worker processes")
+    parser.add_argument("-o", "--out", help="write the results here instead of stdout")
+    args = parser.parse_args()
+    args.rates = [int(rate) for rate in args.rates.split(",")]
+
+    # rov.py and station.py talk on stdout; keep it for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        result = main(args)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        print()
@@ -0,0 +1,235 @@
+""" Wire formats shared by the station and the ROV.
+
+Control packets travel station -> ROV over UDP. Two formats are accepted:
+    * JSON: the original format, a dict of controller axes.
+    * Binary: a fixed-layout little-endian frame described by CONTROL_STRUCT.
+The first byte tells them apart (JSON always starts with '{'),
+so the ROV accepts both and older stations keep working.
+
+Binary control frame (42 bytes):
+    magic     uint8   CONTROL_MAGIC
+    version   uint8   CONTROL_VERSION
+    seq       uint32  incremented for every packet, wraps around
+    time      double  station send time, seconds since the epoch
+    axes      6 x float32 in AXES order
+    buttons   uint32  bitfield, bit n is Button(n) of devices.xbox_async
+
+Telemetry packets travel ROV -> station over the same UDP socket.
+Each datagram carries one field group so groups can be sent at different rates:
+    magic     uint8   TELEMETRY_MAGIC
+    version   uint8   TELEMETRY_VERSION
+    group     uint8   index into TELEMETRY_GROUPS
+    seq       uint32  incremented for every telemetry packet
+    time      double  ROV send time, seconds since the epoch
+    payload   see TELEMETRY_GROUPS
+
+Commands travel over TCP in both directions as length-prefixed frames,
+so several requests can be in flight and replies matched to them:
+    magic     uint8   COMMAND_MAGIC
+    length    uint16  size of the body in bytes
+    id        uint32  request id, echoed by the reply
+    body      UTF-8 JSON
+        request: {"cmd": name, "args": {...}}
+        reply:   {"ok": true, "result": ...} or {"ok": false, "error": message}
+"""
+import json
+import struct
+import time
+
+CONTROL_MAGIC = 0xA5
+CONTROL_VERSION = 1
+CONTROL_STRUCT = struct.Struct('<BBIdffffffI')
+
+# Order of the axes within the binary frame
+AXES = ("lx", "ly", "rx", "ry", "lt", "rt")
+
+SEQ_MOD = 1 << 32
+
+TELEMETRY_MAGIC = 0xA6
+TELEMETRY_VERSION = 1
+TELEMETRY_HEADER = struct.Struct('<BBBId')
+
+# name: (payload struct, field names). A field name ending in [] takes the
+# rest of the payload as a list of floats, prefixed with a uint8 count.
+TELEMETRY_GROUPS = [
+    ("pressure", struct.Struct('<fff'), ("pressure", "temperature", "depth")),
+    ("imu", struct.Struct('<ffffff'), ("ax", "ay", "az", "gx", "gy", "gz")),
+    ("thrusters", struct.Struct('<B'), ("outputs[]",)),
+    ("status", struct.Struct('<BIIIff'), ("autonomy", "accepted", "lost", "late", "jitter_ms", "delay_ms")),
+]
+TELEMETRY_GROUP_IDS = dict((name, i) for i, (name, _, _) in enumerate(TELEMETRY_GROUPS))
+FLOAT = struct.Struct('<f')
+
+COMMAND_MAGIC = 0xA7
+COMMAND_HEADER = struct.Struct('<BHI')
+COMMAND_MAX_BODY = 0xFFFF
+
+class PacketError(ValueError):
+    """ Raised for malformed or unsupported packets. """
+    pass
+
+class CommandError(Exception):
+    """ Error reply to a command. """
+    pass
+
+def is_binary(data):
+    """ True if data looks like a binary control frame rather than JSON. """
+    return len(data) > 0 and data[0] == CONTROL_MAGIC
+
+class ControlEncoder:
+    """ Packs controller state into a reusable buffer.
+        The same bytearray is returned on every call, so send it before encoding again.
+    """
+    def __init__(self):
+        self.seq = 0
+        self.buffer = bytearray(CONTROL_STRUCT.size)
+
+    def encode(self, info, buttons=0):
+        self.seq = (self.seq + 1) % SEQ_MOD
+        CONTROL_STRUCT.pack_into(self.buffer, 0,
+                                 CONTROL_MAGIC, CONTROL_VERSION, self.seq, time.time(),
+                                 info["lx"], info["ly"], info["rx"],
+                                 info["ry"], info["lt"], info["rt"],
+                                 buttons)
+        return self.buffer
+
+def decode_control(data, info):
+    """ Unpacks a binary control frame into the info dict in place.
+        Returns (seq, send_time, buttons).
+    """
+    if len(data) != CONTROL_STRUCT.size:
+        raise PacketError("Control frame is {} bytes, expected {}".format(len(data), CONTROL_STRUCT.size))
+    if data[0] != CONTROL_MAGIC or data[1] != CONTROL_VERSION:
+        raise PacketError("Unsupported control frame version {}".format(data[1]))
+
+    (magic, version, seq, send_time,
+     info["lx"], info["ly"], info["rx"],
+     info["ry"], info["lt"], info["rt"],
+     buttons) = CONTROL_STRUCT.unpack_from(data)
+
+    return seq, send_time, buttons
+
+class TelemetryEncoder:
+    """ Packs telemetry groups into per-group reusable buffers. """
+    def __init__(self, max_outputs=16):
+        self.seq = 0
+        self.buffers = []
+        for name, payload, fields in TELEMETRY_GROUPS:
+            size = TELEMETRY_HEADER.size + payload.size
+            if fields[-1].endswith("[]"):
+                size += max_outputs * FLOAT.size
+            self.buffers.append(bytearray(size))
+
+    def encode(self, group, values):
+        """ values is a sequence in the order of the group's fields.
+            Returns a memoryview into a buffer that is reused for the next packet of this group.
+        """
+        group_id = TELEMETRY_GROUP_IDS[group]
+        _, payload, fields = TELEMETRY_GROUPS[group_id]
+        buf = self.buffers[group_id]
+
+        self.seq = (self.seq + 1) % SEQ_MOD
+        TELEMETRY_HEADER.pack_into(buf, 0, TELEMETRY_MAGIC, TELEMETRY_VERSION, group_id, self.seq, time.time())
+
+        offset = TELEMETRY_HEADER.size
+        if fields[-1].endswith("[]"):
+            # Variable length group, e.g. one value per thruster
+            values = values[0]
+            payload.pack_into(buf, offset, len(values))
+            offset += payload.size
+            for v in values:
+                FLOAT.pack_into(buf, offset, v)
+                offset += FLOAT.size
+        else:
+            payload.pack_into(buf, offset, *values)
+            offset += payload.size
+
+        return memoryview(buf)[:offset]
+
+def is_telemetry(data):
+    return len(data) > 0 and data[0] == TELEMETRY_MAGIC
+
+def decode_telemetry(data):
+    """ Returns (group, seq, send_time, values) where values is a dict of the group's fields. """
+    if len(data) < TELEMETRY_HEADER.size:
+        raise PacketError("Telemetry packet too short")
+    magic, version, group_id, seq, send_time = TELEMETRY_HEADER.unpack_from(data)
+    if magic != TELEMETRY_MAGIC or version != TELEMETRY_VERSION or group_id >= len(TELEMETRY_GROUPS):
+        raise PacketError("Unsupported telemetry packet")
+
+    name, payload, fields = TELEMETRY_GROUPS[group_id]
+    offset = TELEMETRY_HEADER.size
+    try:
+        if fields[-1].endswith("[]"):
+            count, = payload.unpack_from(data, offset)
+            offset += payload.size
+            values = {fields[-1][:-2]: list(struct.unpack_from('<{}f'.format(count), data, offset))}
+        else:
+            values = dict(zip(fields, payload.unpack_from(data, offset)))
+    except struct.error as e:
+        raise PacketError(str(e))
+
+    return name, seq, send_time, values
+
+def encode_command(request_id, body):
+    """ Frames a JSON-serializable body. """
+    data = json.dumps(body).encode()
+    if len(data) > COMMAND_MAX_BODY:
+        raise PacketError("Command body is too long")
+    return COMMAND_HEADER.pack(COMMAND_MAGIC, len(data), request_id) + data
+
+class CommandReader:
+    """ Reassembles command frames from a TCP byte stream.
+        TCP may split or merge writes, so frames are only returned once complete.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """ Adds received bytes. Returns a list of (request_id, body) for complete frames.
+            Raises PacketError if the stream does not contain command frames.
+        """
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+
+        while len(buf) >= COMMAND_HEADER.size:
+            magic, length, request_id = COMMAND_HEADER.unpack_from(buf)
+            if magic != COMMAND_MAGIC:
+                raise PacketError("Lost command framing")
+
+            end = COMMAND_HEADER.size + length
+            if len(buf) < end:
+                break
+
+            try:
+                body = json.loads(buf[COMMAND_HEADER.size:end].decode())
+            except ValueError:
+                body = None # Reported to the sender by the caller
+            frames.append((request_id, body))
+            del buf[:end]
+
+        return frames
+
+if __name__ == "__main__":
+    """ Compare the cost of both formats on this machine. """
+    import json
+
+    COUNT = 100000
+    info = dict.fromkeys(AXES, 0.5)
+    encoder = ControlEncoder()
+    data = bytes(encoder.encode(info))
+
+    start = time.perf_counter()
+    for _ in range(COUNT):
+        decode_control(data, info)
+    binary = time.perf_counter() - start
+
+    data_json = json.dumps(info).encode()
+    start = time.perf_counter()
+    for _ in range(COUNT):
+        json.loads(data_json.decode())
+    text = time.perf_counter() - start
+
+    print("Binary: {} bytes, {:.0f} packets/s".format(len(data), COUNT / binary))
+    print("JSON:   {} bytes, {:.0f} packets/s".format(len(data_json), COUNT / text))
@@ -37,10 +37,21 @@ Arduino IDE : Select board "Arduino Pro or Pro Mini (3.3v, 8Mhz) w/ATmega328"
    "#t" - Output sensors in TEXT format (Output has the form "#ACC=-142.28,-5.38,33.52#GYR=-142.28,-5.38,33.52"
    followed by carriage return and line feed [\r\n]).
    "#a" - Output angle
+   "#c" - Start continuous stream of framed binary samples, one per sensor read (50Hz)
+   "#p" - Stop the continuous stream
+   "#r" - Stream raw sensor readings, before the calibration in sensors_fix (for test_tools/calibrate_imu.py)
+   "#f" - Stream calibrated readings (default)
 
    Newline characters are not required. So you can send #b#a to get sensor and angle data.
 
    Byte order of binary output is little-endian: least significant byte comes first.
+
+   Stream frames are laid out as:
+   0xA5 0x5A | length (1 byte) | flags (1 byte) | counter (2 bytes) | payload | checksum (1 byte)
+   The payload is acc, gyro, gyro temperature in C (7 floats, 28 bytes) and length is its size in bytes.
+   Bit 0 of flags is set when acc and gyro are raw readings (see "#r").
+   The counter increments with every sensor read, so gaps show dropped frames.
+   The checksum is the low byte of the sum of every byte from length to the end of the payload.
  */
 
 #define OUTPUT__BAUD_RATE 57600
@@ -55,6 +66,12 @@ Arduino IDE : Select board "Arduino Pro or Pro Mini (3.3v, 8Mhz) w/ATmega328"
 #define OUTPUT__FORMAT_TEXT 0 // Outputs data as text
 #define OUTPUT__FORMAT_BINARY 1 // Outputs data as binary float
 
+// Stream frame definitions (see above)
+#define STREAM_SYNC_1 0xA5
+#define STREAM_SYNC_2 0x5A
+#define STREAM_PAYLOAD_SIZE 28
+#define STREAM_FLAG_RAW 0x01
+
 // Values of gravity on the various axis, both + and -
 #define ACCEL_X_MIN -265
 #define ACCEL_X_MAX 256
@@ -91,9 +108,14 @@ struct Vector3 {
 };
 
 struct Vector3 accel, gyro, angle;
+struct Vector3 accel_raw, gyro_raw;
+float temperature;
 
 int output_format = OUTPUT__FORMAT_TEXT;
 int prev_time;
+bool stream_enabled = false;
+bool stream_raw = false;
+unsigned int sample_counter = 0;
 
 /**
  * modifies accel and gyro with all error_compensation.
@@ -115,8 +137,9 @@ void sensors_fix() {
 }
 
 void sensors_read() {
-    gyro = gyro_read();
-    accel = accel_read();
+    gyro_raw = gyro = gyro_read();
+    accel_raw = accel = accel_read();
+    temperature = gyro_temperature_read();
 
     sensors_fix();
 }
@@ -163,6 +186,41 @@ void sensors_output()
     }
 }
 
+// Writes bytes and adds them to the checksum
+void stream_write(const byte *data, int len, byte *checksum)
+{
+    Serial.write(data, len);
+    for (int i = 0; i < len; i++) {
+        *checksum += data[i];
+    }
+}
+
+// Writes the current sensor values as one stream frame
+void stream_output()
+{
+    byte checksum = 0;
+    struct Vector3 *accel_out = stream_raw ? &accel_raw : &accel;
+    struct Vector3 *gyro_out = stream_raw ? &gyro_raw : &gyro;
+    byte header[4] = {
+        STREAM_PAYLOAD_SIZE,
+        (byte) (stream_raw ? STREAM_FLAG_RAW : 0), // flags
+        (byte) (sample_counter & 0xFF),
+        (byte) (sample_counter >> 8)
+    };
+
+    Serial.write(STREAM_SYNC_1);
+    Serial.write(STREAM_SYNC_2);
+    stream_write(header, 4, &checksum);
+    stream_write((byte *) &accel_out->x, 4, &checksum);
+    stream_write((byte *) &accel_out->y, 4, &checksum);
+    stream_write((byte *) &accel_out->z, 4, &checksum);
+    stream_write((byte *) &gyro_out->x, 4, &checksum);
+    stream_write((byte *) &gyro_out->y, 4, &checksum);
+    stream_write((byte *) &gyro_out->z, 4, &checksum);
+    stream_write((byte *) &temperature, 4, &checksum);
+    Serial.write(checksum);
+}
+
 // Prints the current angle
 // This will be relative to initial starting orientation.
 void angle_output() {
@@ -224,6 +282,18 @@ void loop()
             case 'a':
                 angle_output();
                 break;
+            case 'c':
+                stream_enabled = true;
+                break;
+            case 'p':
+                stream_enabled = false;
+                break;
+            case 'r':
+                stream_raw = true;
+                break;
+            case 'f':
+                stream_raw = false;
+                break;
             default:
                 break;
         }
@@ -235,5 +305,10 @@ void loop()
         prev_time = curr_time;
         sensors_read();
         angle_update();
+        sample_counter++;
+
+        if (stream_enabled) {
+            stream_output();
+        }
     }
 }
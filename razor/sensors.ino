@@ -119,3 +119,25 @@ struct Vector3 gyro_read()
 
     return reading;
 }
+
+// Reads the gyro's die temperature in degrees C, which its bias drifts with
+float gyro_temperature_read()
+{
+    int i = 0;
+    uint8_t buff[2];
+
+    Wire.beginTransmission(GYRO_ADDRESS);
+    WIRE_SEND(0x1B);  // TEMP_OUT_H
+    Wire.endTransmission();
+
+    Wire.requestFrom(GYRO_ADDRESS, 2);
+    while (Wire.available()) {
+        buff[i++] = WIRE_RECEIVE();
+    }
+
+    if (i != 2) {
+        return temperature; // Keep the last reading
+    }
+    // ITG-3200: 280 LSB per degree, -13200 at 35C
+    return 35.0f + ((int16_t)((((uint16_t) buff[0]) << 8) | buff[1]) + 13200) / 280.0f;
+}
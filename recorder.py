@@ -0,0 +1,175 @@
+""" Flight recorder for the ROV control path.
+
+Records go into a fixed-size ring file through a shared memory map,
+so writing one costs no system calls. A background thread fsyncs the file
+each time a page fills up. After a crash or power loss, at most the
+page being written is lost.
+
+File layout:
+    header    HEADER, padded to HEADER_SIZE
+    records   capacity x RECORD
+Every record carries its sequence number, so readers can restore order
+after the ring wraps around. The sequence carries on across sessions, so it orders
+records even when the clock steps back between boots (the Pi has no RTC).
+"""
+import mmap
+import numpy
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'ROVREC01'
+HEADER = struct.Struct('<8sII')     # magic, record size, capacity
+HEADER_SIZE = 64
+RECORD = struct.Struct('<dIHH12f')  # time, seq, kind, number of values, values
+MAX_VALUES = 12
+SEQ_MOD = 1 << 32
+RECORD_DTYPE = numpy.dtype([('time', '<f8'), ('seq', '<u4'), ('kind', '<u2'),
+                            ('count', '<u2'), ('values', '<f4', (MAX_VALUES,))])
+
+# Kinds of records and the values they hold
+KIND_CONTROL = 1   # lx, ly, rx, ry, lt, rt, buttons
+KIND_IMU = 2       # ax, ay, az, gx, gy, gz
+KIND_PRESSURE = 3  # pressure (mbar), temperature (C), depth (m)
+KIND_OUTPUT = 4    # controller output, one value per DOF
+KIND_PWM = 5       # PWM ticks, one value per thruster
+KIND_NAMES = {
+    KIND_CONTROL: "control",
+    KIND_IMU: "imu",
+    KIND_PRESSURE: "pressure",
+    KIND_OUTPUT: "output",
+    KIND_PWM: "pwm",
+}
+
+class Recorder:
+    """ Appends records to a ring file. Reopening an existing file continues after its newest record. """
+    def __init__(self, path, capacity):
+        size = HEADER_SIZE + capacity * RECORD.size
+        self.capacity = capacity
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        existing = os.fstat(self.fd).st_size
+        if existing != size:
+            os.ftruncate(self.fd, 0) # Layout changed, start over
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+        self.seq = 0
+        if existing == size and self.map[:len(MAGIC)] == MAGIC:
+            self.seq = newest_seq(self.map, capacity) + 1
+        HEADER.pack_into(self.map, 0, MAGIC, RECORD.size, capacity)
+
+        # Structs for each number of values, so unused values don't need padding
+        self.structs = [struct.Struct('<dIHH{}f'.format(n)) for n in range(MAX_VALUES + 1)]
+        self.records_per_page = mmap.PAGESIZE // RECORD.size
+
+        self.page_done = threading.Event()
+        self.closed = False
+        self.flusher = threading.Thread(target=self.flush_pages, name="recorder")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def record(self, kind, values):
+        """ Appends a record of up to MAX_VALUES numbers. """
+        n = len(values)
+        offset = HEADER_SIZE + (self.seq % self.capacity) * RECORD.size
+        self.structs[n].pack_into(self.map, offset, time.time(), self.seq % SEQ_MOD, kind, n, *values)
+
+        self.seq += 1
+        if self.seq % self.records_per_page == 0:
+            self.page_done.set()
+
+    def flush_pages(self):
+        """ Runs on its own thread so the event loop never waits on the disk. """
+        while not self.closed:
+            self.page_done.wait()
+            self.page_done.clear()
+            if not self.closed:
+                os.fdatasync(self.fd)
+
+    def close(self):
+        self.closed = True
+        self.page_done.set()
+        self.flusher.join()
+        self.map.flush()
+        self.map.close()
+        os.close(self.fd)
+
+def seq_order(seqs):
+    """ Indices that sort sequence numbers oldest first, allowing for the u32 wrap.
+        The ring holds a run of consecutive numbers, so the oldest is the one after the largest gap.
+    """
+    seqs = numpy.asarray(seqs, numpy.int64)
+    ascending = numpy.argsort(seqs, kind='stable')
+    if len(seqs) < 2:
+        return ascending
+    ordered = seqs[ascending]
+    gaps = numpy.diff(ordered)
+    largest = int(numpy.argmax(gaps))
+    if gaps[largest] <= ordered[0] + SEQ_MOD - ordered[-1]:
+        return ascending # No wrap inside the run
+    return numpy.roll(ascending, -(largest + 1))
+
+def newest_seq(buf, capacity):
+    """ Sequence number of the newest record in a mapped ring file, or -1 if there is none. """
+    records = numpy.frombuffer(buf, RECORD_DTYPE, capacity, HEADER_SIZE)
+    written = records[records['kind'] != 0]
+    if not len(written):
+        return -1
+    return int(written['seq'][seq_order(written['seq'])[-1]])
+
+class FlightLog:
+    """ Reads a ring file written by Recorder into numpy arrays. """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, record_size, capacity = HEADER.unpack_from(data)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError("{} is not a flight recorder file".format(path))
+
+        records = numpy.frombuffer(data, RECORD_DTYPE, capacity, HEADER_SIZE)
+        records = records[records['kind'] != 0]
+
+        # Oldest first, by sequence number; the clock may have stepped back between sessions
+        self.records = records[seq_order(records['seq'])]
+
+    def export(self, start=None, end=None):
+        """ Returns {kind name: {"time": (N,), "values": (N, count)}} for records in [start, end].
+            start and end are seconds since the epoch, None for no limit.
+        """
+        records = self.records
+        if start is not None:
+            records = records[records['time'] >= start]
+        if end is not None:
+            records = records[records['time'] <= end]
+
+        result = {}
+        for kind, name in KIND_NAMES.items():
+            selected = records[records['kind'] == kind]
+            count = int(selected['count'].max()) if len(selected) else 0
+            result[name] = {
+                "time": numpy.array(selected['time']),
+                "values": numpy.array(selected['values'][:, :count], dtype=float),
+            }
+        return result
+
+if __name__ == "__main__":
+    """ Export a time range of a flight recording to a .npz file.
+        Usage: recorder.py FILE OUT.npz [START END]
+        START and END are seconds since the epoch.
+    """
+    import sys
+
+    log = FlightLog(sys.argv[1])
+    start = end = None
+    if len(sys.argv) > 4:
+        start, end = float(sys.argv[3]), float(sys.argv[4])
+
+    exported = log.export(start, end)
+    arrays = {}
+    for name, data in exported.items():
+        arrays[name + "_time"] = data["time"]
+        arrays[name + "_values"] = data["values"]
+        print("{}: {} records".format(name, len(data["time"])))
+    numpy.savez(sys.argv[2], **arrays)
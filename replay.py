@@ -0,0 +1,242 @@
+""" Replays flight recordings through the control path without the ROV.
+
+Control packets go through the deadzone and the thruster mix, IMU samples through
+HLController's estimator and its PID/LQR controller, and thruster signals land on a fake PCA9685.
+Timing follows the recording: the thrusters are driven when rov.py would have
+driven them in "event" mode, and the controller sees the recorded sample times.
+Runs as fast as possible, or paced to the recording with realtime=True.
+
+Usage: replay.py [--realtime] [--speed X] [--pid P I D] [--layout FILE] [--calibration FILE] OUT_DIR LOG...
+Writes OUT_DIR/<log name>.npz for every log, see Replay.run for the arrays.
+"""
+import argparse
+import numpy
+import os
+import time
+
+import control
+import hlcontroller
+import packets
+import recorder
+import devices.t100 as t100
+import devices.t100_curve as t100_curve
+from devices.fake_pca9685 import FakePCA9685
+
+# Defaults match rov.py
+CONTROLLER_DEADZONE = 0.2
+PACKET_TIMEOUT = 1.5    # secs
+THRUSTER_MAX_RATE = 10  # ms minimum between event driven thruster signals
+AUTO_RATE = 100         # ms between controller updates, THRUSTER_RATE in rov.py
+
+# Controller attributes recorded every tick, when the controller has them
+CONTROLLER_INTERNALS = ("integral", "derivative")
+
+class Replay:
+    """ The ROV's control path with a fake PWM sink.
+        Recorded control values already had the ROV's deadzone applied,
+        so only a larger deadzone changes anything.
+    """
+    def __init__(self, controller=None, layout=None, deadzone=CONTROLLER_DEADZONE,
+                 timeout=PACKET_TIMEOUT, max_rate=THRUSTER_MAX_RATE, auto_rate=AUTO_RATE, calibration=None):
+        self.pwm = FakePCA9685()
+        self.thrusters = t100.Thrusters(self.pwm, layout, calibration)
+        self.hl_controller = hlcontroller.HLController(controller or hlcontroller.PID())
+        self.deadzone = deadzone
+        self.timeout = timeout
+        self.max_rate = max_rate / 1000.0
+        self.auto_rate = auto_rate / 1000.0
+        self.info = dict.fromkeys(packets.AXES, 0.0)
+
+    def run(self, records, realtime=False, speed=1.0):
+        """ Feeds records in the order written (FlightLog.records) through the control path.
+            Returns a dict of arrays:
+                drive_time, drive_command (N, DOF), drive_outputs, drive_signals (N, thrusters), drive_timed_out
+                controller_time, controller_dt, controller_acceleration, controller_orientation,
+                controller_position, controller_velocity, controller_output, controller_<internal>
+                pressure_time, pressure_values
+                recorded_pwm_time, recorded_pwm_values   PWM the ROV actually sent, for comparison
+        """
+        kinds = records['kind']
+        n_control = int((kinds == recorder.KIND_CONTROL).sum())
+        n_imu = int((kinds == recorder.KIND_IMU).sum())
+        self.allocate(2 * n_control + 1, n_imu)
+        result = {}
+
+        times = records['time'].tolist()
+        kinds = kinds.tolist()
+        values = records['values'].astype(float)
+        counts = records['count'].tolist()
+        if not times:
+            return self.arrays(result)
+
+        start_wall = time.monotonic()
+        start_time = times[0]
+        last_packet = None
+        timeout_driven = True
+        self.last_drive = float("-inf")
+        self.drive_due = None
+        next_auto = start_time
+        self.hl_controller.time = start_time - self.auto_rate
+        pressure, recorded_pwm = [], []
+
+        for i, t in enumerate(times):
+            if realtime:
+                delay = start_wall + (t - start_time) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            # Drives the ROV would have made before this record
+            if self.drive_due is not None and self.drive_due <= t:
+                self.drive(self.drive_due, False)
+            if not timeout_driven and t - last_packet > self.timeout:
+                # manual_loop notices the timeout on its next poll; assume right away
+                self.drive(last_packet + self.timeout, True)
+                timeout_driven = True
+
+            kind = kinds[i]
+            if kind == recorder.KIND_CONTROL:
+                for axis, value in zip(packets.AXES, values[i]):
+                    self.info[axis] = value
+                control.apply_deadzone(self.info, self.deadzone)
+                last_packet = t
+                timeout_driven = False
+                if self.drive_due is None:
+                    if t - self.last_drive >= self.max_rate:
+                        self.drive(t, False)
+                    else:
+                        self.drive_due = self.last_drive + self.max_rate
+
+            elif kind == recorder.KIND_IMU:
+                self.hl_controller.observe_imu(t, values[i, :3], values[i, 3:6])
+                if t >= next_auto:
+                    next_auto = t + self.auto_rate
+                    self.update_controller(t)
+
+            elif kind == recorder.KIND_PRESSURE:
+                self.hl_controller.observe_depth(t, values[i, 2])
+                pressure.append(i)
+            elif kind == recorder.KIND_PWM:
+                recorded_pwm.append(i)
+
+        if self.drive_due is not None:
+            self.drive(self.drive_due, False)
+
+        result["pressure_time"] = records['time'][pressure]
+        result["pressure_values"] = values[pressure, :3]
+        width = max([counts[i] for i in recorded_pwm] or [0])
+        result["recorded_pwm_time"] = records['time'][recorded_pwm]
+        result["recorded_pwm_values"] = values[recorded_pwm, :width]
+        return self.arrays(result)
+
+    def allocate(self, drives, updates):
+        """ Preallocates per-tick arrays for at most drives and updates ticks. """
+        thrusters = len(self.thrusters.pins)
+        self.drives = 0
+        self.drive_time = numpy.empty(drives)
+        self.drive_command = numpy.empty((drives, len(t100.DOF)))
+        self.drive_outputs = numpy.empty((drives, thrusters))
+        self.drive_signals = numpy.empty((drives, thrusters), int)
+        self.drive_timed_out = numpy.empty(drives, bool)
+
+        self.updates = 0
+        self.controller_time = numpy.empty(updates)
+        self.controller_dt = numpy.empty(updates)
+        self.controller_acceleration = numpy.empty((updates, 3))
+        self.controller_orientation = numpy.empty((updates, 3))
+        self.controller_position = numpy.empty((updates, 3))
+        self.controller_velocity = numpy.empty((updates, 3))
+        self.controller_output = None   # Sized by the first output
+        self.controller_internals = {}
+
+    def drive(self, t, timed_out):
+        thrusters = self.thrusters
+        control.manual_command(thrusters, self.info, timed_out)
+        thrusters.drive()
+
+        n = self.drives
+        self.drive_time[n] = t
+        self.drive_command[n] = thrusters.command
+        self.drive_outputs[n] = thrusters.outputs
+        self.drive_signals[n] = thrusters.signals
+        self.drive_timed_out[n] = timed_out
+        self.drives += 1
+
+        self.last_drive = t
+        self.drive_due = None
+
+    def update_controller(self, t):
+        hl = self.hl_controller
+        n = self.updates
+        self.controller_dt[n] = t - hl.time
+        output = numpy.asarray(hl.update(t), float)
+
+        if self.controller_output is None:
+            size = len(self.controller_time)
+            self.controller_output = numpy.empty((size,) + output.shape)
+            for name in CONTROLLER_INTERNALS:
+                if hasattr(hl.controller, name):
+                    self.controller_internals[name] = numpy.empty((size,) + output.shape)
+
+        self.controller_time[n] = t
+        self.controller_acceleration[n] = hl.estimator.acceleration
+        self.controller_orientation[n] = hl.rotation
+        self.controller_position[n] = hl.position
+        self.controller_velocity[n] = hl.velocity
+        self.controller_output[n] = output
+        for name, column in self.controller_internals.items():
+            column[n] = getattr(hl.controller, name)
+        self.updates += 1
+
+    def arrays(self, result):
+        """ Trims the per-tick arrays to the ticks that happened. """
+        n = self.drives
+        result["drive_time"] = self.drive_time[:n]
+        result["drive_command"] = self.drive_command[:n]
+        result["drive_outputs"] = self.drive_outputs[:n]
+        result["drive_signals"] = self.drive_signals[:n]
+        result["drive_timed_out"] = self.drive_timed_out[:n]
+
+        n = self.updates
+        result["controller_time"] = self.controller_time[:n]
+        result["controller_dt"] = self.controller_dt[:n]
+        result["controller_acceleration"] = self.controller_acceleration[:n]
+        result["controller_orientation"] = self.controller_orientation[:n]
+        result["controller_position"] = self.controller_position[:n]
+        result["controller_velocity"] = self.controller_velocity[:n]
+        if self.controller_output is not None:
+            result["controller_output"] = self.controller_output[:n]
+        for name, column in self.controller_internals.items():
+            result["controller_" + name] = column[:n]
+        return result
+
+def replay(path, controller=None, layout=None, realtime=False, speed=1.0, **options):
+    """ Replays one recorder file. options are passed on to Replay. """
+    log = recorder.FlightLog(path)
+    return Replay(controller, layout, **options).run(log.records, realtime, speed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay flight recordings through the control path.")
+    parser.add_argument("out_dir")
+    parser.add_argument("logs", nargs="+")
+    parser.add_argument("--realtime", action="store_true", help="pace the replay to the recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed with --realtime")
+    parser.add_argument("--pid", type=float, nargs=3, metavar=("P", "I", "D"))
+    parser.add_argument("--layout", help="thruster layout file, see t100.load_layout")
+    parser.add_argument("--calibration", help="thrust calibration file, see t100_curve.load_calibration")
+    args = parser.parse_args()
+
+    layout = t100.load_layout(args.layout) if args.layout else None
+    calibration = t100_curve.load_calibration(args.calibration) if args.calibration else None
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    start = time.perf_counter()
+    for path in args.logs:
+        controller = hlcontroller.PID(p=args.pid[0], i=args.pid[1], d=args.pid[2]) if args.pid else None
+        result = replay(path, controller, layout, args.realtime, args.speed, calibration=calibration)
+
+        name = os.path.splitext(os.path.basename(path))[0]
+        numpy.savez(os.path.join(args.out_dir, name + ".npz"), **result)
+        print("{}: {} drives, {} controller updates".format(
+            path, len(result["drive_time"]), len(result["controller_time"])))
+    print("Replayed {} logs in {:.2f}s".format(len(args.logs), time.perf_counter() - start))
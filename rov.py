@@ -1,34 +1,79 @@
 #!/usr/bin/env python3
 """ Logic for the ROV.
 """
+import time
+started = time.monotonic() # Before the other imports, so the startup timeline counts them
+
 import asyncio
 import json
-import serial
+import numpy
+import os
 import signal
 import socket
 import sys
-import time
-import Adafruit_PCA9685
+import control
+from asyncio_compat import coroutine, ensure_future
 import hlcontroller
+import packets
+import recorder
+import scheduler
+import startup
+import stats
 
 import devices.ms5837 as ms5837 # Temp & Pressure sensor
-from devices.imu import IMU
+from devices.imu import IMUStream
+from devices.imu_calibration import Calibration
 from devices.light import Light
+import devices.t100 as t100
+import devices.t100_curve as t100_curve
 from devices.t100 import Thrusters
 
-# Converts the IMU's unit to m/s
-ACCEL_CONVERSION = 9.8 / 256
-
 SERIAL_DEV = '/dev/ttyUSB0'
 SERIAL_BAUD = 57600
 LOCAL_ADDR="192.168.0.15"
 PORT=30002
 THRUSTER_RATE=100     # ms between each thruster signal. 50 = 20 signals/s
+THRUSTER_MODE = "event" # "event" drives on every accepted packet, "poll" drives every THRUSTER_RATE
+CONTROL_RATE = 100      # ms between controller updates from the state estimate
+THRUSTER_MAX_RATE = 10  # ms minimum between event driven thruster signals
 PWM_FREQ = 48
 CONTROLLER_DEADZONE=0.2
 LIGHT_PIN = 15
 PACKET_TIMEOUT = 1.5 # secs before stop moving
+PRESSURE_RATE = 5     # pressure/temperature samples per second
+PRESSURE_OSR = ms5837.OSR_8192
+# ms between telemetry datagrams of each field group, None turns a group off
+TELEMETRY_RATES = {
+    "pressure" : 500,
+    "imu" : 100,
+    "thrusters" : 100,
+    "status" : 1000,
+}
 # Pins for thrusters are defined in the thruster module; Sorry! it's 8 pins!
+# They can be overridden without code edits by this file. See t100.load_layout for the format.
+THRUSTER_LAYOUT = "thrusters.json"
+# Measured thrust curves of individual thrusters, see t100_curve. The published curve is used without it.
+THRUSTER_CALIBRATION = "thrust_calibration.json"
+# IMU bias, scale and gyro temperature drift from test_tools/calibrate_imu.py, applied here to raw readings.
+# The firmware's own calibration is used without it.
+IMU_CALIBRATION = "imu_calibration.json"
+# LQR gains over (depth, speed), see hlcontroller.GainSchedule. Used instead of solving when the file exists.
+LQR_SCHEDULE = "lqr_schedule.npz"
+STAGE_PROBES = False # Time each stage from packet receive to PWM write, see the stats command
+# Run the IMU and pressure drivers in worker processes that share samples through memory,
+# so blocking serial and I2C reads can't stall this loop. See sensorproc.py.
+SENSOR_PROCESSES = False
+SENSOR_POLL_RATE = 10 # ms between reads of the workers' samples
+# secs a sensor may take to come up before it is reported degraded. The ROV runs without it meanwhile.
+IMU_START_TIMEOUT = 3.0
+IMU_RETRY_DELAY = 0.5 # secs before reopening the IMU after it failed, doubled after every failure in a row
+IMU_RETRY_MAX = 30.0  # secs, cap on the retry delay
+PRESSURE_START_TIMEOUT = 1.0
+# Flight recorder ring file; None turns recording off.
+# Holds about RECORDER_RETENTION secs at RECORDER_RATE records/s before wrapping.
+RECORDER_PATH = "flight.rec"
+RECORDER_RETENTION = 600
+RECORDER_RATE = 200
 
 # Updated by handle_data method
 controller_info = {
@@ -39,114 +84,286 @@ controller_info = {
     "lt" : 0.0,
     "rt" : 0.0,
 }
-hlcontroller = hlcontroller.HLController(hlcontroller.PID())
+hl_controller = hlcontroller.HLController(hlcontroller.PID())
 autonomy = False
 prev_packet_time = 0
+packet_arrival = None   # monotonic receive time of the newest packet not yet driven
+last_drive_time = 0
+drive_handle = None
+link_stats = stats.LinkStats()
+imu_stream = None
+pressure_sampler = None
+sensors = None          # sensorproc.Supervisor with SENSOR_PROCESSES
+station_addr = None     # Telemetry goes to wherever control packets come from
+drive_latency = stats.Histogram() # ms from packet receive to PWM write
+loops = scheduler.Scheduler()     # Fixed-rate loops; each one declares its rate
+stage_probe = stats.StageProbe(("decode", "accept", "deadzone", "record", "queue", "mix", "pwm"), STAGE_PROBES)
+flight_recorder = None
+lqr_schedule = None
+timeline = startup.Startup(started)
 
 class UDP:
     """Implement callbacks for asyncio transports
        Used to update controller_info
     """
-    def __init__(self, loop, pwm):
+    def __init__(self, loop, pwm, thrusters):
         self.loop = loop
         self.pwm = pwm
+        self.thrusters = thrusters
+        self.packet_info = dict(controller_info) # Binary packets are decoded here first
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        global prev_packet_time
+        global prev_packet_time, packet_arrival, station_addr
 
-        data_json = data.decode()
+        arrival = time.monotonic()
+        stage_probe.begin()
         try:
-            data = json.loads(data_json)
+            if packets.is_binary(data):
+                seq, send_time, buttons = packets.decode_control(data, self.packet_info)
+                data = self.packet_info
+            else:
+                data = json.loads(data.decode())
+                seq, send_time = data.get("seq"), data.get("time")
+                buttons = 0
+            stage_probe.mark("decode")
+
+            # Packets from old stations carry no sequence number; apply them as they come.
+            if seq is not None and not link_stats.accept(seq, send_time):
+                stage_probe.cancel()
+                return
+            stage_probe.mark("accept")
+
             handle_udpdata(data, self.loop, self.pwm)
+            stage_probe.mark("deadzone")
+            if flight_recorder:
+                flight_recorder.record(recorder.KIND_CONTROL,
+                                       [controller_info[axis] for axis in packets.AXES] + [buttons])
+            stage_probe.mark("record")
             prev_packet_time = time.time()
-        except json.JSONDecodeError:
+            packet_arrival = arrival
+            station_addr = addr
+
+            if autonomy:
+                stage_probe.cancel() # The packet won't drive the thrusters
+            elif THRUSTER_MODE == "event":
+                request_drive(self.loop, self.thrusters)
+        except (ValueError, UnicodeDecodeError):
+            # Covers packets.PacketError and json.JSONDecodeError
+            stage_probe.cancel()
             print("Received invalid packet.")
-            pass    # Ignore non JSON packets
-        except e:
+            pass    # Ignore malformed packets
+        except Exception as e:
+            stage_probe.cancel()
             print(e)
 
     def error_received(self, exc):
         print('UDP connection error:', exc)
 
+    def connection_lost(self, exc):
+        pass # Closed on shutdown
+
 def handle_udpdata(data, loop, pwm):
-    """Parses JSON from UDP packets.
-    Adds data to global variable.
+    """Copies a decoded control packet into the global controller_info.
     """
     global controller_info
 
-    controller_info = data
-
-    # DEADZONE
-    if abs(controller_info["lx"]) < CONTROLLER_DEADZONE:
-        controller_info["lx"] = 0
-    if abs(controller_info["ly"]) < CONTROLLER_DEADZONE:
-        controller_info["ly"] = 0
-    if abs(controller_info["rx"]) < CONTROLLER_DEADZONE:
-        controller_info["rx"] = 0
-    if abs(controller_info["ry"]) < CONTROLLER_DEADZONE:
-        controller_info["ry"] = 0
+    controller_info.update(data)
+    control.apply_deadzone(controller_info, CONTROLLER_DEADZONE)
 
 class TCP(asyncio.Protocol):
     """ Implement callbacks for asyncio transports.
         This will be used to send receive info from the ROV, i.e. temperature data
+        Commands arrive as frames (see packets.py) and are answered by request id.
+        Stations that send bare strings ("temp", "pid{...}") get the old plain replies.
     """
-    def __init__(self, pwm):
+    def __init__(self, loop, pwm, thrusters):
+        self.loop = loop
         self.pwm = pwm
+        self.thrusters = thrusters
+        self.reader = packets.CommandReader()
+        self.legacy = None  # Decided by the first byte received
+        self.connected = False
 
     def connection_made(self, transport):
         peername = transport.get_extra_info('peername')
         print('Connection from {}'.format(peername))
         self.transport = transport
+        self.connected = True
+
+    def connection_lost(self, exc):
+        self.connected = False
 
     def data_received(self, data):
-        global autonomy
+        if self.legacy is None:
+            self.legacy = data[0] != packets.COMMAND_MAGIC
+        if self.legacy:
+            self.legacy_received(data.decode())
+            return
 
-        data = data.decode()
-        if data == 'temp':
-            pressure, temp = get_temp()
-            self.transport.write("T: {}°C, P: {} mbar".format(temp, pressure).encode())
-        elif data == 'light':
-            light_toggle(self.pwm)
-        elif data == 'auto':
-            autonomy = not autonomy
-        elif data.startswith('pid'):
-            pid_values = json.loads(data[3:])
-            pid = hlcontroller.PID(p=pid_values['p'], i=pid_values['i'], d=pid_values['d'])
-            hlcontroller.change_controller(pid)
-        elif data.startswith('lqr'):
-            lqr_values = json.loads(data[3:])
-            q = numpy.identity(lqr_values['q'])
-            r = numpy.identity(lqr_values['r'])
-            lqr = hlcontroller.LQR(q=q, r=r)
-            hlcontroller.change_controller(lqr)
+        try:
+            frames = self.reader.feed(data)
+        except packets.PacketError as e:
+            print('TCP framing error:', e)
+            self.transport.close()
+            return
+
+        for request_id, body in frames:
+            try:
+                result = self.run_command(body["cmd"], body.get("args") or {})
+            except Exception as e:
+                self.reply(request_id, error=e)
+                continue
+
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                # Slow commands reply when done; later requests are answered meanwhile
+                future = ensure_future(result)
+                future.add_done_callback(lambda f, request_id=request_id: self.reply_future(request_id, f))
+            else:
+                self.reply(request_id, result)
+
+    def reply(self, request_id, result=None, error=None):
+        if error is None:
+            body = {"ok": True, "result": result}
+        else:
+            body = {"ok": False, "error": "{}: {}".format(type(error).__name__, error)}
+        if self.connected:
+            self.transport.write(packets.encode_command(request_id, body))
+
+    def reply_future(self, request_id, future):
+        if future.cancelled():
+            self.reply(request_id, error=asyncio.CancelledError())
+        elif future.exception() is not None:
+            self.reply(request_id, error=future.exception())
+        else:
+            self.reply(request_id, future.result())
+
+    def run_command(self, name, args):
+        handler = getattr(self, "cmd_" + name, None)
+        if handler is None:
+            raise KeyError("Unknown command {}".format(name))
+        return handler(**args)
+
+    def legacy_received(self, data):
+        """ Plain string commands from stations that predate framing. """
+        if data.startswith('pid') or data.startswith('lqr'):
+            name, args = data[:3], json.loads(data[3:])
+        else:
+            words = data.split()
+            name, args = words[0], {"reset": True} if words[1:] == ['reset'] else {}
+
+        try:
+            result = self.run_command(name, args)
+        except Exception as e:
+            print('Command {} failed: {}'.format(data, e))
+            return
+
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            ensure_future(result) # Old stations never got a reply to these
+            return
+        if name == 'temp':
+            self.transport.write("T: {temperature}°C, P: {pressure} mbar".format(**result).encode())
+        elif result is not None:
+            self.transport.write(json.dumps(result).encode())
+
+    def cmd_temp(self):
+        pressure, temp = get_temp()
+        if pressure is None:
+            raise RuntimeError("Pressure sensor has no reading yet.")
+        return {"pressure": pressure, "temperature": temp}
+
+    def cmd_light(self):
+        light_toggle(self.pwm)
+
+    def cmd_auto(self):
+        global autonomy
+        autonomy = not autonomy
+        return autonomy
+
+    def cmd_link(self, reset=False):
+        if reset:
+            link_stats.reset()
+            return None
+        return link_stats.summary()
+
+    def cmd_latency(self, reset=False):
+        if reset:
+            drive_latency.reset()
+            return None
+        return drive_latency.summary()
+
+    def cmd_stats(self, reset=False, enable=None):
+        """ Everything the ROV measures about itself in one reply.
+            enable turns the per-stage probes on or off.
+        """
+        if enable is not None:
+            stage_probe.enable(enable)
+        if reset:
+            link_stats.reset()
+            drive_latency.reset()
+            self.thrusters.writer.reset_counters()
+            loops.reset()
+            stage_probe.reset()
+            if sensors:
+                sensors.reset()
+            return None
+        return {
+            "link": link_stats.summary(),
+            "latency": drive_latency.summary(),
+            "pwm": self.thrusters.writer.summary(),
+            "loops": loops.summary(),
+            "stages": stage_probe.summary(),
+            "sensors": sensors.summary() if sensors else None,
+            "startup": timeline.summary(),
+        }
+
+    def cmd_loops(self, reset=False):
+        if reset:
+            loops.reset()
+            return None
+        return loops.summary()
+
+    def cmd_pwm(self, reset=False):
+        if reset:
+            self.thrusters.writer.reset_counters()
+            return None
+        return self.thrusters.writer.summary()
+
+    def cmd_pid(self, p, i, d):
+        pid = hlcontroller.PID(p=p, i=i, d=d)
+        hl_controller.update_controller(pid)
+
+    @coroutine
+    def cmd_lqr(self, q, r):
+        """ Solves the gain in a worker thread so the event loop keeps running.
+            Gains solved before are reused straight away. With a gain schedule loaded
+            the gain comes from the schedule instead, so nothing is solved.
+        """
+        Q, R = q * numpy.identity(6), r * numpy.identity(6)
+        K = None
+        if lqr_schedule is None:
+            A, B = hlcontroller.plant_model(CONTROL_RATE / 1000.0)
+            K = hlcontroller.cached_gain(A, B, Q, R)
+            if K is None:
+                K = yield from self.loop.run_in_executor(None, hlcontroller.solve_gain, A, B, Q, R)
+
+        hl_controller.update_controller(hlcontroller.LQR(q=Q, r=R, K=K, schedule=lqr_schedule))
+        return {"scheduled": lqr_schedule is not None}
 
     def error_received(self, exc):
         print('TCP connection error:', exc)
 
 def get_temp():
-    """ Gets temperature and sends the information into the socket.
-        temp_bar and sock are static variables.
+    """ Returns the latest pressure (mbar) and temperature (°C) from the background sampler.
+        Both are None until the first reading completes.
     """
-    try:
-        bar = get_temp.temp_bar
-    except AttributeError:
-        # This was the first time this function was run.
-        # Initialize all static vars.
-        print("Initializing temperature bar.")
-        get_temp.temp_bar = ms5837.MS5837()
-        if not get_temp.temp_bar.init():
-            print("Sensor failed to initialize")
-        bar = get_temp.temp_bar
-
-    bar.read()
+    reading = pressure_sampler.latest if pressure_sampler else None
+    if reading is None:
+        return None, None
 
-    pressure = bar.pressure(ms5837.UNITS_mbar)
-    temp = bar.temperature(ms5837.UNITS_Centigrade)
-
-    return pressure, temp
+    return reading.pressure, reading.temperature
 
 def light_toggle(pwm):
     try:
@@ -159,46 +376,123 @@ def light_toggle(pwm):
 
     light.toggle()
 
-@asyncio.coroutine
+def manual_drive(thrusters):
+    """ Mixes controller_info into thruster weights and sends them out. """
+    global packet_arrival, last_drive_time
+
+    stage_probe.mark("queue")
+    timed_out = time.time() - prev_packet_time > PACKET_TIMEOUT
+    control.manual_command(thrusters, controller_info, timed_out)
+    thrusters.mix()
+    stage_probe.mark("mix")
+    thrusters.write()
+    stage_probe.mark("pwm")
+    stage_probe.end()
+    if flight_recorder:
+        flight_recorder.record(recorder.KIND_PWM, thrusters.signals)
+
+    last_drive_time = time.monotonic()
+    if packet_arrival is not None:
+        drive_latency.add((last_drive_time - packet_arrival) * 1000.0)
+        packet_arrival = None
+
+def request_drive(loop, thrusters):
+    """ Drives the thrusters now, or as soon as THRUSTER_MAX_RATE allows.
+        A deferred drive uses whatever controller_info holds when it fires,
+        so bursts of packets collapse into one update.
+    """
+    global drive_handle
+
+    if drive_handle is not None:
+        return
+
+    wait = last_drive_time + THRUSTER_MAX_RATE / 1000.0 - time.monotonic()
+    if wait <= 0:
+        manual_drive(thrusters)
+    else:
+        drive_handle = loop.call_later(wait, deferred_drive, thrusters)
+
+def deferred_drive(thrusters):
+    global drive_handle
+
+    drive_handle = None
+    if not autonomy:
+        manual_drive(thrusters)
+    else:
+        stage_probe.cancel()
+
+@coroutine
 def manual_loop(interval, thrusters):
-    """ Reads controller_info and sends the proper command to ThrusterControl library. """
+    """ Reads controller_info and sends the proper command to ThrusterControl library.
+        In event mode packets drive the thrusters themselves,
+        so this only stops them once packets time out.
+    """
     global controller_info, autonomy, prev_packet_time
+    ticker = loops.ticker("thrusters", interval)
 
     while True:
-        yield from asyncio.sleep(interval / 1000.0)
+        yield from ticker.wait()
         if not autonomy:
-            curr_time = time.time()
-            thrusters.move_horizontal(controller_info["lx"])
-            thrusters.move_forward(controller_info["ly"])
-            thrusters.move_vertical(controller_info["lt"] - controller_info["rt"])
-            thrusters.move_yaw(-controller_info["rx"]) # Flipped to map xbox state to ROV coordinate
-            thrusters.move_pitch(controller_info["ry"])
-
-            if curr_time - prev_packet_time > PACKET_TIMEOUT:
-                thrusters.clear_weights()
-            thrusters.drive()
-
-def remove_gravity(accel):
-    """ Remove gravity from accelerometer output
-        Ideally using the gyro to calculate gravity
+            timed_out = time.time() - prev_packet_time > PACKET_TIMEOUT
+            if THRUSTER_MODE != "event" or timed_out:
+                manual_drive(thrusters)
+
+@coroutine
+def open_imu(imu_ready, reopen):
+    """ The IMU stream from imu_ready. If it fails, reopen() is tried with a growing delay until a stream opens.
+        Without reopen, gives up and returns None.
     """
-    accel[2] - 256.0
-    return accel
-
-@asyncio.coroutine
-def auto_loop(interval, thrusters):
-    """ Constantly updates controller with IMU data.
+    delay = IMU_RETRY_DELAY
+    while True:
+        try:
+            return (yield from imu_ready)
+        except OSError as e:
+            if reopen is None:
+                print("Running without the IMU:", e)
+                return None
+            print("IMU failed to open ({}), retrying in {}s".format(e, delay))
+        yield from asyncio.sleep(delay)
+        delay = min(IMU_RETRY_MAX, delay * 2)
+        imu_ready = reopen()
+
+@coroutine
+def auto_loop(interval, thrusters, imu_ready, reopen=None):
+    """ Feeds every IMU sample to the state estimator and updates the controller at interval.
+        Without an IMU stream yet, waits for imu_ready to open one.
+        A stream that fails or closes is opened again with reopen(), a coroutine like IMUStream.open;
+        without reopen, e.g. for sensorproc, which restarts its own workers, the loop gives up.
     """
-    global hlcontroller
-    imu = IMU(SERIAL_DEV, SERIAL_BAUD)
+    global hl_controller, imu_stream
+    prev_sample = None
+    ticker = loops.ticker("control", interval)
 
     while True:
-        yield from asyncio.sleep(interval / 1000.0)
-
-        accel, mag, gyro = imu.get_sensors()
-        accel = remove_gravity(accel)
-
-        weights = hlcontroller.update(accel, gyro)
+        if imu_stream is None:
+            imu_stream = yield from open_imu(imu_ready, reopen)
+            if imu_stream is None:
+                return
+            imu_stream.on_sample(lambda sample: hl_controller.observe_imu(sample.time, sample.accel, sample.gyro))
+            if flight_recorder:
+                imu_stream.on_sample(lambda sample: flight_recorder.record(
+                    recorder.KIND_IMU, tuple(sample.accel) + tuple(sample.gyro)))
+
+        yield from ticker.wait()
+
+        if reopen is not None and imu_stream.closed.done():
+            print("IMU stream stopped ({}), reopening".format(imu_stream.closed.exception()))
+            imu_stream = None
+            imu_ready = reopen()
+            continue
+
+        # The stream fills in samples in the background; only use new ones
+        sample = imu_stream.latest
+        if sample is None or sample is prev_sample:
+            continue
+        prev_sample = sample
+
+        weights = hl_controller.update()
+        if flight_recorder:
+            flight_recorder.record(recorder.KIND_OUTPUT, weights)
 
         if autonomy:
             pass
@@ -211,37 +505,167 @@ def auto_loop(interval, thrusters):
 
         #thrusters.drive()
 
-        #print("Acc: {}".format(accel))
-        #print("Vel: {}".format(hlcontroller.velocity * ACCEL_CONVERSION))
-        #print("Pos: {}".format(hlcontroller.position * ACCEL_CONVERSION))
-
-if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
+        #print("Acc: {}".format(hl_controller.estimator.acceleration))
+        #print("Vel: {}".format(hl_controller.velocity))
+        #print("Pos: {}".format(hl_controller.position))
+
+def telemetry_values(group, thrusters):
+    """ Returns the current values of a telemetry group, or None if they are not available yet. """
+    if group == "pressure":
+        reading = pressure_sampler.latest if pressure_sampler else None
+        if reading:
+            return (reading.pressure, reading.temperature, reading.depth)
+    elif group == "imu":
+        sample = imu_stream.latest if imu_stream else None
+        if sample:
+            return tuple(sample.accel) + tuple(sample.gyro)
+    elif group == "thrusters":
+        return (thrusters.outputs,)
+    elif group == "status":
+        delay = link_stats.delay.percentile(50)
+        return (autonomy, link_stats.accepted, link_stats.lost, link_stats.late,
+                link_stats.jitter, delay if delay is not None else 0.0)
+    return None
+
+@coroutine
+def sensor_loop(interval):
+    """ Hands samples from the sensor workers to their consumers and restarts failed workers. """
+    ticker = loops.ticker("sensors", interval)
 
-    # Init pi hat
-    pwm = Adafruit_PCA9685.PCA9685()
-    pwm.set_pwm_freq(PWM_FREQ) # 50 Hz is good for servo
+    while True:
+        yield from ticker.wait()
+        sensors.poll()
+
+@coroutine
+def telemetry_loop(transport, thrusters):
+    """ Pushes each telemetry group to the station at its rate in TELEMETRY_RATES. """
+    encoder = packets.TelemetryEncoder()
+    rates = dict((group, rate) for group, rate in TELEMETRY_RATES.items() if rate)
+    if not rates:
+        return
+    # Every group goes out on a multiple of the fastest group's ticks
+    tick = min(rates.values())
+    every = dict((group, max(1, int(round(rate / tick)))) for group, rate in rates.items())
+    ticker = loops.ticker("telemetry", tick)
 
-    # Init lights and thrusters
-    Light(pwm, LIGHT_PIN).set_on() # We drop the class
-    thrusters = Thrusters(pwm)
+    while True:
+        yield from ticker.wait()
+        if station_addr is None:
+            continue
+
+        for group in rates:
+            if (ticker.ticks - 1) % every[group]:
+                continue
+
+            values = telemetry_values(group, thrusters)
+            if values is not None:
+                transport.sendto(encoder.encode(group, values), station_addr)
+
+def start(loop, pwm, pressure_bus=1):
+    """ Brings up the thrusters, servers and sensors on loop, in that order.
+        The thrusters go to neutral and commands are accepted before any sensor is touched;
+        sensors come up in the background, and the ROV runs without the ones that are late or fail.
+        pwm is the PiHat's Adafruit_PCA9685.PCA9685, or a stand-in with the same methods,
+        and pressure_bus an I2C bus number or SMBus-like object for the pressure sensor.
+        Returns (udp transport, tcp server, tasks).
+    """
+    global imu_stream, pressure_sampler, sensors, flight_recorder, lqr_schedule
+
+    # Thrusters first: the ESCs arm on a neutral signal
+    layout = None
+    if os.path.exists(THRUSTER_LAYOUT):
+        print("Loading thruster layout from {}".format(THRUSTER_LAYOUT))
+        layout = t100.load_layout(THRUSTER_LAYOUT)
+    calibration = None
+    if os.path.exists(THRUSTER_CALIBRATION):
+        print("Loading thruster calibration from {}".format(THRUSTER_CALIBRATION))
+        calibration = t100_curve.load_calibration(THRUSTER_CALIBRATION)
+    thrusters = Thrusters(pwm, layout, calibration, PWM_FREQ)
+    timeline.mark("thrusters neutral")
 
     # Init UDP Server
     udp_serv = loop.create_datagram_endpoint(
-        lambda: UDP(loop, pwm),
+        lambda: UDP(loop, pwm, thrusters),
         local_addr = (LOCAL_ADDR, PORT))
     transport, protocol = loop.run_until_complete(udp_serv)
 
     # Init TCP Server
-    tcp_serv = loop.create_server(lambda: TCP(pwm), LOCAL_ADDR, PORT)
+    tcp_serv = loop.create_server(lambda: TCP(loop, pwm, thrusters), LOCAL_ADDR, PORT)
     server = loop.run_until_complete(tcp_serv)
+    timeline.mark("accepting commands")
+
+    Light(pwm, LIGHT_PIN).set_on() # We drop the class
+    if os.path.exists(LQR_SCHEDULE):
+        print("Loading LQR gain schedule from {}".format(LQR_SCHEDULE))
+        lqr_schedule = hlcontroller.GainSchedule.load(LQR_SCHEDULE)
+    if RECORDER_PATH:
+        flight_recorder = recorder.Recorder(RECORDER_PATH, RECORDER_RETENTION * RECORDER_RATE)
+
+    # Sample the sensors in the background
+    imu_calibration = None
+    if os.path.exists(IMU_CALIBRATION):
+        print("Loading IMU calibration from {}".format(IMU_CALIBRATION))
+        imu_calibration = Calibration.load(IMU_CALIBRATION)
+    if SENSOR_PROCESSES:
+        import sensorproc # Pulls in multiprocessing, so only with the option
+        sensors = sensorproc.Supervisor()
+        imu_stream = sensors.add_imu(SERIAL_DEV, SERIAL_BAUD, imu_calibration)
+        imu_ready = startup.first_call(imu_stream.on_sample, loop)
+        reopen_imu = None # The supervisor restarts the worker
+        pressure_sampler = sensors.add_pressure(pressure_bus, PRESSURE_RATE, PRESSURE_OSR)
+    else:
+        reopen_imu = lambda: IMUStream.open(SERIAL_DEV, SERIAL_BAUD, loop, calibration=imu_calibration)
+        imu_ready = ensure_future(reopen_imu(), loop=loop)
+        pressure_sampler = ms5837.Sampler(ms5837.MS5837(bus=pressure_bus), PRESSURE_RATE, PRESSURE_OSR)
+    pressure_ready = startup.first_call(pressure_sampler.on_reading, loop)
+    pressure_sampler.on_reading(lambda reading: hl_controller.observe_depth(reading.time, reading.depth))
+    if flight_recorder:
+        pressure_sampler.on_reading(lambda reading: flight_recorder.record(
+            recorder.KIND_PRESSURE, (reading.pressure, reading.temperature, reading.depth)))
+    if sensors:
+        sensors.start()
+    else:
+        pressure_sampler.ticker = loops.ticker("pressure", 1000.0 / PRESSURE_RATE)
+        startup.fail_with(pressure_sampler.start(loop), pressure_ready)
+    timeline.watch("imu", imu_ready, IMU_START_TIMEOUT, loop)
+    timeline.watch("pressure", pressure_ready, PRESSURE_START_TIMEOUT, loop)
 
     # define tasks
     tasks = [
-        #Python3.5 asyncio.ensure_future(manual_loop(THRUSTER_RATE, pwm))
-        asyncio.async(manual_loop(THRUSTER_RATE, thrusters)),
-        asyncio.async(auto_loop(THRUSTER_RATE, thrusters)),
+        ensure_future(manual_loop(THRUSTER_RATE, thrusters), loop=loop),
+        ensure_future(auto_loop(CONTROL_RATE, thrusters, imu_ready, reopen_imu), loop=loop),
+        ensure_future(telemetry_loop(transport, thrusters), loop=loop),
     ]
+    if sensors:
+        tasks.append(ensure_future(sensor_loop(SENSOR_POLL_RATE), loop=loop))
+    return transport, server, tasks
+
+if __name__ == "__main__":
+    timeline.mark("imported")
+    import Adafruit_PCA9685 # Only on the Pi; start() takes any stand-in
 
-    loop.add_signal_handler(signal.SIGINT, lambda: (transport.close(), loop.stop(), server.close()))
-    loop.run_until_complete(asyncio.gather(*tasks));
+    loop = asyncio.get_event_loop()
+
+    # Init pi hat
+    pwm = Adafruit_PCA9685.PCA9685()
+    pwm.set_pwm_freq(PWM_FREQ) # 50 Hz is good for servo
+    timeline.mark("PiHat ready")
+
+    transport, server, tasks = start(loop, pwm)
+
+    def shutdown():
+        transport.close()
+        server.close()
+        for task in tasks:
+            task.cancel()
+
+    loop.add_signal_handler(signal.SIGINT, shutdown)
+    try:
+        loop.run_until_complete(asyncio.gather(*tasks))
+    except asyncio.CancelledError:
+        pass # Ctrl-C
+    finally:
+        if sensors:
+            sensors.stop()
+        if flight_recorder:
+            flight_recorder.close()
@@ -0,0 +1,118 @@
+""" Fixed-rate scheduling for the ROV's asyncio loops.
+
+Sleeping for the interval after doing the work makes the real period
+interval + work + event loop latency, so loops drift and jitter.
+A Ticker instead waits for absolute deadlines on the event loop's monotonic clock,
+one period apart, no matter how long the work took.
+
+    ticker = scheduler.ticker("thrusters", 100)
+    while True:
+        yield from ticker.wait()
+        ...work...
+
+A tick that starts after its deadline is an overrun. With skip_missed, deadlines
+that passed more than a whole period ago are dropped instead of run back to back.
+"""
+import asyncio
+
+import stats
+from asyncio_compat import coroutine
+
+JITTER_GAIN = 1 / 16.0  # weight of each tick in the running jitter estimate, as in RFC 3550
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+class Ticker:
+    """ Ticks every interval ms and keeps statistics on how well it keeps up. """
+    def __init__(self, name, interval, skip_missed=True, loop=None):
+        self.name = name
+        self.period = interval / 1000.0
+        self.skip_missed = skip_missed
+        self.loop = loop
+        self.period_ms = stats.Histogram()     # time between ticks
+        self.lateness_ms = stats.Histogram()   # time from deadline to tick
+        self.work_ms = stats.Histogram()       # time from tick to the next wait()
+        self.deadline = None
+        self.reset()
+
+    def reset(self):
+        """ Clears the statistics. The schedule itself keeps running. """
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jitter = 0.0   # ms, running mean of |period - interval|
+        self.last_tick = None
+        self.period_ms.reset()
+        self.lateness_ms.reset()
+        self.work_ms.reset()
+
+    @coroutine
+    def wait(self):
+        """ Returns at the next deadline. Always yields to the event loop, even when late. """
+        loop = self.loop or asyncio.get_event_loop()
+        now = loop.time()
+
+        if self.deadline is None:
+            self.deadline = now + self.period
+        else:
+            if self.last_tick is not None:
+                self.work_ms.add((now - self.last_tick) * 1000.0)
+            if now > self.deadline:
+                self.overruns += 1
+                if self.skip_missed:
+                    missed = int((now - self.deadline) / self.period)
+                    self.skipped += missed
+                    self.deadline += missed * self.period
+
+        if self.deadline > now:
+            future = asyncio.Future(loop=loop)
+            handle = loop.call_at(self.deadline, _wake, future)
+            try:
+                yield from future
+            finally:
+                handle.cancel()
+        else:
+            yield from asyncio.sleep(0)
+
+        tick = loop.time()
+        self.lateness_ms.add((tick - self.deadline) * 1000.0)
+        if self.last_tick is not None:
+            period = tick - self.last_tick
+            self.period_ms.add(period * 1000.0)
+            self.jitter += (abs(period - self.period) * 1000.0 - self.jitter) * JITTER_GAIN
+        self.last_tick = tick
+        self.ticks += 1
+        self.deadline += self.period
+
+    def summary(self):
+        return {
+            "interval_ms": self.period * 1000.0,
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitter_ms": self.jitter,
+            "period_ms": self.period_ms.summary(),
+            "lateness_ms": self.lateness_ms.summary(),
+            "work_ms": self.work_ms.summary(),
+        }
+
+class Scheduler:
+    """ Keeps the tickers of all loops so their statistics can be read in one place. """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.tickers = {}
+
+    def ticker(self, name, interval, skip_missed=True):
+        """ Creates the ticker for a loop running every interval ms. """
+        ticker = Ticker(name, interval, skip_missed, self.loop)
+        self.tickers[name] = ticker
+        return ticker
+
+    def summary(self):
+        return dict((name, ticker.summary()) for name, ticker in self.tickers.items())
+
+    def reset(self):
+        for ticker in self.tickers.values():
+            ticker.reset()
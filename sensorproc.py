@@ -0,0 +1,261 @@
+""" Sensor drivers in worker processes, so blocking device I/O never stalls the event loop.
+
+Each worker runs a blocking driver loop and publishes timestamped samples into
+a shmring.SampleRing. On the event loop, Supervisor.poll() hands new samples to
+the callbacks of each SharedSensor, which has the latest/on_sample interface of
+IMUStream and ms5837.Sampler, and restarts workers that died or went quiet.
+
+    sensors = Supervisor()
+    imu = sensors.add_imu('/dev/ttyUSB0', 57600)
+    imu.on_sample(...)
+    sensors.start()
+    ...every few ms: sensors.poll()
+
+Workers are forked, so anything passed to them (i.e. a stand-in SMBus) is copied, not shared.
+Sample times are time.monotonic(), which is the same clock in every process.
+"""
+import multiprocessing
+import os
+import select
+import serial
+import signal
+import time
+
+import shmring
+from devices.imu import Sample, FrameParser, STREAM_INTERVAL, READ_SIZE, WAKE_INTERVAL, stream_command
+import devices.ms5837 as ms5837
+
+CONTEXT = multiprocessing.get_context("fork")
+STARTUP_GRACE = 3.0   # secs a new worker may take before its first sample, i.e. while the IMU board boots
+RESTART_DELAY = 0.5   # secs before restarting a worker, doubled after every failure in a row
+RESTART_MAX = 30.0    # secs, cap on the restart delay
+JOIN_TIMEOUT = 0.5    # secs to wait for a stopped worker to exit before killing it
+IMU_TIMEOUT = 1.0     # secs without an IMU sample before the worker is restarted
+IMU_WIDTH = 8         # counter, accel, gyro, temperature
+PRESSURE_WIDTH = 3    # pressure, temperature, depth
+
+def imu_worker(ring, dev, rate, calibration=None):
+    """ Streams IMU frames from the serial port into ring, see devices.imu.IMUStream.
+        With a calibration the frames are raw and calibrated here, a read at a time.
+    """
+    port = serial.Serial(dev, rate, timeout=0)
+    fd = port.fileno()
+    parser = FrameParser()
+    command = stream_command(calibration)
+    wake = 0.0
+    while True:
+        # Repeat the stream command until the booting board takes it, see IMUStream.open
+        if not parser.frames and time.monotonic() >= wake:
+            port.write(command)
+            port.flush()
+            wake = time.monotonic() + WAKE_INTERVAL
+        if not select.select([fd], [], [], WAKE_INTERVAL)[0]:
+            continue
+        try:
+            data = os.read(fd, READ_SIZE)
+        except BlockingIOError:
+            continue
+        if not data:
+            raise EOFError("{} closed".format(dev)) # Unplugged; let the supervisor start over
+        now = time.monotonic()
+        frames = parser.feed(data)
+        if calibration is not None and frames:
+            frames = calibration.apply_frames(frames)
+        for i, (flags, counter, values) in enumerate(frames):
+            ring.write(now - (len(frames) - 1 - i) * STREAM_INTERVAL, (counter,) + tuple(values))
+
+def pressure_worker(ring, bus, rate, oversampling):
+    """ Reads the MS5837 at rate per second into ring. """
+    sensor = ms5837.MS5837(bus=bus)
+    if not sensor.init():
+        raise OSError("Pressure sensor failed to initialize")
+
+    deadline = time.monotonic()
+    while True:
+        deadline += 1.0 / rate
+        if sensor.read(oversampling):
+            ring.write(time.monotonic(), (sensor.pressure(ms5837.UNITS_mbar),
+                                          sensor.temperature(ms5837.UNITS_Centigrade),
+                                          sensor.depth()))
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            deadline = time.monotonic() # Fell behind; don't try to catch up
+
+def imu_sample(t, values):
+    """ IMU Sample whose accel and gyro are views into the ring. """
+    return Sample(t, int(values[0]), values[1:4], values[4:7], float(values[7]))
+
+def pressure_reading(t, values):
+    return ms5837.Reading(t, float(values[0]), float(values[1]), float(values[2]))
+
+def run_worker(target, ring, args):
+    # Ctrl-C is for the ROV process, which stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(ring, *args)
+
+class SharedSensor:
+    """ Reads one worker's ring on the event loop.
+        latest is the newest sample, made by convert(time, values). Its arrays
+        are views into shared memory, good for the ring's capacity of samples; copy what you keep.
+    """
+    def __init__(self, name, target, args, width, convert, timeout, capacity=shmring.CAPACITY):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.convert = convert
+        self.timeout = timeout
+        self.ring = shmring.SampleRing(width, capacity)
+        self.process = None
+        self.latest = None
+        self.callbacks = []
+        self.read = 0          # Newest sample handed to the callbacks
+        self.last_sample = None
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.overruns = 0      # Samples overwritten before they were read
+        self.torn = 0          # Samples caught mid-write
+        self.restarts = 0
+        self.crashes = 0
+        self.stalls = 0
+
+    def on_sample(self, callback):
+        """ Calls callback(sample) for every new sample. """
+        self.callbacks.append(callback)
+
+    on_reading = on_sample # ms5837.Sampler's name for it
+
+    def poll(self):
+        """ Hands samples written since the last poll to the callbacks. Returns how many. """
+        ring = self.ring
+        head = ring.head()
+        if head == self.read:
+            return 0
+
+        first = max(self.read + 1, head - ring.capacity + 1)
+        self.overruns += first - self.read - 1
+        count = 0
+        for n in range(first, head + 1):
+            item = ring.get(n)
+            if item is None:
+                self.torn += 1
+                continue
+            sample = self.convert(*item)
+            self.latest = sample
+            for cb in self.callbacks:
+                cb(sample)
+            count += 1
+        self.read = head
+        self.samples += count
+        self.last_sample = time.monotonic()
+        return count
+
+    def start(self):
+        self.process = CONTEXT.Process(target=run_worker, args=(self.target, self.ring, self.args),
+                                       name="sensor-" + self.name)
+        self.process.daemon = True
+        self.process.start()
+        self.started = time.monotonic()
+
+    def stop(self):
+        process = self.process
+        if process is None:
+            return
+        self.process = None
+        if process.is_alive():
+            process.terminate()
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGKILL)
+        process.join(JOIN_TIMEOUT)
+
+    def state(self, now):
+        """ "running", "dead" or "stalled". """
+        if not self.process.is_alive():
+            return "dead"
+        since = max(self.started + STARTUP_GRACE, self.last_sample or 0.0)
+        if now - since > self.timeout:
+            return "stalled"
+        return "running"
+
+    def summary(self):
+        return {
+            "pid": self.process.pid if self.process else None,
+            "samples": self.samples,
+            "overruns": self.overruns,
+            "torn": self.torn,
+            "restarts": self.restarts,
+            "crashes": self.crashes,
+            "stalls": self.stalls,
+            "age": time.monotonic() - self.latest.time if self.latest else None,
+        }
+
+class Supervisor:
+    """ Starts the sensor workers, polls their rings and restarts the ones that fail.
+        Restarts back off from RESTART_DELAY to RESTART_MAX while a worker keeps failing.
+    """
+    def __init__(self):
+        self.sensors = {}
+        self.failures = {}     # Failures in a row, by name
+        self.restart_at = {}   # Pending restarts, by name
+
+    def add(self, name, target, args, width, convert, timeout):
+        sensor = SharedSensor(name, target, args, width, convert, timeout)
+        self.sensors[name] = sensor
+        self.failures[name] = 0
+        return sensor
+
+    def add_imu(self, dev, rate, calibration=None):
+        return self.add("imu", imu_worker, (dev, rate, calibration), IMU_WIDTH, imu_sample, IMU_TIMEOUT)
+
+    def add_pressure(self, bus, rate, oversampling):
+        # A few missed readings, but at least a second
+        return self.add("pressure", pressure_worker, (bus, rate, oversampling),
+                        PRESSURE_WIDTH, pressure_reading, max(1.0, 5.0 / rate))
+
+    def start(self):
+        for sensor in self.sensors.values():
+            sensor.start()
+
+    def poll(self):
+        """ Delivers new samples and looks after the workers. Call it often from the event loop. """
+        now = time.monotonic()
+        for name, sensor in self.sensors.items():
+            if sensor.poll():
+                self.failures[name] = 0
+
+            if name in self.restart_at:
+                if now >= self.restart_at[name]:
+                    del self.restart_at[name]
+                    sensor.restarts += 1
+                    sensor.start()
+                continue
+
+            state = sensor.state(now)
+            if state == "running":
+                continue
+            if state == "dead":
+                sensor.crashes += 1
+                print("Sensor worker {} exited with {}".format(name, sensor.process.exitcode))
+            else:
+                sensor.stalls += 1
+                print("Sensor worker {} sent nothing for {}s".format(name, sensor.timeout))
+            sensor.stop()
+            delay = min(RESTART_MAX, RESTART_DELAY * 2 ** self.failures[name])
+            self.failures[name] += 1
+            self.restart_at[name] = now + delay
+
+    def stop(self):
+        for sensor in self.sensors.values():
+            sensor.stop()
+            sensor.ring.close()
+
+    def reset(self):
+        for sensor in self.sensors.values():
+            sensor.reset()
+
+    def summary(self):
+        return dict((name, sensor.summary()) for name, sensor in self.sensors.items())
@@ -0,0 +1,127 @@
+""" Lock-free ring of timestamped samples in shared memory, for one writer process and any number of readers.
+
+Layout:
+    header    HEADER: magic, width, capacity, head
+    slots     capacity x (seq, time, width values), all 8 byte fields
+
+head counts the samples written so far; sample n (from 1) lives in slot (n - 1) % capacity.
+Each slot works as a seqlock: the writer sets its seq to 2n - 1 before writing sample n
+and to 2n after, then publishes head = n. A reader that finds seq == 2n
+knows the slot holds all of sample n, so it can use the values in place.
+The slot stays intact until the writer comes around again, capacity samples later;
+valid(n) tells whether that happened.
+
+CPython has no memory barriers, so the ordering of the stores rests on each
+numpy assignment being a separate trip through the interpreter.
+
+Backed by multiprocessing.shared_memory where it exists (Python 3.8+), otherwise
+by an anonymous shared mmap, which forked children inherit.
+"""
+import mmap
+import numpy
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None # Python 3.4 on the Pi
+
+MAGIC = 0x524F5652 # "ROVR"
+HEADER = numpy.dtype([('magic', '<u4'), ('width', '<u4'), ('capacity', '<u8'), ('head', '<u8')])
+CAPACITY = 256
+
+def slot_dtype(width):
+    return numpy.dtype([('seq', '<u8'), ('time', '<f8'), ('values', '<f8', (width,))])
+
+class SampleRing:
+    """ Ring of capacity samples, each a time and width floats.
+        Create it before starting the writer process, or attach to an existing one by name.
+    """
+    def __init__(self, width, capacity=CAPACITY, name=None):
+        slot = slot_dtype(width)
+        size = HEADER.itemsize + capacity * slot.itemsize
+        self.width = width
+        self.capacity = capacity
+        self.owner = name is None
+
+        if shared_memory is not None:
+            self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+            self.buffer = self.shm.buf
+            self.name = self.shm.name
+        elif self.owner:
+            self.shm = None
+            self.buffer = mmap.mmap(-1, size)
+            self.name = None
+        else:
+            raise RuntimeError("Attaching to a ring by name needs multiprocessing.shared_memory")
+
+        self.header = numpy.frombuffer(self.buffer, HEADER, 1)
+        if self.owner:
+            self.header['magic'] = MAGIC
+            self.header['width'] = width
+            self.header['capacity'] = capacity
+        elif self.header['magic'][0] != MAGIC or self.header['width'][0] != width:
+            raise ValueError("{} is not a ring of {} values".format(name, width))
+        elif self.header['capacity'][0] != capacity:
+            raise ValueError("{} holds {} samples, not {}".format(name, self.header['capacity'][0], capacity))
+
+        slots = numpy.frombuffer(self.buffer, slot, capacity, HEADER.itemsize)
+        self.head_view = self.header['head']
+        self.seq = slots['seq']
+        self.times = slots['time']
+        self.values = slots['values']
+
+    def head(self):
+        """ Number of samples written so far. """
+        return int(self.head_view[0])
+
+    def write(self, t, values):
+        """ Appends a sample. Only one process may write. """
+        n = int(self.head_view[0]) + 1
+        i = (n - 1) % self.capacity
+        self.seq[i] = 2 * n - 1
+        self.times[i] = t
+        self.values[i] = values
+        self.seq[i] = 2 * n
+        self.head_view[0] = n
+
+    def get(self, n):
+        """ Returns (time, values) of sample n, or None if it is not complete or already overwritten.
+            values is a view into the ring, valid until valid(n) turns False.
+        """
+        i = (n - 1) % self.capacity
+        if self.seq[i] != 2 * n:
+            return None
+        t = float(self.times[i])
+        if self.seq[i] != 2 * n:
+            return None
+        return t, self.values[i]
+
+    def valid(self, n):
+        """ True while the slot of sample n still holds it. """
+        return self.seq[(n - 1) % self.capacity] == 2 * n
+
+    def latest(self):
+        """ (n, time, values) of the newest sample, or None before the first. """
+        n = self.head()
+        while n > 0:
+            sample = self.get(n)
+            if sample is not None:
+                return (n,) + sample
+            newer = self.head()
+            if newer == n:
+                return None
+            n = newer # Overwritten while we looked; the writer has moved on
+        return None
+
+    def close(self):
+        """ Detaches, and frees the memory if this ring created it. """
+        self.header = self.head_view = self.seq = self.times = self.values = None
+        try:
+            if self.shm is not None:
+                self.shm.close()
+            else:
+                self.buffer.close()
+        except BufferError:
+            pass # A reader still holds a view; the mapping goes with the process
+        if self.shm is not None and self.owner:
+            self.shm.unlink()
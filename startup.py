@@ -0,0 +1,84 @@
+""" Startup timeline of the ROV and the state of each device.
+
+rov.py brings the thrusters to neutral and the servers up first, then starts the
+sensors in the background. Each sensor gets a timeout: one that has not come up by
+then is marked degraded and the ROV runs without it, until it does come up.
+
+Every step is logged with the secs since the process started, e.g.
+    [startup   0.412s] thrusters neutral
+and the whole timeline is kept for the stats command.
+
+Device states:
+    starting   still coming up, within its timeout
+    degraded   past its timeout and still coming up
+    ok         up
+    failed     gave up with an error
+"""
+import asyncio
+import time
+
+class Startup:
+    def __init__(self, t0=None):
+        self.t0 = time.monotonic() if t0 is None else t0
+        self.events = []     # (secs since t0, event)
+        self.devices = {}    # name: state
+
+    def mark(self, event):
+        elapsed = time.monotonic() - self.t0
+        self.events.append((elapsed, event))
+        print("[startup {:7.3f}s] {}".format(elapsed, event))
+
+    def device(self, name, state, detail=None):
+        self.devices[name] = state
+        self.mark("{} {}".format(name, state) + (": {}".format(detail) if detail else ""))
+
+    def watch(self, name, future, timeout, loop):
+        """ Tracks a device that is up when future completes. """
+        self.device(name, "starting")
+
+        def late():
+            if not future.done():
+                self.device(name, "degraded", "not up after {}s".format(timeout))
+
+        def done(f):
+            handle.cancel()
+            if f.cancelled():
+                self.device(name, "failed", "cancelled")
+            elif f.exception() is not None:
+                self.device(name, "failed", f.exception())
+            else:
+                self.device(name, "ok")
+
+        handle = loop.call_later(timeout, late)
+        future.add_done_callback(done)
+
+    def summary(self):
+        return {
+            "events": [[round(t, 4), event] for t, event in self.events],
+            "devices": dict(self.devices),
+        }
+
+def first_call(subscribe, loop):
+    """ Future that completes with the first value passed to a callback registered by subscribe,
+        i.e. first_call(stream.on_sample, loop).
+    """
+    future = asyncio.Future(loop=loop)
+
+    def callback(value):
+        if not future.done():
+            future.set_result(value)
+
+    subscribe(callback)
+    return future
+
+def fail_with(task, future):
+    """ Fails future if task ends before completing it, i.e. a sampler that gave up on its sensor. """
+    def done(task):
+        if future.done():
+            return
+        if task.cancelled():
+            future.cancel()
+        else:
+            future.set_exception(task.exception() or RuntimeError("stopped before coming up"))
+
+    task.add_done_callback(done)
@@ -4,6 +4,7 @@ Current setup:
     Send a UDP message with controller_info to the
     TARGET_HOST on PORT every UDP_RATE ms.
     Send a TCP message with single time events
+    Receive telemetry pushed by the ROV on the same UDP socket
 """
 import devices.xbox_async
 from devices.xbox_async import Button, Joystick
@@ -13,15 +14,21 @@ import signal
 import time
 import socket
 import json
-import gbulb
-gbulb.install()
-
-from gtkpanel import ROVPanel
+import packets
 
 PORT=30002
 TARGET_ADDR="192.168.0.15"
 UDP_RATE=50     # ms between each datagram. 50 = 20 packets/s
 COMMAND_LIMIT = 1 # seconds between each command. i.e. temp sensor
+COMMAND_TIMEOUT = 5 # seconds to wait for a command's reply before giving up on it
+JOYSTICK_BACKEND = "xboxdrv" # "xboxdrv" or "evdev". evdev reads the kernel's event device without root.
+JOYSTICK_DEVICE = None # evdev device or FIFO of recorded events. None picks the first joystick.
+PACKET_FORMAT = "binary" # "binary" or "json". Use json for ROVs that predate the binary format.
+SEND_MODE = "change" # "change" sends when the input moves plus a heartbeat, "periodic" sends every UDP_RATE
+CHANGE_THRESHOLD = 0.02 # smallest axis change that is sent right away
+HEARTBEAT_RATE = 250 # ms between packets while the input is idle. Keep well below the ROV's PACKET_TIMEOUT.
+MAX_SEND_RATE = 10 # ms minimum between packets
+TELEMETRY_LOG = "telemetry.log" # One JSON object per telemetry packet. None disables logging.
 
 # This will be modified by the xbox button handlers
 controller_info = {
@@ -32,161 +39,309 @@ controller_info = {
     "lt" : 0.0,
     "rt" : 0.0,
 }
-rov_tcp_sock = None
+controller_buttons = 0 # Bitfield of held buttons, see devices.xbox_async.ControllerState
+rov_tcp = None # TCP protocol of the command connection
+
+# controller_info as of the last packet sent, and the event that wakes controller_output
+last_sent = dict(controller_info)
+input_changed = None
+
+# Latest values of each telemetry group, updated as packets arrive
+telemetry = {}
+telemetry_log = None
+panel = None
 
 class UDP:
     """ Implement callbacks for asyncio transports.
-        Our implementation has one-way communication for controller states.
+        Controller states go out; telemetry from the ROV comes back in.
     """
     def connection_made(self, transport):
         self.transport = transport
 
+    def datagram_received(self, data, addr):
+        try:
+            group, seq, send_time, values = packets.decode_telemetry(data)
+        except packets.PacketError:
+            return # Ignore anything that is not telemetry
+        handle_telemetry(group, send_time, values)
+
     def error_received(self, exc):
         pass
 
+def handle_telemetry(group, send_time, values):
+    """ Stores, logs and displays a telemetry group. """
+    telemetry[group] = values
+
+    if telemetry_log:
+        telemetry_log.write(json.dumps(dict(values, group=group, time=send_time)) + "\n")
+    if panel:
+        panel.show_telemetry(group, values)
+
 class TCP(asyncio.Protocol):
     """ Implement callbacks for asyncio transports.
-        prints received data
+        Sends framed commands (see packets.py) and resolves a future per request
+        when the matching reply arrives.
     """
+    def __init__(self):
+        self.reader = packets.CommandReader()
+        self.pending = {}
+        self.next_id = 0
+
     def connection_made(self, transport):
         peername = transport.get_extra_info('peername')
         print("Connected to ROV at {}".format(peername))
         self.transport = transport
 
+    def command(self, name, **args):
+        """ Sends a command. Returns a future for its result.
+            The future raises packets.CommandError if the ROV reports an error,
+            asyncio.TimeoutError without a reply in COMMAND_TIMEOUT secs
+            and ConnectionError if the connection drops first.
+        """
+        self.next_id = (self.next_id + 1) % packets.SEQ_MOD
+        future = asyncio.get_event_loop().create_future()
+        self.pending[self.next_id] = future
+        self.transport.write(packets.encode_command(self.next_id, {"cmd": name, "args": args}))
+        return asyncio.ensure_future(self.wait_reply(self.next_id, name, future))
+
+    async def wait_reply(self, request_id, name, future):
+        try:
+            return await asyncio.wait_for(future, COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError("No reply to {} in {}s".format(name, COMMAND_TIMEOUT)) from None
+        finally:
+            if self.pending.get(request_id) is future:
+                del self.pending[request_id]
+
     def data_received(self, data):
-        print(data.decode())
+        try:
+            frames = self.reader.feed(data)
+        except packets.PacketError as e:
+            print("Bad reply from ROV:", e)
+            self.transport.close()
+            return
+
+        for request_id, body in frames:
+            future = self.pending.pop(request_id, None)
+            if future is None or future.done():
+                continue
+            if body is None:
+                future.set_exception(packets.CommandError("Malformed reply"))
+            elif body.get("ok"):
+                future.set_result(body.get("result"))
+            else:
+                future.set_exception(packets.CommandError(body.get("error")))
 
     def error_received(self, exc):
         print('TCP connection error:', exc)
 
     def connection_lost(self, exc):
+        global rov_tcp
         print("Lost connection to ROV.")
+        rov_tcp = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Lost connection to ROV"))
+        self.pending.clear()
         asyncio.get_event_loop().create_task(tcp_retry())
 
-
 def stick_l(x, y):
     global controller_info
     controller_info["lx"] = x
     controller_info["ly"] = y
+    input_moved()
 
 def stick_r(x, y):
     global controller_info
     controller_info["rx"] = x
     controller_info["ry"] = y
+    input_moved()
 
 def trig_l(x):
     global controller_info
     controller_info["lt"] = x
+    input_moved()
 
 def trig_r(x):
     global controller_info
     controller_info["rt"] = x
+    input_moved()
 
-def req_temp():
-    global rov_tcp_sock
-    try: req_temp.time
-    except AttributeError: req_temp.time = 0
+def input_moved():
+    """ Wakes controller_output if any axis moved more than CHANGE_THRESHOLD since the last packet. """
+    if input_changed is None or input_changed.is_set():
+        return
 
-    curr_time = time.time()
-    if curr_time - req_temp.time > COMMAND_LIMIT:
-        try:
-            rov_tcp_sock.write("temp".encode())
-        except AttributeError:
-            pass # Initial connection has not been established
-        req_temp.time = curr_time
+    for key, value in controller_info.items():
+        if abs(value - last_sent[key]) > CHANGE_THRESHOLD:
+            input_changed.set()
+            return
 
-def req_light():
-    global rov_tcp_sock
-    try: req_light.time
-    except AttributeError: req_light.time = 0
+def send_command(name, **args):
+    """ Sends a command to the ROV. Returns a future for the reply, or None if not connected. """
+    if rov_tcp is None:
+        return None # Initial connection has not been established
+    return rov_tcp.command(name, **args)
+
+def throttled(func):
+    """ True if func ran less than COMMAND_LIMIT seconds ago. Otherwise records this run. """
+    try: func.time
+    except AttributeError: func.time = 0
 
     curr_time = time.time()
-    if curr_time - req_light.time > COMMAND_LIMIT:
-        try:
-            rov_tcp_sock.write("light".encode())
-        except AttributeError:
-            pass # Initial connection has not been established
-        req_light.time = curr_time
+    if curr_time - func.time > COMMAND_LIMIT:
+        func.time = curr_time
+        return False
+    return True
 
-def req_auto():
-    global rov_tcp_sock
-    try: req_auto.time
-    except AttributeError: req_auto.time = 0
+def print_reply(future):
+    """ Prints the result of a command future once it is done. """
+    def done(f):
+        if f.cancelled():
+            return
+        print(f.exception() if f.exception() else f.result())
 
-    curr_time = time.time()
-    if curr_time - req_auto.time > COMMAND_LIMIT:
-        try:
-            rov_tcp_sock.write("auto".encode())
-        except AttributeError:
-            pass # Initial connection has not been established
-        req_auto.time = curr_time
+    if future is not None:
+        future.add_done_callback(done)
+
+def req_temp():
+    """ Returns a future for {"pressure", "temperature"}, or None if throttled or not connected. """
+    if throttled(req_temp):
+        return None
+    return send_command("temp")
+
+def req_light():
+    if throttled(req_light):
+        return None
+    return send_command("light")
+
+def req_auto():
+    """ Returns a future for the new autonomy state. """
+    if throttled(req_auto):
+        return None
+    return send_command("auto")
+
+def req_link():
+    """ Returns a future for the ROV's link statistics. """
+    if throttled(req_link):
+        return None
+    return send_command("link")
+
+def req_stats():
+    """ Returns a future for everything the ROV measures about itself, see TCP.cmd_stats in rov.py. """
+    if throttled(req_stats):
+        return None
+    return send_command("stats")
 
 async def controller_poll():
     """Read xbox controller information.
     """
-    joy = await Joystick.create(normalize=True)
+    global controller_buttons
+    joy = await Joystick.create(normalize=True, backend=JOYSTICK_BACKEND, device=JOYSTICK_DEVICE)
     joy.on_button(Button.LStick, stick_l)
     joy.on_button(Button.RStick, stick_r)
     joy.on_button(Button.LTrigger, trig_l)
     joy.on_button(Button.RTrigger, trig_r)
-    joy.on_button(Button.A, req_temp)
-    joy.on_button(Button.B, req_light)
-    joy.on_button(Button.X, req_auto)
+    joy.on_button(Button.A, lambda: print_reply(req_temp()))
+    joy.on_button(Button.B, lambda: print_reply(req_light()))
+    joy.on_button(Button.X, lambda: print_reply(req_auto()))
+    joy.on_button(Button.Y, lambda: print_reply(req_link()))
+    joy.on_button(Button.Back, lambda: print_reply(req_stats()))
 
     while True:
         joy = await joy.read()
+        controller_buttons = joy.state.buttons
 
     joy.close()
 
 async def controller_output(transport, interval):
     """Send controller message through given transport every interval(ms)
+    In "change" mode, send as soon as the input moves instead,
+    at most every MAX_SEND_RATE ms and at least every HEARTBEAT_RATE ms.
     """
-    global controller_info
+    global controller_info, input_changed
+    encoder = packets.ControlEncoder()
+    loop = asyncio.get_event_loop()
+    input_changed = asyncio.Event()
+    prev_send = 0
 
     while True:
-        await asyncio.sleep(interval / 1000.0)
+        if SEND_MODE == "change":
+            try:
+                await asyncio.wait_for(input_changed.wait(), HEARTBEAT_RATE / 1000.0)
+            except asyncio.TimeoutError:
+                pass # Heartbeat keeps the ROV's failsafe from tripping
+
+            wait = prev_send + MAX_SEND_RATE / 1000.0 - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            input_changed.clear()
+        else:
+            await asyncio.sleep(interval / 1000.0)
 
-        # Package all the global vars into JSON and send it.
-        controller_info_json = json.dumps(controller_info)
+        # Package all the global vars and send them.
+        if PACKET_FORMAT == "binary":
+            data = encoder.encode(controller_info, controller_buttons)
+        else:
+            encoder.seq = (encoder.seq + 1) % packets.SEQ_MOD
+            data = json.dumps(dict(controller_info, seq=encoder.seq, time=time.time())).encode()
 
         # The transport should already have destination specification stored in it.
         # Otherwise we can specify it.
-        transport.sendto(controller_info_json.encode())
+        transport.sendto(data)
+        last_sent.update(controller_info)
+        prev_send = loop.time()
 
 async def tcp_retry():
     """ Continuously attempts to establish TCP connection until success.
     """
-    global rov_tcp_sock
+    global rov_tcp
     print("Attempting to initialize TCP connection with ROV...");
     loop = asyncio.get_event_loop()
     while True:
         try:
-            (rov_tcp_sock, protocol) = await loop.create_connection(lambda: TCP(), TARGET_ADDR, PORT)
+            (transport, rov_tcp) = await loop.create_connection(lambda: TCP(), TARGET_ADDR, PORT)
         except OSError:
             await asyncio.sleep(3)
             print("Retrying connection to ROV...")
         else:
             break
 
-if __name__ == "__main__":
-    loop = asyncio.get_event_loop()
-    loop.add_signal_handler(signal.SIGINT, lambda: loop.stop())
-
+def start(loop):
+    """ Connects to the ROV and starts reading the controller on loop.
+        Returns (udp transport, tasks).
+    """
     # Init UDP client
     udp = loop.create_datagram_endpoint(
         lambda: UDP(), remote_addr=(TARGET_ADDR, PORT))
     transport, protocol = loop.run_until_complete(udp)
 
-    # Init ROV Panel
-    win = ROVPanel(rov_tcp_sock)
-
     tasks = [
-        asyncio.ensure_future(tcp_retry()),
-        asyncio.ensure_future(controller_poll()),
-        asyncio.ensure_future(controller_output(transport, UDP_RATE))
+        asyncio.ensure_future(tcp_retry(), loop=loop),
+        asyncio.ensure_future(controller_poll(), loop=loop),
+        asyncio.ensure_future(controller_output(transport, UDP_RATE), loop=loop)
     ]
+    return transport, tasks
+
+if __name__ == "__main__":
+    # The panel runs GTK inside the asyncio loop
+    import gbulb
+    gbulb.install()
+    from gtkpanel import ROVPanel
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGINT, lambda: loop.stop())
+
+    if TELEMETRY_LOG:
+        telemetry_log = open(TELEMETRY_LOG, "a", buffering=1)
+
+    # Init ROV Panel
+    panel = ROVPanel(send_command)
 
+    transport, tasks = start(loop)
     loop.run_until_complete(asyncio.gather(*tasks))
 
     transport.close()
     loop.close()
+    if telemetry_log:
+        telemetry_log.close()
@@ -0,0 +1,237 @@
+""" Lightweight statistics used to watch the ROV while it is running.
+Everything here is cheap enough to update on every packet.
+"""
+import bisect
+import time
+
+# Bucket edges (ms) for timing histograms
+TIMING_EDGES_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+# Finer edges (ms) for stages of a single pass through the code
+STAGE_EDGES_MS = [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100]
+
+MAX_PACKET_AGE = 0.5   # secs a packet may lag behind the fastest one seen before it is dropped
+REORDER_WINDOW = 64    # packets behind the newest that may still be reordering; further back is a restart
+CLOCK_STEP_RUN = 10    # late packets in a row, all late by about the same amount, that mean a clock stepped
+SEQ_MOD = 1 << 32
+
+class Histogram:
+    """ Fixed bucket histogram.
+        counts[i] holds values <= edges[i]; the last bucket holds everything above the last edge.
+    """
+    def __init__(self, edges=TIMING_EDGES_MS):
+        self.edges = list(edges)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """ Upper edge of the bucket holding the p-th percentile (0-100).
+            Returns the max for the overflow bucket and None when empty.
+        """
+        if not self.count:
+            return None
+
+        target = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                return self.edges[i] if i < len(self.edges) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "edges": self.edges,
+            "counts": self.counts,
+        }
+
+class LinkStats:
+    """ Tracks control link health and decides which packets are fresh enough to apply.
+        Station and ROV clocks are not synchronized, so one-way delay is measured
+        relative to the smallest delay seen so far. That minimum absorbs the clock offset.
+        When either clock steps (i.e. NTP catching up on a Pi without an RTC) the offset
+        changes and every packet looks late by the step. A backlog of delayed packets looks
+        late too, but by less and less as it drains, so a run of CLOCK_STEP_RUN packets
+        late by amounts within max_age of each other is taken for a step, and the minimum starts over.
+    """
+    def __init__(self, max_age=MAX_PACKET_AGE):
+        self.max_age = max_age
+        self.interarrival = Histogram()
+        self.delay = Histogram()
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.late = 0
+        self.lost = 0
+        self.restarts = 0
+        self.clock_steps = 0
+        self.jitter = 0.0   # ms, RFC 3550 style running estimate
+
+        self.last_seq = None
+        self.last_send_time = None
+        self.last_arrival = None
+        self.last_transit = None
+        self.min_transit = None
+        self.late_run = 0          # Late packets in a row
+        self.late_low = self.late_high = None  # Range of their transits
+
+        self.interarrival.reset()
+        self.delay.reset()
+
+    def accept(self, seq, send_time, recv_time=None):
+        """ Records a packet. Returns True if it should be applied. """
+        if recv_time is None:
+            recv_time = time.time()
+        arrival = time.monotonic()
+        self.received += 1
+
+        if self.last_arrival is not None:
+            self.interarrival.add((arrival - self.last_arrival) * 1000.0)
+        self.last_arrival = arrival
+
+        if self.last_seq is not None:
+            diff = (seq - self.last_seq) % SEQ_MOD
+            if diff == 0:
+                self.duplicates += 1
+                return False
+            if diff >= SEQ_MOD // 2:
+                if SEQ_MOD - diff > REORDER_WINDOW or send_time > self.last_send_time:
+                    # The station restarted its counter: too far back for reordering,
+                    # or sent after the newest packet, which a late packet can't be
+                    self.restarts += 1
+                    self.min_transit = None
+                    self.last_transit = None
+                else:
+                    # A packet we already counted as lost showed up late
+                    self.reordered += 1
+                    self.lost = max(0, self.lost - 1)
+                    return False
+            else:
+                self.lost += diff - 1
+
+        transit = recv_time - send_time
+        if self.min_transit is None or transit < self.min_transit:
+            self.min_transit = transit
+        age = transit - self.min_transit
+
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) * 1000.0 - self.jitter) / 16.0
+        self.last_transit = transit
+        self.delay.add(age * 1000.0)
+        self.last_seq = seq
+        self.last_send_time = send_time
+
+        if age > self.max_age:
+            if not self.late_run:
+                self.late_low = self.late_high = transit
+            self.late_run += 1
+            self.late_low = min(self.late_low, transit)
+            self.late_high = max(self.late_high, transit)
+            if self.late_high - self.late_low > self.max_age:
+                self.late_run = 0 # Draining a backlog, not a step
+            if self.late_run < CLOCK_STEP_RUN:
+                self.late += 1
+                return False
+            # A clock stepped; measure from the new offset
+            self.clock_steps += 1
+            self.min_transit = transit
+        self.late_run = 0
+
+        self.accepted += 1
+        return True
+
+    def summary(self):
+        expected = self.accepted + self.late + self.lost
+        return {
+            "received": self.received,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "reordered": self.reordered,
+            "late": self.late,
+            "lost": self.lost,
+            "loss": self.lost / expected if expected else 0.0,
+            "restarts": self.restarts,
+            "clock_steps": self.clock_steps,
+            "jitter_ms": self.jitter,
+            "clock_offset": self.min_transit,
+            "interarrival_ms": self.interarrival.summary(),
+            "delay_ms": self.delay.summary(),
+        }
+
+class StageProbe:
+    """ Times the stages of a pipeline, e.g. from packet receive to PWM write.
+        begin() starts a pass, mark(stage) records the time since the previous
+        mark (or begin) under stage, and end() records the whole pass.
+        While disabled every call returns straight away.
+    """
+    def __init__(self, stages, enabled=False):
+        self.stages = list(stages)
+        self.enabled = enabled
+        self.histograms = dict((stage, Histogram(STAGE_EDGES_MS)) for stage in self.stages)
+        self.total = Histogram(STAGE_EDGES_MS)
+        self.start = None
+        self.last = None
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        if self.last is None:
+            return  # Disabled, or no pass in progress
+        now = time.perf_counter()
+        self.histograms[stage].add((now - self.last) * 1000.0)
+        self.last = now
+
+    def end(self):
+        if self.last is None:
+            return
+        self.total.add((self.last - self.start) * 1000.0)
+        self.start = self.last = None
+
+    def cancel(self):
+        """ Abandons the pass in progress, e.g. for a dropped packet. """
+        self.start = self.last = None
+
+    def enable(self, enabled):
+        self.enabled = enabled
+        self.cancel()
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.total.reset()
+
+    def summary(self):
+        return {
+            "enabled": self.enabled,
+            "stages": self.stages,
+            "stage_ms": dict((stage, self.histograms[stage].summary()) for stage in self.stages),
+            "total_ms": self.total.summary(),
+        }
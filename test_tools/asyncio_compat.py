@@ -0,0 +1 @@
+../asyncio_compat.py
\ No newline at end of file
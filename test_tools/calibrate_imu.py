@@ -0,0 +1,106 @@
+"""
+Calibrate the IMU: accelerometer bias and scale, and gyro bias against temperature.
+
+Streams raw readings at the firmware's full rate into numpy arrays in two steps:
+    still   leave the IMU still, for the gyro bias. The longer, and the more its
+            temperature changes (i.e. from a cold start), the better the drift fit.
+    tumble  turn the IMU slowly through as many orientations as you can, pausing in each,
+            for the accelerometer ellipsoid.
+then fits them and writes the file rov.py applies, see devices/imu_calibration.py.
+
+    python3 calibrate_imu.py -o ../imu_calibration.json
+    python3 calibrate_imu.py --save-raw raw.npz ...     keep the readings
+    python3 calibrate_imu.py --from-raw raw.npz ...     and fit them again later
+"""
+import argparse
+import os
+import time
+import numpy as np
+import serial
+
+from devices.imu import FrameParser, FLAG_RAW, READ_SIZE, STREAM_INTERVAL
+import devices.imu_calibration as imu_calibration
+
+SERIAL_DEV = '/dev/ttyUSB0'
+SERIAL_BAUD = 57600
+STILL_SECS = 120
+TUMBLE_SECS = 90
+BOOT_TIMEOUT = 5.0 # secs for the board to start streaming
+
+def record(port, parser, secs):
+    """ Raw readings (n, 7) streamed over secs: accel, gyro, temperature. """
+    readings = np.empty((int(secs / STREAM_INTERVAL * 1.2) + 64, 7))
+    count = 0
+    skipped = 0
+    # Drop what piled up while waiting for the user
+    port.flushInput()
+    del parser.buffer[:]
+    end = time.monotonic() + secs
+    while time.monotonic() < end:
+        for flags, counter, values in parser.feed(port.read(READ_SIZE)):
+            if not flags & FLAG_RAW:
+                skipped += 1
+                continue
+            if count == len(readings):
+                readings = np.concatenate((readings, np.empty(readings.shape)))
+            readings[count] = values
+            count += 1
+    if skipped and not count:
+        raise SystemExit("The IMU sends no raw readings; flash razor/razor.ino for \"#r\"")
+    return readings[:count]
+
+def collect(dev, rate, still_secs, tumble_secs):
+    port = serial.Serial(dev, rate, timeout=STREAM_INTERVAL)
+    parser = FrameParser()
+
+    # The board resets when the port opens; repeat the command until it streams
+    deadline = time.monotonic() + BOOT_TIMEOUT
+    while not parser.feed(port.read(READ_SIZE)):
+        if time.monotonic() > deadline:
+            raise SystemExit("No frames from {}".format(dev))
+        port.write(b'#b#r#c')
+        port.flush()
+
+    input("Leave the IMU still for {}s, then press enter ".format(still_secs))
+    still = record(port, parser, still_secs)
+    print("{} readings, {:.1f} to {:.1f}C".format(len(still), still[:, 6].min(), still[:, 6].max()))
+
+    input("Turn the IMU slowly through every orientation for {}s, pausing in each. Press enter to start "
+          .format(tumble_secs))
+    tumble = record(port, parser, tumble_secs)
+    print("{} readings".format(len(tumble)))
+
+    port.write(b'#f#p')
+    port.close()
+    return still, tumble
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit the IMU calibration applied by rov.py.")
+    parser.add_argument("-o", "--out", default="imu_calibration.json")
+    parser.add_argument("--dev", default=SERIAL_DEV)
+    parser.add_argument("--baud", type=int, default=SERIAL_BAUD)
+    parser.add_argument("--still", type=float, default=STILL_SECS, help="secs held still")
+    parser.add_argument("--tumble", type=float, default=TUMBLE_SECS, help="secs turned through orientations")
+    parser.add_argument("--save-raw", help="keep the raw readings in this .npz")
+    parser.add_argument("--from-raw", help="fit readings kept by --save-raw instead of recording")
+    args = parser.parse_args()
+
+    if args.from_raw:
+        with np.load(args.from_raw) as raw:
+            still, tumble = raw["still"], raw["tumble"]
+    else:
+        still, tumble = collect(args.dev, args.baud, args.still, args.tumble)
+        if args.save_raw:
+            np.savez(args.save_raw, still=still, tumble=tumble)
+
+    calibration = imu_calibration.fit(still, tumble)
+    info = calibration.info
+    print("Accel bias {} scale {}".format(np.round(calibration.accel_bias, 2),
+                                          np.round(np.abs(np.diag(calibration.accel_matrix)), 4)))
+    print("Gyro bias {} drift {} per C at {:.1f}C".format(np.round(calibration.gyro_bias, 2),
+                                                          np.round(calibration.gyro_drift, 3),
+                                                          calibration.reference_temperature))
+    print("From {} accel points, |accel| within {:.2%} of 1g; gyro noise {} deg/s".format(
+        info["accel_points"], info["gravity_error"], np.round(info["gyro_noise"], 3)))
+    calibration.save(args.out)
+    print("Wrote {}".format(os.path.abspath(args.out)))
@@ -0,0 +1,72 @@
+"""
+Stand-in for a controller when testing the evdev backend of devices.xbox_async.
+Writes input_event structs into a FIFO, which Joystick.create(backend="evdev", device=FIFO) reads.
+
+Usage: fake_joystick.py FIFO [RECORDING]
+Without a recording, a short scripted sequence is played in a loop.
+A recording is raw events captured from a real controller,
+i.e. cat /dev/input/by-id/...-event-joystick > recording
+and is replayed with its original timing.
+"""
+import os
+import struct
+import sys
+import time
+
+# Same layout as devices/xbox_async.py
+INPUT_EVENT = struct.Struct('llHHi')
+EV_SYN, EV_KEY, EV_ABS = 0x00, 0x01, 0x03
+ABS_X, ABS_Y, ABS_RZ = 0x00, 0x01, 0x05
+BTN_A = 0x130
+
+# (seconds to wait before, [(type, code, value), ...]) Each step ends with a SYN_REPORT.
+SCRIPT = [
+    (0.5, [(EV_ABS, ABS_Y, -32768)]),         # Left stick forward
+    (0.5, [(EV_ABS, ABS_X, 16000)]),          # and a little right
+    (0.5, [(EV_ABS, ABS_X, 0), (EV_ABS, ABS_Y, 0)]),
+    (0.5, [(EV_ABS, ABS_RZ, 255)]),           # Right trigger
+    (0.5, [(EV_ABS, ABS_RZ, 0)]),
+    (0.5, [(EV_KEY, BTN_A, 1)]),              # Press and release A
+    (0.1, [(EV_KEY, BTN_A, 0)]),
+]
+
+def event(ev_type, code, value, stamp=None):
+    stamp = time.time() if stamp is None else stamp
+    return INPUT_EVENT.pack(int(stamp), int(stamp % 1 * 1e6), ev_type, code, value)
+
+def play_script(fifo):
+    while True:
+        for delay, events in SCRIPT:
+            time.sleep(delay)
+            data = b''.join(event(*e) for e in events) + event(EV_SYN, 0, 0)
+            os.write(fifo, data)
+
+def play_recording(fifo, path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    start = None
+    for offset in range(0, len(data) - INPUT_EVENT.size + 1, INPUT_EVENT.size):
+        sec, usec, ev_type, code, value = INPUT_EVENT.unpack_from(data, offset)
+        stamp = sec + usec / 1e6
+        if start is None:
+            start = (stamp, time.time())
+        delay = (stamp - start[0]) - (time.time() - start[1])
+        if delay > 0:
+            time.sleep(delay)
+        os.write(fifo, data[offset:offset + INPUT_EVENT.size])
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    if not os.path.exists(path):
+        os.mkfifo(path)
+
+    print("Waiting for a reader on {}".format(path))
+    fifo = os.open(path, os.O_WRONLY)
+    try:
+        if len(sys.argv) > 2:
+            play_recording(fifo, sys.argv[2])
+        else:
+            play_script(fifo)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
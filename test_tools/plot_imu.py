@@ -1,62 +1,276 @@
-""" Plots a values from the IMU along with a rolling average of the previous N values."""
+""" Live IMU scope: accel and gyro from the stream, with rolling statistics over a few windows.
+
+Samples go into fixed size numpy rings and rolling statistics that cost O(1) each,
+as fast as the firmware sends them. The plot redraws with blitting at DISPLAY_RATE,
+however fast the samples come, and memory stays the same however long it runs.
+Rendering text is slow, so the statistics are redrawn at STATS_RATE into a second
+background that the lines are blitted over.
+
+    python3 plot_imu.py --windows 0.5,5,60 --span 10
+"""
+import argparse
 import collections
-import random
 import time
 import numpy as np
 import matplotlib.pyplot as plt
-from devices.imu import IMU
+import serial
+
+from devices.imu import FrameParser, READ_SIZE, STREAM_INTERVAL, WAKE_INTERVAL, stream_command
+from devices.imu_calibration import Calibration
 
 SERIAL_DEV = '/dev/ttyUSB0'
 SERIAL_BAUD = 57600
-DATA_POINTS = 150
-AVG_COUNT = 17
+SPAN = 10.0            # secs shown
+WINDOWS = "0.5,5,60"   # secs of each set of rolling statistics
+DISPLAY_RATE = 30      # redraws per second
+STATS_RATE = 4         # statistics text redraws per second
+ACCEL_RANGE = 512.0    # initial y limits, 2g in the firmware's units
+GYRO_RANGE = 100.0     # deg/s
+RESYNC = 64            # windows between exact recomputations of the rolling mean and variance
 
-prev_data_points = collections.deque(maxlen=AVG_COUNT)
+CHANNELS = ['ax', 'ay', 'az', 'gx', 'gy', 'gz']
 
-def plot_data(label, dataX, dataY, dataZ):
-    """ Plot data assuming X is time
-        Save the figure
+class History:
+    """ The last capacity samples of width channels.
+        Every sample is written twice, capacity apart, so the newest ones are always one contiguous view.
     """
-    fig = plt.figure(figsize=(10, 7))
-    plt.plot(dataX, dataZ, label="avg")
-    plt.plot(dataX, dataY, label="raw")
-    plt.xlabel('time(s)')
-    plt.ylabel(label)
-    #plt.yticks(np.arange(min(accel_data[0]), max(accel_data[0])+1, 0.25))
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.times = np.zeros(2 * capacity)
+        self.values = np.zeros((2 * capacity, width))
+        self.next = 0
+        self.count = 0
 
-    plt.legend()
-    fig.savefig(label + str(DATA_POINTS) + ".png")
+    def append(self, t, values):
+        i = self.next
+        self.times[i] = self.times[i + self.capacity] = t
+        self.values[i] = self.values[i + self.capacity] = values
+        self.next = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
 
-if __name__ == '__main__':
-    """ Poll the imu at random intervals and plot stuff.
-        The internal poll rate of the firmware is 20ms(50Hz)
-        so polling faster than that is pointless
+    def view(self):
+        """ (times, values) of the stored samples, oldest first. Views, valid until the next append. """
+        end = self.next + self.capacity
+        return self.times[end - self.count:end], self.values[end - self.count:end]
+
+class RollingStats:
+    """ Mean, variance, min and max of each channel over the last window samples.
+        The mean and variance slide with Welford's update; min and max are the heads of
+        monotonic queues. Rounding errors in the sliding sums are cleared by an exact
+        recomputation every RESYNC windows, so the cost per sample stays O(1) on average.
     """
-    imu = IMU(SERIAL_DEV, SERIAL_BAUD)
+    def __init__(self, window, width):
+        self.window = window
+        self.values = np.zeros((window, width))
+        self.next = 0
+        self.count = 0
+        self.added = 0
+        self.mean = np.zeros(width)
+        self.m2 = np.zeros(width)
+        self.lows = [collections.deque() for _ in range(width)]   # (index, value), rising
+        self.highs = [collections.deque() for _ in range(width)]  # (index, value), falling
 
-    accel_data = [[], [], []]
-    avg_data = []
-    time_data = []
+    def add(self, x):
+        x = np.asarray(x, float)
+        if self.count < self.window:
+            self.count += 1
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (x - self.mean)
+        else:
+            old = self.values[self.next]
+            old_mean = self.mean.copy()
+            self.mean += (x - old) / self.window
+            self.m2 += (x - old) * (x - self.mean + old - old_mean)
+        self.values[self.next] = x
+        self.next = (self.next + 1) % self.window
 
-    start_time = time.time()
-    for i in range(0, DATA_POINTS):
-        accel, gyro = imu.get_sensors()
+        index = self.added
+        self.added += 1
+        oldest = index - self.window
+        for value, lows, highs in zip(x.tolist(), self.lows, self.highs):
+            while lows and lows[-1][1] >= value:
+                lows.pop()
+            lows.append((index, value))
+            if lows[0][0] <= oldest:
+                lows.popleft()
+            while highs and highs[-1][1] <= value:
+                highs.pop()
+            highs.append((index, value))
+            if highs[0][0] <= oldest:
+                highs.popleft()
 
-        accel_data[0].append(gyro[0])
-        accel_data[1].append(gyro[1])
-        accel_data[2].append(gyro[2])
-        prev_data_points.append(accel)
+        if self.added % (RESYNC * self.window) == 0:
+            self.mean = self.values.mean(axis=0)
+            self.m2 = ((self.values - self.mean) ** 2).sum(axis=0)
 
-        if i >= AVG_COUNT:
-            avges = [sum(i) / AVG_COUNT for i in zip(*prev_data_points)]
-            avg_data.append(list(avges))
-        else:
-            avg_data.append(accel)
+    @property
+    def variance(self):
+        return np.maximum(self.m2, 0.0) / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def min(self):
+        return np.array([lows[0][1] for lows in self.lows])
+
+    @property
+    def max(self):
+        return np.array([highs[0][1] for highs in self.highs])
+
+class Scope:
+    """ Reads the stream from port on a timer and draws it, blitting only the lines and text. """
+    def __init__(self, port, span, windows, calibration=None):
+        self.port = port
+        self.parser = FrameParser()
+        self.calibration = calibration
+        self.command = stream_command(calibration)
+        self.wake = 0.0
+        self.windows = windows
+        rate = 1.0 / STREAM_INTERVAL
+        self.stats = [RollingStats(max(1, int(round(w * rate))), len(CHANNELS)) for w in windows]
+        # Raw channels, then the mean over the first window
+        self.history = History(int(span * rate), 2 * len(CHANNELS))
+        self.samples = 0
+
+        self.fig, axes = plt.subplots(2, 1, sharex=True, figsize=(12, 8))
+        self.axes = axes
+        self.lines = []
+        self.texts = []
+        for ax, (label, limit) in zip(axes, [("accel", ACCEL_RANGE), ("gyro (deg/s)", GYRO_RANGE)]):
+            ax.set_xlim(-span, 0)
+            ax.set_ylim(-limit, limit)
+            ax.set_ylabel(label)
+            ax.grid(True)
+            self.texts.append(ax.text(0.01, 0.97, "", transform=ax.transAxes, va='top',
+                                      family='monospace', fontsize=8, animated=True))
+        for i, name in enumerate(CHANNELS):
+            ax = axes[i // 3]
+            line, = ax.plot([], [], lw=1, label=name, animated=True)
+            self.lines.append(line)
+        for i, name in enumerate(CHANNELS):
+            ax = axes[i // 3]
+            line, = ax.plot([], [], lw=1.5, ls='--', color=self.lines[i].get_color(), animated=True)
+            self.lines.append(line)
+        for ax in axes:
+            ax.legend(loc='upper right')
+        axes[-1].set_xlabel("secs")
+
+        self.background = None       # Everything but the animated artists
+        self.text_background = None  # And the statistics text
+        self.stats_due = 0.0
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
 
-        time_data.append(time.time() - start_time)
-        time.sleep(random.random() * 0.1 + 0.1)
+    def read(self):
+        """ Adds every sample received since the last call. """
+        if not self.parser.frames and time.monotonic() >= self.wake:
+            # The board resets when the port opens; repeat the command until it streams
+            self.port.write(self.command)
+            self.port.flush()
+            self.wake = time.monotonic() + WAKE_INTERVAL
+
+        data = self.port.read(READ_SIZE)
+        if not data:
+            return
+        now = time.monotonic()
+        frames = self.parser.feed(data)
+        if self.calibration is not None and frames:
+            frames = self.calibration.apply_frames(frames)
+        for i, (flags, counter, values) in enumerate(frames):
+            self.add(now - (len(frames) - 1 - i) * STREAM_INTERVAL, values[0:6])
+
+    def add(self, t, values):
+        for stats in self.stats:
+            stats.add(values)
+        self.history.append(t, np.concatenate((values, self.stats[0].mean)))
+        self.samples += 1
+
+    def on_draw(self, event):
+        """ Keeps the static parts of a full redraw (after a resize or a rescale) to blit over. """
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_texts()
+        for line in self.lines:
+            self.fig.draw_artist(line)
+
+    def draw_texts(self):
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        for text in self.texts:
+            self.fig.draw_artist(text)
+        self.text_background = canvas.copy_from_bbox(self.fig.bbox)
+
+    def summary(self, channels):
+        lines = ["{:>6} {:>3} {:>9} {:>8} {:>9} {:>9}".format("window", "", "mean", "std", "min", "max")]
+        for secs, stats in zip(self.windows, self.stats):
+            mean, std, low, high = stats.mean, stats.std, stats.min, stats.max
+            for c in channels:
+                lines.append("{:>5}s {:>3} {:9.2f} {:8.3f} {:9.2f} {:9.2f}".format(
+                    secs, CHANNELS[c], mean[c], std[c], low[c], high[c]))
+        return "\n".join(lines)
+
+    def rescale(self):
+        """ Widens the y limits to the longest window's range. Returns True if any changed. """
+        stats = self.stats[-1]
+        low, high = stats.min, stats.max
+        changed = False
+        for i, ax in enumerate(self.axes):
+            bottom, top = ax.get_ylim()
+            lo, hi = low[3 * i:3 * i + 3].min(), high[3 * i:3 * i + 3].max()
+            if lo < bottom or hi > top:
+                limit = 1.2 * max(abs(lo), abs(hi))
+                ax.set_ylim(-limit, limit)
+                changed = True
+        return changed
+
+    def tick(self):
+        self.read()
+        if not self.history.count or self.background is None:
+            return
+
+        times, values = self.history.view()
+        x = times - times[-1]
+        for i, line in enumerate(self.lines):
+            line.set_data(x, values[:, i])
+
+        now = time.monotonic()
+        if now >= self.stats_due:
+            self.stats_due = now + 1.0 / STATS_RATE
+            self.texts[0].set_text(self.summary(range(0, 3)))
+            self.texts[1].set_text(self.summary(range(3, 6)))
+            if self.rescale():
+                self.fig.canvas.draw_idle() # A full redraw, which takes new backgrounds
+                return
+            self.draw_texts()
+
+        canvas = self.fig.canvas
+        canvas.restore_region(self.text_background)
+        for line in self.lines:
+            self.fig.draw_artist(line)
+        canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def run(self):
+        timer = self.fig.canvas.new_timer(interval=int(1000 / DISPLAY_RATE))
+        timer.add_callback(self.tick)
+        timer.start()
+        plt.show()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Live plot of the IMU stream with rolling statistics.")
+    parser.add_argument("--dev", default=SERIAL_DEV)
+    parser.add_argument("--baud", type=int, default=SERIAL_BAUD)
+    parser.add_argument("--span", type=float, default=SPAN, help="secs shown")
+    parser.add_argument("--windows", default=WINDOWS,
+                        help="comma separated secs of the rolling statistics; the first is also plotted")
+    parser.add_argument("--calibration", help="IMU calibration file, see devices/imu_calibration.py")
+    args = parser.parse_args()
 
-    avg_by_axis = [i for i in zip(*avg_data)]
-    plot_data('X', time_data, accel_data[0], avg_by_axis[0])
-    plot_data('Y', time_data, accel_data[1], avg_by_axis[1])
-    plot_data('Z', time_data, accel_data[2], avg_by_axis[2])
+    calibration = Calibration.load(args.calibration) if args.calibration else None
+    port = serial.Serial(args.dev, args.baud, timeout=0)
+    try:
+        Scope(port, args.span, [float(w) for w in args.windows.split(",")], calibration).run()
+    finally:
+        port.write(b'#p')
+        port.close()
@@ -0,0 +1,79 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from devices import imu
+
+def frame(counter):
+    body = imu.STREAM_HEADER.pack(imu.STREAM_SYNC, imu.STREAM_SAMPLE.size, 0, counter)
+    body += imu.STREAM_SAMPLE.pack(0.0, 0.0, 256.0, 0.0, 0.0, 0.0)
+    return body + bytes([sum(body[2:]) & 0xFF])
+
+class PipePort:
+    """ Stands in for the serial port: the stream reads the far end of a pipe. """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.commands = []
+        self.is_open = True
+
+    def fileno(self):
+        return self.read_fd
+
+    def write(self, data):
+        self.commands.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.is_open:
+            os.close(self.read_fd)
+        self.is_open = False
+
+class StreamClosed(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.port = PipePort()
+        self.stream = imu.IMUStream(self.port, self.loop)
+        self.loop.add_reader(self.port.fileno(), self.stream._read_ready)
+
+    def tearDown(self):
+        if self.port.is_open:
+            self.stream.close()
+        if self.port.write_fd is not None:
+            os.close(self.port.write_fd)
+        self.loop.close()
+
+    def wait_closed(self):
+        self.loop.call_later(1.0, self.loop.stop)
+        return self.loop.run_until_complete(self.stream.closed)
+
+    def test_samples_until_eof(self):
+        os.write(self.port.write_fd, frame(1) + frame(2))
+        os.close(self.port.write_fd)
+        self.port.write_fd = None
+        with self.assertRaises(EOFError):
+            self.wait_closed()
+        self.assertEqual(self.stream.latest.counter, 2)
+        self.assertFalse(self.port.is_open)
+
+    def test_read_error(self):
+        self.loop.remove_reader(self.port.fileno())
+        os.close(self.port.read_fd)
+        self.port.read_fd = os.open(os.devnull, os.O_WRONLY) # Reading it fails with EBADF
+        self.stream._read_ready()
+        with self.assertRaises(OSError):
+            self.wait_closed()
+        self.assertFalse(self.port.is_open)
+
+    def test_close(self):
+        self.stream.close()
+        self.assertIsNone(self.wait_closed())
+        self.assertEqual(self.port.commands, [b'#p'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from asyncio_compat import coroutine
+from devices import ms5837
+
+class FakeSensor:
+    """ Answers every init and read at once. """
+    @coroutine
+    def init_async(self):
+        yield from asyncio.sleep(0)
+        return True
+
+    @coroutine
+    def read_async(self, oversampling):
+        yield from asyncio.sleep(0)
+        return True
+
+    def pressure(self, units):
+        return 1013.25
+
+    def temperature(self, units):
+        return 20.0
+
+    def depth(self):
+        return 0.0
+
+class SamplerCallbacks(unittest.TestCase):
+    def test_failing_callback_does_not_stop_the_others(self):
+        loop = asyncio.new_event_loop()
+        sampler = ms5837.Sampler(FakeSensor(), rate=1000)
+        readings = []
+
+        def broken(reading):
+            raise ValueError("broken consumer")
+
+        sampler.on_reading(broken)
+        sampler.on_reading(readings.append)
+        task = sampler.start(loop)
+        loop.run_until_complete(asyncio.sleep(0.05))
+        self.assertFalse(task.done())
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            loop.run_until_complete(task)
+        loop.close()
+
+        self.assertGreater(len(readings), 1)
+        self.assertEqual(sampler.callback_errors, len(readings))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from devices.fake_pca9685 import FakePCA9685
+from devices.pca9685 import BatchedPWM
+
+class FailingWrites(unittest.TestCase):
+    def setUp(self):
+        self.chip = FakePCA9685(i2c=True)
+        self.pwm = BatchedPWM(self.chip)
+        self.pwm.write([2, 3], [307, 307])
+        self.failures = 0
+        write_list = self.chip._device.writeList
+
+        def flaky(register, data):
+            if self.failures:
+                self.failures -= 1
+                raise OSError(121, "Remote I/O error")
+            write_list(register, data)
+        self.chip._device.writeList = flaky
+
+    def test_failed_write_is_retried(self):
+        self.failures = 1
+        with self.assertRaises(OSError):
+            self.pwm.write([2, 3], [347, 307])
+        self.assertEqual(self.chip.off[2], 307)
+
+        skipped = self.pwm.skipped
+        self.pwm.write([2, 3], [347, 307])
+        self.assertEqual(self.chip.off[2], 347)
+        self.assertEqual(self.pwm.skipped, skipped + 1) # Only channel 3, which did not change
+        self.assertEqual(self.pwm.errors, 1)
+
+    def test_failed_neutral_is_retried(self):
+        self.pwm.write([2], [347])
+        self.failures = 1
+        with self.assertRaises(OSError):
+            self.pwm.write([2], [307]) # Failsafe neutral
+        self.pwm.write([2], [307])
+        self.assertEqual(self.chip.off[2], 307)
+
+if __name__ == "__main__":
+    unittest.main()
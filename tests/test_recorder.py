@@ -0,0 +1,43 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy
+import recorder
+
+class RecorderOrder(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "flight.rec")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def session(self, clock, count, capacity=100):
+        """ Writes count records with time.time() at clock, one sec apart. """
+        times = iter(clock + numpy.arange(count))
+        with mock.patch("recorder.time.time", lambda: next(times)):
+            rec = recorder.Recorder(self.path, capacity)
+            for i in range(count):
+                rec.record(recorder.KIND_PWM, [float(i)])
+            rec.close()
+
+    def test_clock_stepping_back_between_sessions(self):
+        self.session(10000.0, 10)
+        self.session(10000.0 - 3600, 10) # No RTC; the clock came up an hour behind
+        self.session(10000.0 - 3600, 10)
+        seqs = recorder.FlightLog(self.path).records['seq']
+        self.assertEqual(seqs.tolist(), list(range(30)))
+
+    def test_seq_order_wraps(self):
+        seqs = [recorder.SEQ_MOD - 2, recorder.SEQ_MOD - 1, 0, 1]
+        order = recorder.seq_order(numpy.array(seqs, numpy.uint32)[[2, 0, 3, 1]])
+        self.assertEqual(order.tolist(), [1, 3, 0, 2])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import packets
+import station
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def write(self, data):
+        self.sent.append(data)
+
+    def get_extra_info(self, name):
+        return ("192.168.0.15", station.PORT)
+
+class CommandReplies(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tcp = station.TCP()
+        self.tcp.connection_made(FakeTransport())
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def reply(self, request_id, body):
+        self.tcp.data_received(packets.encode_command(request_id, body))
+
+    def test_reply(self):
+        future = self.tcp.command("temp")
+        self.loop.call_soon(self.reply, self.tcp.next_id, {"ok": True, "result": 21.5})
+        self.assertEqual(self.loop.run_until_complete(future), 21.5)
+        self.assertEqual(self.tcp.pending, {})
+
+    def test_no_reply_times_out(self):
+        with mock.patch("station.COMMAND_TIMEOUT", 0.01):
+            future = self.tcp.command("temp")
+            with self.assertRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(future)
+        self.assertEqual(self.tcp.pending, {})
+        self.reply(self.tcp.next_id, {"ok": True, "result": 21.5}) # Too late, ignored
+
+    def test_connection_lost_fails_pending(self):
+        futures = [self.tcp.command("temp"), self.tcp.command("stats")]
+        with mock.patch("station.tcp_retry", mock.Mock(return_value=asyncio.sleep(0))):
+            self.loop.call_soon(self.tcp.connection_lost, None)
+            for future in futures:
+                with self.assertRaises(ConnectionError):
+                    self.loop.run_until_complete(future)
+        self.assertEqual(self.tcp.pending, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import stats
+
+class LinkStatsRestart(unittest.TestCase):
+    def send(self, link, seqs, start):
+        """ Packets sent 20ms apart from start, received as sent. Returns what accept said. """
+        return [link.accept(seq, start + i * 0.02, start + i * 0.02) for i, seq in enumerate(seqs)]
+
+    def test_restart_after_a_few_hundred_packets(self):
+        link = stats.LinkStats()
+        self.send(link, range(300), 1000.0)
+        self.assertEqual(self.send(link, range(300), 2000.0), [True] * 300)
+        self.assertEqual(link.restarts, 1)
+        self.assertEqual(link.reordered, 0)
+
+    def test_restart_within_the_reorder_window(self):
+        link = stats.LinkStats()
+        self.send(link, range(10), 1000.0)
+        self.assertEqual(self.send(link, range(10), 2000.0), [True] * 10)
+        self.assertEqual(link.restarts, 1)
+
+    def test_late_packet_is_reordered(self):
+        link = stats.LinkStats()
+        self.assertEqual(self.send(link, [0, 1, 3], 1000.0), [True] * 3)
+        self.assertFalse(link.accept(2, 1000.01, 1000.07))
+        self.assertEqual(link.reordered, 1)
+        self.assertEqual(link.restarts, 0)
+        self.assertEqual(link.lost, 0)
+
+class LinkStatsClockStep(unittest.TestCase):
+    def stream(self, link, seqs, start, step=0.0):
+        """ Packets 20ms apart, received 5ms after sending on a clock step secs ahead. """
+        return [link.accept(seq, start + i * 0.02, start + i * 0.02 + 0.005 + step)
+                for i, seq in enumerate(seqs)]
+
+    def test_rov_clock_steps_forward(self):
+        link = stats.LinkStats()
+        self.assertEqual(self.stream(link, range(50), 1000.0), [True] * 50)
+        after = self.stream(link, range(50, 100), 1001.0, step=5.0)
+        self.assertFalse(any(after[:stats.CLOCK_STEP_RUN - 1]))
+        self.assertTrue(all(after[stats.CLOCK_STEP_RUN - 1:]))
+        self.assertEqual(link.clock_steps, 1)
+
+    def test_station_clock_steps_back(self):
+        link = stats.LinkStats()
+        self.stream(link, range(50), 1000.0)
+        after = self.stream(link, range(50, 100), 1001.0 - 3.0, step=3.0)
+        self.assertTrue(all(after[stats.CLOCK_STEP_RUN - 1:]))
+
+    def test_backlog_is_not_a_clock_step(self):
+        link = stats.LinkStats()
+        self.stream(link, range(50), 1000.0)
+        # 20 packets held up by the network, delivered together 2s after the first was sent
+        sent = [1001.0 + i * 0.1 for i in range(20)]
+        accepted = [link.accept(50 + i, t, 1003.0) for i, t in enumerate(sent)]
+        self.assertEqual(link.clock_steps, 0)
+        self.assertEqual(accepted, [1003.0 - t <= stats.MAX_PACKET_AGE + 0.005 for t in sent])
+
+if __name__ == "__main__":
+    unittest.main()
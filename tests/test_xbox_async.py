@@ -0,0 +1,43 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from devices import xbox_async
+from devices.xbox_async import ABS_X, ABS_Y, EV_ABS, EV_SYN, SYN_REPORT, INPUT_EVENT
+
+def event(ev_type, code, value):
+    return INPUT_EVENT.pack(0, 0, ev_type, code, value)
+
+class EvdevSticks(unittest.TestCase):
+    def joystick(self, minimum, maximum):
+        """ An evdev Joystick whose device reports sticks from minimum to maximum. """
+        joy = xbox_async.Joystick.__new__(xbox_async.Joystick)
+        joy.state = xbox_async.NEUTRAL
+        joy.partial = b''
+        joy.raw = list(xbox_async.NEUTRAL)
+        info = xbox_async.ABSINFO.pack(0, minimum, maximum, 0, 0, 0)
+        with mock.patch("devices.xbox_async.fcntl.ioctl", return_value=info):
+            joy.read_ranges(None)
+        return joy
+
+    def stick(self, joy, x, y):
+        state, _ = joy.decode_events(event(EV_ABS, ABS_X, x) + event(EV_ABS, ABS_Y, y) +
+                                     event(EV_SYN, SYN_REPORT, 0))
+        return state.lx, state.ly
+
+    def test_byte_range_sticks_are_rescaled(self):
+        joy = self.joystick(0, 255)
+        self.assertEqual(self.stick(joy, 0, 0), (-32767, 32767))
+        self.assertEqual(self.stick(joy, 255, 255), (32767, -32767))
+        self.assertLess(abs(self.stick(joy, 128, 128)[0]), 200)
+
+    def test_full_range_sticks_are_unchanged(self):
+        joy = self.joystick(-32768, 32767)
+        self.assertEqual(self.stick(joy, 32767, 0), (32767, 0))
+        self.assertEqual(self.stick(joy, -32768, 0), (-32767, 0))
+
+if __name__ == "__main__":
+    unittest.main()